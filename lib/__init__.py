@@ -10,13 +10,24 @@ from .options import (
     setenv,
     get_elapsed_time
     )
-from .dataloader import create_dataloader
+from .dataloader import create_dataloader, fit_scaler, create_tensor_caches
 from .framework import (
     create_model,
     set_device,
     setup,
     )
 from .metrics import set_eval
+from .shards import make_shards
+from .manifest import SharedManifest
+from .checkpoint import (
+    CheckpointSchedule,
+    get_rng_states,
+    set_rng_states,
+    gather_rank_states,
+    load_checkpoint,
+    to_cpu
+    )
+from .evaluator import AsyncValidator
 from .logger import BaseLogger
 
 __all__ = [
@@ -28,9 +39,20 @@ __all__ = [
             'setenv',
             'get_elapsed_time',
             'create_dataloader',
+            'fit_scaler',
+            'create_tensor_caches',
             'create_model',
             'set_device',
             'setup',
             'set_eval',
+            'make_shards',
+            'SharedManifest',
+            'CheckpointSchedule',
+            'get_rng_states',
+            'set_rng_states',
+            'gather_rank_states',
+            'load_checkpoint',
+            'to_cpu',
+            'AsyncValidator',
             'BaseLogger'
         ]
@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import torch
+from torch import Tensor
+import torch.nn.functional as F
+import torchvision.transforms.functional as TF
+from typing import List, Dict, Tuple
+
+
+class BatchOps:
+    """
+    Class to define operations applied to a batch of images at once, ie. tensor of shape (B, C, H, W).
+
+    Parameters of each operation are given per image as tensor of shape (B,).
+    Images are float tensors whose pixel values are in [0, bound], eg. bound=255 for 8bit images,
+    and pixels are truncated to integers after each non-affine operation,
+    which follows the operations of torchvision applied to integer images.
+    """
+    @staticmethod
+    def _to_pixel(images: Tensor, bound: float) -> Tensor:
+        """
+        Clamp and truncate pixel values as integer images.
+
+        Args:
+            images (Tensor): images
+            bound (float): max pixel value
+
+        Returns:
+            Tensor: images
+        """
+        return images.clamp_(0, bound).floor_()
+
+    @staticmethod
+    def _per_image(values: Tensor) -> Tensor:
+        """
+        Reshape parameters of each image to be broadcast with images.
+
+        Args:
+            values (Tensor): parameters of shape (B,)
+
+        Returns:
+            Tensor: parameters of shape (B, 1, 1, 1)
+        """
+        return values.view(-1, 1, 1, 1)
+
+    @classmethod
+    def _blend(cls, images1: Tensor, images2: Tensor, ratios: Tensor, bound: float) -> Tensor:
+        """
+        Blend two images by ratio of each image.
+
+        Args:
+            images1 (Tensor): images
+            images2 (Tensor): images to be blended
+            ratios (Tensor): ratio of images1, shape of (B,)
+            bound (float): max pixel value
+
+        Returns:
+            Tensor: blended images
+        """
+        ratios = cls._per_image(ratios)
+        blended = ratios * images1 + (1.0 - ratios) * images2
+        return cls._to_pixel(blended, bound)
+
+    @staticmethod
+    def _grayscale(images: Tensor) -> Tensor:
+        """
+        Convert images to grayscale.
+
+        Args:
+            images (Tensor): images of 1 or 3 channels
+
+        Returns:
+            Tensor: grayscale images of 1 channel
+        """
+        if images.shape[1] == 1:
+            return images
+        r, g, b = images.unbind(dim=1)
+        gray = (0.2989 * r + 0.587 * g + 0.114 * b).floor_()
+        return gray.unsqueeze(dim=1)
+
+    @staticmethod
+    def inverse_affine_matrices(
+                                angles: Tensor,
+                                translates: Tensor,
+                                shears: Tensor,
+                                centers: Tensor
+                                ) -> Tensor:
+        """
+        Make inverse affine matrices in pixel coordinates whose origin is the image center,
+        as torchvision.transforms.functional.affine does for each image.
+
+        Args:
+            angles (Tensor): rotation angle in degrees, shape of (B,)
+            translates (Tensor): translations in pixels, shape of (B, 2)
+            shears (Tensor): shear angles in degrees along x and y, shape of (B, 2)
+            centers (Tensor): centers of rotation and shear, shape of (B, 2)
+
+        Returns:
+            Tensor: inverse affine matrices, shape of (B, 2, 3)
+        """
+        rot = torch.deg2rad(angles)
+        sx = torch.deg2rad(shears[:, 0])
+        sy = torch.deg2rad(shears[:, 1])
+        cx, cy = centers[:, 0], centers[:, 1]
+        tx, ty = translates[:, 0], translates[:, 1]
+
+        # Rotation with shear, where the determinant is 1.
+        a = torch.cos(rot - sy) / torch.cos(sy)
+        b = -torch.cos(rot - sy) * torch.tan(sx) / torch.cos(sy) - torch.sin(rot)
+        c = torch.sin(rot - sy) / torch.cos(sy)
+        d = -torch.sin(rot - sy) * torch.tan(sx) / torch.cos(sy) + torch.cos(rot)
+
+        # Inverse of rotation and shear, translation, and center translation.
+        m0, m1, m3, m4 = d, -b, -c, a
+        m2 = m0 * (-cx - tx) + m1 * (-cy - ty) + cx
+        m5 = m3 * (-cx - tx) + m4 * (-cy - ty) + cy
+        matrices = torch.stack([m0, m1, m2, m3, m4, m5], dim=1).view(-1, 2, 3)
+        return matrices
+
+    @staticmethod
+    def affine(images: Tensor, matrices: Tensor) -> Tensor:
+        """
+        Apply affine transformation to each image with nearest interpolation and zero fill.
+
+        Args:
+            images (Tensor): images, shape of (B, C, H, W)
+            matrices (Tensor): inverse affine matrices made by inverse_affine_matrices(), shape of (B, 2, 3)
+
+        Returns:
+            Tensor: transformed images
+        """
+        num_images, _, height, width = images.shape
+        x_grid = torch.linspace(-width * 0.5 + 0.5, width * 0.5 - 0.5, steps=width, device=images.device)
+        y_grid = torch.linspace(-height * 0.5 + 0.5, height * 0.5 - 0.5, steps=height, device=images.device)
+        base_grid = torch.stack([
+                                x_grid.view(1, width).expand(height, width),
+                                y_grid.view(height, 1).expand(height, width),
+                                torch.ones(height, width, device=images.device)
+                                ], dim=-1).view(1, height * width, 3)
+
+        scale = torch.tensor([0.5 * width, 0.5 * height], device=images.device)
+        rescaled_matrices = matrices.to(images.device).transpose(1, 2) / scale
+        grid = base_grid.expand(num_images, -1, -1).bmm(rescaled_matrices).view(num_images, height, width, 2)
+        return F.grid_sample(images, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+
+    @classmethod
+    def brightness(cls, images: Tensor, factors: Tensor, bound: float) -> Tensor:
+        return cls._blend(images, torch.zeros_like(images), factors, bound)
+
+    @classmethod
+    def color(cls, images: Tensor, factors: Tensor, bound: float) -> Tensor:
+        if images.shape[1] == 1:
+            # Saturation of grayscale is not changed.
+            return images
+        return cls._blend(images, cls._grayscale(images), factors, bound)
+
+    @classmethod
+    def contrast(cls, images: Tensor, factors: Tensor, bound: float) -> Tensor:
+        means = cls._grayscale(images).mean(dim=(-3, -2, -1), keepdim=True)
+        return cls._blend(images, means, factors, bound)
+
+    @classmethod
+    def sharpness(cls, images: Tensor, factors: Tensor, bound: float) -> Tensor:
+        num_channels, height, width = images.shape[1:]
+        if (height <= 2) or (width <= 2):
+            return images
+        kernel = torch.ones((3, 3), dtype=images.dtype, device=images.device)
+        kernel[1, 1] = 5.0
+        kernel = (kernel / kernel.sum()).expand(num_channels, 1, 3, 3)
+        blurred = F.conv2d(images, kernel, groups=num_channels).round_()
+        degenerate = images.clone()
+        degenerate[..., 1:-1, 1:-1] = blurred
+        return cls._blend(images, degenerate, factors, bound)
+
+    @classmethod
+    def posterize(cls, images: Tensor, bits: Tensor, bound: float) -> Tensor:
+        steps = cls._per_image(torch.pow(2.0, 8 - bits.to(images.dtype)))
+        return torch.floor(images / steps) * steps
+
+    @classmethod
+    def solarize(cls, images: Tensor, thresholds: Tensor, bound: float) -> Tensor:
+        return torch.where(images >= cls._per_image(thresholds), bound - images, images)
+
+    @classmethod
+    def autocontrast(cls, images: Tensor, bound: float) -> Tensor:
+        minimum = images.amin(dim=(-2, -1), keepdim=True)
+        maximum = images.amax(dim=(-2, -1), keepdim=True)
+        is_flat = (maximum == minimum)
+        scale = torch.where(is_flat, torch.ones_like(maximum), bound / (maximum - minimum).clamp_(min=1.0))
+        minimum = torch.where(is_flat, torch.zeros_like(minimum), minimum)
+        return cls._to_pixel((images - minimum) * scale, bound)
+
+    @classmethod
+    def equalize(cls, images: Tensor, bound: float) -> Tensor:
+        # Histogram of each image is equalized. Available only for 8bit images.
+        return TF.equalize(images.to(torch.uint8)).to(images.dtype)
+
+
+class BatchAugmentBase(BatchOps):
+    """
+    Base class of augmentation applied to a batch of integer images after collation.
+    Random parameters are sampled per image, and operations are applied to the whole batch at once.
+
+    Note:
+        When 16bit images are used, only affine transformation are applied,
+        because non-affine transformations are not available for 16bit images.
+        This is the same as the augmentations applied to each image.
+    """
+    affine_ops = ['Identity', 'ShearX', 'ShearY', 'TranslateX', 'TranslateY', 'Rotate']
+
+    def __init__(self, augmentation) -> None:
+        """
+        Args:
+            augmentation (XrayAugmentMultiBit, TrivialAugmentWideMultiBit or RandAugmentMultiBit):
+                augmentation applied to each image, whose operations and parameters for bit depth are used.
+        """
+        self.augmentation = augmentation
+        self.bit_depth = augmentation.bit_depth
+        self.bound = float(2 ** self.bit_depth - 1)
+
+    def augment(self, images: Tensor) -> Tensor:
+        raise NotImplementedError
+
+    def __call__(self, images: Tensor) -> Tensor:
+        """
+        Augment batch of images.
+
+        Args:
+            images (Tensor): integer images, shape of (B, C, H, W)
+
+        Returns:
+            Tensor: augmented images of the same dtype
+        """
+        dtype = images.dtype
+        augmented = self.augment(images.to(torch.float32))
+        return augmented.round_().clamp_(0, self.bound).to(dtype)
+
+    def __repr__(self) -> str:
+        return self.__class__.__name__ + f"({self.augmentation})"
+
+
+class BatchXrayAugment(BatchAugmentBase):
+    """
+    XrayAugmentMultiBit applied to a batch of images.
+    Affine transformation is always applied, then sharpness and autocontrast are applied with their probability
+    if they are included for the bit depth.
+    """
+    def __init__(self, augmentation) -> None:
+        """
+        Args:
+            augmentation (XrayAugmentMultiBit): augmentation applied to each image
+        """
+        super().__init__(augmentation)
+
+        # Parameters are taken from the transforms of each image so that both are always the same.
+        _transforms = augmentation.transform.transforms
+        _affine = augmentation.augmentation_space['Affine']
+        self.degrees = _affine.degrees
+        self.translate = _affine.translate
+
+        _sharpness = augmentation.augmentation_space['Sharpness']
+        self.sharpness_factor = _sharpness.sharpness_factor
+        self.sharpness_p = _sharpness.p if _sharpness in _transforms else 0.0
+
+        _contrast = augmentation.augmentation_space['Contrast']
+        self.contrast_p = _contrast.p if _contrast in _transforms else 0.0
+
+    def augment(self, images: Tensor) -> Tensor:
+        """
+        Augment batch of images.
+
+        Args:
+            images (Tensor): images
+
+        Returns:
+            Tensor: augmented images
+        """
+        num_images, _, height, width = images.shape
+
+        angles = torch.empty(num_images).uniform_(self.degrees[0], self.degrees[1])
+        max_translates = torch.tensor([self.translate[0] * width, self.translate[1] * height])
+        translates = ((torch.rand(num_images, 2) * 2.0 - 1.0) * max_translates).round_()
+        matrices = self.inverse_affine_matrices(angles, translates, torch.zeros(num_images, 2), torch.zeros(num_images, 2))
+        images = self.affine(images, matrices)
+
+        if self.sharpness_p > 0:
+            is_applied = (torch.rand(num_images) < self.sharpness_p)
+            factors = torch.where(is_applied, torch.full((num_images,), float(self.sharpness_factor)), torch.ones(num_images))
+            images = self.sharpness(images, factors.to(images.device), self.bound)
+
+        if self.contrast_p > 0:
+            is_applied = (torch.rand(num_images) < self.contrast_p).to(images.device)
+            images = torch.where(self._per_image(is_applied), self.autocontrast(images, self.bound), images)
+
+        return images
+
+
+class BatchAutoAugmentBase(BatchAugmentBase):
+    """
+    Base class of augmentation which selects operations from augmentation space for each image,
+    ie. TrivialAugmentWide and RandAugment.
+    """
+    def augmentation_space(self, image_size: Tuple[int, int]) -> Dict[str, Tuple[Tensor, bool]]:
+        raise NotImplementedError
+
+    def _sample_magnitudes(self, magnitudes: Tensor, signed: bool, num_images: int) -> Tensor:
+        raise NotImplementedError
+
+    def _apply_op(self, images: Tensor, op_name: str, magnitudes: Tensor) -> Tensor:
+        """
+        Apply non-affine operation to images.
+
+        Args:
+            images (Tensor): images
+            op_name (str): name of operation
+            magnitudes (Tensor): magnitude for each image
+
+        Returns:
+            Tensor: images
+        """
+        magnitudes = magnitudes.to(images.device)
+        if op_name == 'Brightness':
+            return self.brightness(images, 1.0 + magnitudes, self.bound)
+        if op_name == 'Color':
+            return self.color(images, 1.0 + magnitudes, self.bound)
+        if op_name == 'Contrast':
+            return self.contrast(images, 1.0 + magnitudes, self.bound)
+        if op_name == 'Sharpness':
+            return self.sharpness(images, 1.0 + magnitudes, self.bound)
+        if op_name == 'Posterize':
+            return self.posterize(images, magnitudes, self.bound)
+        if op_name == 'Solarize':
+            return self.solarize(images, magnitudes, self.bound)
+        if op_name == 'AutoContrast':
+            return self.autocontrast(images, self.bound)
+        if op_name == 'Equalize':
+            return self.equalize(images, self.bound)
+        raise ValueError(f"The provided operator {op_name} is not recognized.")
+
+    def _apply_affine_ops(self, images: Tensor, op_names: List[str], op_indices: Tensor, magnitudes: Tensor) -> Tensor:
+        """
+        Apply affine operations to images all at once with one affine matrix for each image.
+
+        Args:
+            images (Tensor): images
+            op_names (List[str]): names of operations in augmentation space
+            op_indices (Tensor): index of operation selected for each image
+            magnitudes (Tensor): magnitude for each image
+
+        Returns:
+            Tensor: images
+        """
+        num_images, _, height, width = images.shape
+        angles = torch.zeros(num_images)
+        translates = torch.zeros(num_images, 2)
+        shears = torch.zeros(num_images, 2)
+        centers = torch.zeros(num_images, 2)
+        # Shear is done around the upper left corner, as the original AutoAugment does.
+        corner = torch.tensor([-width * 0.5, -height * 0.5])
+
+        for op_index, op_name in enumerate(op_names):
+            is_op = (op_indices == op_index)
+            if op_name == 'ShearX':
+                shears[is_op, 0] = torch.rad2deg(torch.atan(magnitudes[is_op]))
+                centers[is_op] = corner
+            elif op_name == 'ShearY':
+                shears[is_op, 1] = torch.rad2deg(torch.atan(magnitudes[is_op]))
+                centers[is_op] = corner
+            elif op_name == 'TranslateX':
+                translates[is_op, 0] = magnitudes[is_op].trunc()
+            elif op_name == 'TranslateY':
+                translates[is_op, 1] = magnitudes[is_op].trunc()
+            elif op_name == 'Rotate':
+                # Rotate counter-clockwise as torchvision.transforms.functional.rotate does.
+                angles[is_op] = -magnitudes[is_op]
+
+        is_affine = torch.tensor([op_names[i] in self.affine_ops[1:] for i in op_indices.tolist()], dtype=torch.bool)
+        if not is_affine.any():
+            return images
+
+        matrices = self.inverse_affine_matrices(angles[is_affine], translates[is_affine], shears[is_affine], centers[is_affine])
+        is_affine = is_affine.to(images.device)
+        images[is_affine] = self.affine(images[is_affine], matrices)
+        return images
+
+    def _augment_once(self, images: Tensor) -> Tensor:
+        """
+        Select one operation for each image and apply it.
+
+        Args:
+            images (Tensor): images
+
+        Returns:
+            Tensor: augmented images
+        """
+        num_images, _, height, width = images.shape
+        op_meta = self.augmentation_space((height, width))
+        op_names = list(op_meta.keys())
+
+        op_indices = torch.randint(len(op_names), (num_images,))
+        magnitudes = torch.zeros(num_images)
+        for op_index, op_name in enumerate(op_names):
+            is_op = (op_indices == op_index)
+            _magnitudes, signed = op_meta[op_name]
+            if is_op.any() and (_magnitudes.ndim > 0):
+                magnitudes[is_op] = self._sample_magnitudes(_magnitudes, signed, int(is_op.sum()))
+
+        images = self._apply_affine_ops(images, op_names, op_indices, magnitudes)
+
+        for op_index, op_name in enumerate(op_names):
+            if op_name in self.affine_ops:
+                continue
+            is_op = (op_indices == op_index)
+            if is_op.any():
+                _is_op = is_op.to(images.device)
+                images[_is_op] = self._apply_op(images[_is_op], op_name, magnitudes[is_op])
+        return images
+
+
+class BatchTrivialAugmentWide(BatchAutoAugmentBase):
+    """
+    TrivialAugmentWideMultiBit applied to a batch of images.
+    One operation and its magnitude are sampled for each image.
+    """
+    def augmentation_space(self, image_size: Tuple[int, int]) -> Dict[str, Tuple[Tensor, bool]]:
+        return self.augmentation._augmentation_space(self.augmentation.num_magnitude_bins)
+
+    def _sample_magnitudes(self, magnitudes: Tensor, signed: bool, num_images: int) -> Tensor:
+        _magnitudes = magnitudes[torch.randint(len(magnitudes), (num_images,))].to(torch.float32)
+        if signed:
+            _magnitudes = torch.where(torch.rand(num_images) < 0.5, -_magnitudes, _magnitudes)
+        return _magnitudes
+
+    def augment(self, images: Tensor) -> Tensor:
+        return self._augment_once(images)
+
+
+class BatchRandAugment(BatchAutoAugmentBase):
+    """
+    RandAugmentMultiBit applied to a batch of images.
+    num_ops operations are sampled for each image, all of which have the fixed magnitude.
+    """
+    def augmentation_space(self, image_size: Tuple[int, int]) -> Dict[str, Tuple[Tensor, bool]]:
+        return self.augmentation._augmentation_space(self.augmentation.num_magnitude_bins, image_size)
+
+    def _sample_magnitudes(self, magnitudes: Tensor, signed: bool, num_images: int) -> Tensor:
+        _magnitudes = magnitudes[self.augmentation.magnitude].to(torch.float32).expand(num_images).clone()
+        if signed:
+            _magnitudes = torch.where(torch.rand(num_images) < 0.5, -_magnitudes, _magnitudes)
+        return _magnitudes
+
+    def augment(self, images: Tensor) -> Tensor:
+        for _ in range(self.augmentation.num_ops):
+            images = self._augment_once(images)
+        return images
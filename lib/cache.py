@@ -0,0 +1,561 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import fcntl
+import hashlib
+import contextlib
+import multiprocessing
+import multiprocessing.synchronize
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import torch
+from .manifest import aligned_size
+from .logger import BaseLogger
+from typing import List, Dict, Callable, Iterator, Optional, Tuple, Union
+
+
+logger = BaseLogger.get_logger(__name__)
+
+
+def hash_file(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Return hash of file contents.
+
+    Args:
+        path (str): path to file
+        chunk_size (int): size of chunk to be read at once
+
+    Returns:
+        str: hex digest of file contents
+    """
+    _hash = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            _hash.update(chunk)
+    return _hash.hexdigest()
+
+
+def make_cache_key(*parts: Union[str, int]) -> str:
+    """
+    Make key of cache from parts that determine its contents.
+
+    Args:
+        parts (Union[str, int]): parts, eg. hash of csv, bit_depth, in_channel
+
+    Returns:
+        str: key of cache
+    """
+    _key = '-'.join(str(part) for part in parts)
+    return hashlib.sha1(_key.encode('utf-8')).hexdigest()[:16]
+
+
+@contextlib.contextmanager
+def file_lock(lock_path: Path) -> Iterator[None]:
+    """
+    Hold exclusive lock of file while in context.
+    This is shared by all processes on a host, ie. DDP ranks and DataLoader workers.
+
+    Args:
+        lock_path (Path): path to lock file
+    """
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class ImageCache:
+    """
+    Class for on-disk cache of decoded images.
+
+    Decoded images are packed into a single flat file read through np.memmap.
+    Since pages of the file are held in the page cache of OS,
+    all DDP ranks and DataLoader workers on a host share them instead of decoding images independently.
+
+    Note:
+        The file consists of two parts.
+        images_<key>.bin: pixels of all images, which are concatenated in the order of sorted imgpath.
+        images_<key>.npz: imgpaths, offsets and shapes of images in images_<key>.bin.
+    """
+    def __init__(self, cache_dir: str, key: str, dtype: np.dtype) -> None:
+        """
+        Args:
+            cache_dir (str): directory of cache
+            key (str): key of cache
+            dtype (np.dtype): dtype of pixels, or np.uint8 or np.uint16
+        """
+        self.cache_dir = Path(cache_dir)
+        self.key = key
+        self.dtype = np.dtype(dtype)
+        self.data_path = Path(self.cache_dir, 'images_' + self.key + '.bin')
+        self.index_path = Path(self.cache_dir, 'images_' + self.key + '.npz')
+        self.lock_path = Path(self.cache_dir, 'images_' + self.key + '.lock')
+
+        self.imgpaths = None
+        self.offsets = None
+        self.shapes = None
+        self.data = None
+
+    def exists(self) -> bool:
+        """
+        Check if cache has been built.
+
+        Returns:
+            bool: True if built, otherwise False
+
+        Note:
+            The index is written after the data, therefore its existence means that the cache is complete.
+        """
+        return self.index_path.exists() and self.data_path.exists()
+
+    def lock(self) -> contextlib.AbstractContextManager:
+        """
+        Return lock to build cache only once among processes.
+
+        Returns:
+            contextlib.AbstractContextManager: lock
+        """
+        return file_lock(self.lock_path)
+
+    def build(
+            self,
+            imgpaths: List[str],
+            read_shape: Callable[[str], tuple],
+            decode: Callable[[str], np.ndarray],
+            num_threads: int = None
+            ) -> None:
+        """
+        Decode images and write them into cache.
+
+        Args:
+            imgpaths (List[str]): paths to images
+            read_shape (Callable[[str], tuple]): function to read shape of image, ie. (H, W) or (H, W, C), from its header
+            decode (Callable[[str], np.ndarray]): function to decode image into array of shape (H, W) or (H, W, C)
+            num_threads (int, optional): number of threads to decode images. Defaults to the number of CPUs.
+        """
+        _imgpaths = np.unique(np.array([imgpath.encode('utf-8') for imgpath in imgpaths], dtype=np.bytes_))
+        _decoded_paths = [imgpath.decode('utf-8') for imgpath in _imgpaths]
+        num_threads = os.cpu_count() if num_threads is None else num_threads
+        logger.info(f"Building image cache of {len(_decoded_paths)} images in {self.data_path} ...")
+
+        # Read headers to know shapes, then write decoded pixels at each offset.
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            shapes = list(executor.map(lambda imgpath: self._align_shape(read_shape(imgpath)), _decoded_paths))
+
+        shapes = np.array(shapes, dtype=np.int64).reshape(-1, 3)
+        sizes = shapes.prod(axis=1)
+        offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int64)
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_data_path = self.data_path.with_suffix('.bin.tmp')
+        data = np.memmap(tmp_data_path, dtype=self.dtype, mode='w+', shape=(max(int(sizes.sum()), 1),))
+
+        def _write(i: int) -> None:
+            image = decode(_decoded_paths[i])
+            data[offsets[i]:offsets[i] + sizes[i]] = np.asarray(image, dtype=self.dtype).reshape(-1)
+
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            list(executor.map(_write, range(len(_decoded_paths))))
+
+        data.flush()
+        del data
+        os.replace(tmp_data_path, self.data_path)
+
+        tmp_index_path = self.index_path.with_suffix('.tmp.npz')
+        np.savez(tmp_index_path, imgpaths=_imgpaths, offsets=offsets, shapes=shapes)
+        os.replace(tmp_index_path, self.index_path)
+        logger.info(f"Built image cache: {self.data_path}.")
+
+    @staticmethod
+    def _align_shape(shape: tuple) -> tuple:
+        """
+        Align shape of image to (H, W, C).
+
+        Args:
+            shape (tuple): (H, W) or (H, W, C)
+
+        Returns:
+            tuple: (H, W, C)
+        """
+        if len(shape) == 2:
+            return (shape[0], shape[1], 1)
+        return tuple(shape)
+
+    def open(self) -> None:
+        """
+        Open cache.
+
+        Note:
+            The file is mapped with mode='c', ie. copy-on-write, so that arrays are writable without copying
+            and torch.from_numpy() does not warn. Nothing is written back to the file.
+        """
+        index = np.load(self.index_path)
+        self.imgpaths = index['imgpaths']
+        self.offsets = index['offsets']
+        self.shapes = index['shapes']
+        self.data = np.memmap(self.data_path, dtype=self.dtype, mode='c')
+
+    def positions(self, imgpaths: np.ndarray) -> np.ndarray:
+        """
+        Return positions of images in cache.
+
+        Args:
+            imgpaths (np.ndarray): paths to images as fixed-width UTF-8 bytes
+
+        Returns:
+            np.ndarray: positions of images
+        """
+        positions = np.searchsorted(self.imgpaths, imgpaths)
+        positions = np.minimum(positions, len(self.imgpaths) - 1)
+        assert np.all(self.imgpaths[positions] == imgpaths), f"Some of images are not in cache: {self.data_path}."
+        return positions
+
+    def get(self, position: int) -> np.ndarray:
+        """
+        Return image at position without copying.
+
+        Args:
+            position (int): position of image in cache
+
+        Returns:
+            np.ndarray: image of shape (H, W) if 1 channel, otherwise (H, W, C)
+        """
+        height, width, channel = self.shapes[position]
+        offset = self.offsets[position]
+        image = self.data[offset:offset + height * width * channel]
+        if channel == 1:
+            return image.reshape(height, width)
+        return image.reshape(height, width, channel)
+
+    def __getstate__(self) -> dict:
+        """
+        Return state without the mapping, which is re-opened when unpickled in DataLoader workers.
+
+        Returns:
+            dict: state
+        """
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        """
+        Restore state and re-open the mapping.
+
+        Args:
+            state (dict): state
+        """
+        self.__dict__.update(state)
+        if self.imgpaths is not None:
+            self.data = np.memmap(self.data_path, dtype=self.dtype, mode='c')
+
+
+class TensorCache:
+    """
+    Class for cache of decoded and transformed images held in a single block of shared memory with a budget of bytes.
+
+    The parent process creates it before spawning ranks, and ranks and DataLoader workers attach to the same block,
+    so that images of split without augmentation are decoded and transformed only once on a host.
+    When the budget is full, an image is evicted with CLOCK, ie. the hand sweeps slots and evicts the first one
+    which has not been referenced since the hand passed it last, which approximates LRU in amortized O(1).
+
+    Note:
+        The block consists of five arrays and slots of images.
+        meta: hand, hits, misses, the number of used slots and slots, size of slot, and dtype and shape of images.
+        slot_of_row: slot of each row, -1 if not cached, or -2 while being written.
+        row_of_slot, referenced: row held in each slot, and whether it has been referenced since the hand passed it.
+        version: version of each slot, which is odd while being written.
+        Since images of split are stacked into a batch, all of them have the same shape, ie. the same size of slot.
+        Arrays are updated under a semaphore created with the block, which does not touch the file system,
+        but images are copied outside of it, so that workers do not wait for copies of others.
+        A reader validates its copy with version of slot like a seqlock, and handles it as a miss if slot was reused meanwhile.
+    """
+    # Positions in meta.
+    HAND, HITS, MISSES, NUM_USED, NUM_SLOTS, SLOT_NBYTES, DTYPE, NDIM, SHAPE = range(9)
+    META_SIZE = 16
+    DTYPES = [torch.uint8, torch.int8, torch.int16, torch.int32, torch.int64, torch.float16, torch.bfloat16, torch.float32, torch.float64]
+
+    def __init__(
+                self,
+                shm: shared_memory.SharedMemory,
+                num_rows: int,
+                budget: int,
+                lock: multiprocessing.synchronize.Lock,
+                owner: bool = False
+                ) -> None:
+        """
+        Args:
+            shm (shared_memory.SharedMemory): block of shared memory
+            num_rows (int): the number of rows of split
+            budget (int): bytes of slots
+            lock (multiprocessing.synchronize.Lock): lock shared by processes
+            owner (bool): whether this process unlinks the block
+        """
+        self.shm = shm
+        self.num_rows = num_rows
+        self.budget = budget
+        self.lock = lock
+        self.owner = owner
+
+        self.layout, self.data_offset = self._make_layout(num_rows)
+
+    @classmethod
+    def _make_layout(cls, num_rows: int) -> Tuple[Dict[str, Tuple[type, int, int]], int]:
+        """
+        Lay out arrays at the head of the block.
+
+        Args:
+            num_rows (int): the number of rows of split
+
+        Returns:
+            Tuple[Dict[str, Tuple[type, int, int]], int]: dtype, size and offset of each array, and offset of slots
+        """
+        layout = {}
+        position = 0
+        for name, dtype, size in [
+                                ('meta', np.int64, cls.META_SIZE),
+                                ('slot_of_row', np.int32, num_rows),
+                                ('row_of_slot', np.int32, num_rows),
+                                ('referenced', np.uint8, num_rows),
+                                ('version', np.int64, num_rows)
+                                ]:
+            layout[name] = (dtype, size, position)
+            position += aligned_size(np.dtype(dtype).itemsize * size)
+        return layout, position
+
+    def _view(self, name: str) -> np.ndarray:
+        """
+        Return array in the block without copying.
+
+        Args:
+            name (str): name of array
+
+        Returns:
+            np.ndarray: array
+
+        Note:
+            Arrays are not held, so that the block can be closed when this is garbage collected.
+        """
+        dtype, size, offset = self.layout[name]
+        return np.frombuffer(self.shm.buf, dtype=dtype, count=size, offset=offset)
+
+    @classmethod
+    def create(cls, num_rows: int, budget: int) -> 'TensorCache':
+        """
+        Create empty cache.
+
+        Args:
+            num_rows (int): the number of rows of split
+            budget (int): bytes of slots
+
+        Returns:
+            TensorCache: cache owned by this process
+        """
+        _, header_size = cls._make_layout(num_rows)
+        # Pages of slots are not allocated until images are written.
+        shm = shared_memory.SharedMemory(create=True, size=header_size + budget)
+        # Semaphore in shared memory, which is passed to ranks and workers when spawned, unlike lock of file on disk.
+        lock = multiprocessing.get_context('spawn').Lock()
+        tensor_cache = cls(shm, num_rows, budget, lock, owner=True)
+        tensor_cache._view('meta')[:] = 0
+        tensor_cache._view('slot_of_row')[:] = -1
+        tensor_cache._view('referenced')[:] = 0
+        tensor_cache._view('version')[:] = 0
+        return tensor_cache
+
+    def __getstate__(self) -> Dict:
+        """
+        Return state to be pickled, which refers to the block by name.
+
+        Returns:
+            Dict: state
+        """
+        return {'name': self.shm.name, 'num_rows': self.num_rows, 'budget': self.budget, 'lock': self.lock}
+
+    def __setstate__(self, state: Dict) -> None:
+        """
+        Attach to the block without copying.
+
+        Args:
+            state (Dict): state
+        """
+        self.__init__(shared_memory.SharedMemory(name=state['name']), state['num_rows'], state['budget'], state['lock'], owner=False)
+
+    def _slot(self, meta: np.ndarray, slot: int) -> torch.Tensor:
+        """
+        Return image in slot without copying.
+
+        Args:
+            meta (np.ndarray): meta
+            slot (int): slot
+
+        Returns:
+            torch.Tensor: view of slot
+        """
+        slot_nbytes = int(meta[self.SLOT_NBYTES])
+        dtype = self.DTYPES[meta[self.DTYPE]]
+        shape = meta[self.SHAPE:self.SHAPE + meta[self.NDIM]].tolist()
+        _bytes = torch.frombuffer(self.shm.buf, dtype=torch.uint8, count=slot_nbytes, offset=self.data_offset + slot * slot_nbytes)
+        return _bytes.view(dtype).reshape(shape)
+
+    def _set_slots(self, meta: np.ndarray, image: torch.Tensor) -> None:
+        """
+        Set size of slots to that of the first image.
+
+        Args:
+            meta (np.ndarray): meta
+            image (torch.Tensor): image
+        """
+        slot_nbytes = image.numel() * image.element_size()
+        meta[self.SLOT_NBYTES] = slot_nbytes
+        meta[self.NUM_SLOTS] = min(self.num_rows, self.budget // slot_nbytes)
+        meta[self.DTYPE] = self.DTYPES.index(image.dtype)
+        meta[self.NDIM] = image.dim()
+        meta[self.SHAPE:self.SHAPE + image.dim()] = list(image.shape)
+
+    def _fits(self, meta: np.ndarray, image: torch.Tensor) -> bool:
+        """
+        Check if image has the same dtype and shape as slots.
+
+        Args:
+            meta (np.ndarray): meta
+            image (torch.Tensor): image
+
+        Returns:
+            bool: True if it fits, otherwise False
+        """
+        shape = meta[self.SHAPE:self.SHAPE + meta[self.NDIM]].tolist()
+        return (self.DTYPES[meta[self.DTYPE]] == image.dtype) and (shape == list(image.shape))
+
+    def get(self, idx: int) -> Optional[torch.Tensor]:
+        """
+        Return copy of cached image.
+
+        Args:
+            idx (int): index of row in split
+
+        Returns:
+            Optional[torch.Tensor]: image, or None if not cached
+        """
+        meta = self._view('meta')
+        version = self._view('version')
+        with self.lock:
+            slot = int(self._view('slot_of_row')[idx])
+            if slot < 0:
+                meta[self.MISSES] += 1
+                return None
+            meta[self.HITS] += 1
+            self._view('referenced')[slot] = 1
+            read_version = int(version[slot])
+
+        image = self._slot(meta, slot).clone()
+        # Slot is reused by other process while copied, if its version has changed.
+        if version[slot] != read_version:
+            return None
+        return image
+
+    def _evict(self, meta: np.ndarray) -> Optional[int]:
+        """
+        Advance the hand to slot not referenced since the hand passed it last, and detach its row.
+
+        Args:
+            meta (np.ndarray): meta
+
+        Returns:
+            Optional[int]: slot, or None if all slots are being written
+        """
+        slot_of_row = self._view('slot_of_row')
+        row_of_slot = self._view('row_of_slot')
+        referenced = self._view('referenced')
+        version = self._view('version')
+        num_slots = int(meta[self.NUM_SLOTS])
+        hand = int(meta[self.HAND])
+        # Each slot is passed at most twice, ie. once to clear its reference and once to evict it.
+        for _ in range(2 * num_slots):
+            slot = hand
+            hand = (hand + 1) % num_slots
+            if version[slot] % 2 == 1:
+                continue
+            if referenced[slot]:
+                referenced[slot] = 0
+                continue
+            meta[self.HAND] = hand
+            row = row_of_slot[slot]
+            if slot_of_row[row] == slot:
+                slot_of_row[row] = -1
+            return slot
+        meta[self.HAND] = hand
+        return None
+
+    def put(self, idx: int, image: torch.Tensor) -> None:
+        """
+        Cache image, evicting another one if the budget is full.
+
+        Args:
+            idx (int): index of row in split
+            image (torch.Tensor): image
+        """
+        if (image.dtype not in self.DTYPES) or (image.numel() * image.element_size() > self.budget):
+            return
+
+        meta = self._view('meta')
+        slot_of_row = self._view('slot_of_row')
+        version = self._view('version')
+        with self.lock:
+            if meta[self.NUM_SLOTS] == 0:
+                self._set_slots(meta, image)
+            elif not self._fits(meta, image):
+                return
+
+            # Already cached or being written by other process.
+            if slot_of_row[idx] != -1:
+                return
+
+            num_used = int(meta[self.NUM_USED])
+            if num_used < meta[self.NUM_SLOTS]:
+                slot = num_used
+                meta[self.NUM_USED] += 1
+            else:
+                slot = self._evict(meta)
+                if slot is None:
+                    return
+
+            version[slot] += 1
+            self._view('row_of_slot')[slot] = idx
+            slot_of_row[idx] = -2
+
+        self._slot(meta, slot).copy_(image)
+
+        with self.lock:
+            version[slot] += 1
+            slot_of_row[idx] = slot
+            self._view('referenced')[slot] = 1
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Return counters summed over all processes.
+
+        Returns:
+            Dict[str, int]: hits, misses, the number of cached images and capacity
+        """
+        meta = self._view('meta')
+        return {
+                'hits': int(meta[self.HITS]),
+                'misses': int(meta[self.MISSES]),
+                'cached': int(meta[self.NUM_USED]),
+                'capacity': int(meta[self.NUM_SLOTS])
+                }
+
+    def unlink(self) -> None:
+        """
+        Release the block. Only the owner frees it.
+        """
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import queue
+import random
+import threading
+from pathlib import Path
+import numpy as np
+import torch
+import torch.distributed as dist
+from .logger import BaseLogger
+from typing import Any, Dict, List, Optional
+
+
+logger = BaseLogger.get_logger(__name__)
+
+
+class CheckpointWriter:
+    """
+    Class to write checkpoints on a background thread, so that training continues while they are written.
+
+    Jobs are done one by one in the order they are submitted.
+    Since the queue of jobs is bounded, submitting blocks while it is full.
+
+    Note:
+        Objects are serialized as they are when written, therefore they must not be modified until written.
+        Call wait() before modifying them.
+    """
+    def __init__(self, max_pending: int = 2) -> None:
+        """
+        Args:
+            max_pending (int): maximum number of jobs waiting to be done
+        """
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='CheckpointWriter', daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def write(obj: Any, path: Path) -> None:
+        """
+        Save object atomically, ie. into temporary file first, then rename it.
+
+        Args:
+            obj (Any): object, eg. state_dict
+            path (Path): path to file
+        """
+        path = Path(path)
+        tmp_path = path.with_name(path.name + '.tmp')
+        torch.save(obj, tmp_path)
+        os.replace(tmp_path, path)
+
+    def _run(self) -> None:
+        """
+        Do jobs until closed.
+        """
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                kind, obj, path, ready = job
+                if ready is not None:
+                    # Wait until object is copied from GPU.
+                    ready.synchronize()
+                if kind == 'save':
+                    self.write(obj, path)
+                else:
+                    os.replace(obj, path)
+            except Exception as e:
+                logger.error(f"Failed to write checkpoint: {e}")
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_if_failed(self) -> None:
+        """
+        Raise error which occurred in background.
+        """
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def save(self, obj: Any, path: Path, ready: Optional[torch.cuda.Event] = None) -> None:
+        """
+        Submit saving object.
+
+        Args:
+            obj (Any): object, eg. state_dict
+            path (Path): path to file
+            ready (torch.cuda.Event, optional): event recorded after object is copied from GPU
+        """
+        self._raise_if_failed()
+        self._queue.put(('save', obj, path, ready))
+
+    def rename(self, src_path: Path, dst_path: Path) -> None:
+        """
+        Submit renaming file, which is done after files submitted before are written.
+
+        Args:
+            src_path (Path): path to file
+            dst_path (Path): new path
+        """
+        self._raise_if_failed()
+        self._queue.put(('rename', src_path, dst_path, None))
+
+    def wait(self) -> None:
+        """
+        Wait until all jobs submitted are done.
+        """
+        self._queue.join()
+        self._raise_if_failed()
+
+    def close(self) -> None:
+        """
+        Wait until all jobs are done, and stop the thread.
+        """
+        self._queue.join()
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_if_failed()
+
+
+class CheckpointSchedule:
+    """
+    Class to decide when checkpoints for resuming training are saved, ie. every steps or minutes, whichever comes first.
+    """
+    # Number of steps between checks of elapsed time.
+    time_check_steps = 32
+
+    def __init__(self, steps: int = 0, minutes: float = 0) -> None:
+        """
+        Args:
+            steps (int): number of steps of training between checkpoints, or 0 if not by steps
+            minutes (float): minutes between checkpoints, or 0 if not by minutes
+        """
+        self.steps = steps
+        self.minutes = minutes
+        self.reset()
+
+    @property
+    def enabled(self) -> bool:
+        """
+        Return whether checkpoints are saved.
+
+        Returns:
+            bool: True if saved
+        """
+        return (self.steps > 0) or (self.minutes > 0)
+
+    def reset(self) -> None:
+        """
+        Start counting steps and minutes, which is done when checkpoint is saved.
+        """
+        self.num_steps = 0
+        self.start_time = time.monotonic()
+
+    def is_due(self, device: torch.device) -> bool:
+        """
+        Count a step, and return whether checkpoint is saved after it.
+
+        Args:
+            device (torch.device): device of process
+
+        Returns:
+            bool: True if checkpoint is saved
+
+        Note:
+            Since states of all processes are gathered into checkpoint, all processes have to save it at the same step.
+            Therefore, elapsed time is checked only every time_check_steps steps, which are counted in the same way by all processes,
+            and the decision of the master process is broadcast.
+        """
+        self.num_steps += 1
+        is_due = (self.steps > 0) and (self.num_steps >= self.steps)
+
+        if (self.minutes > 0) and (self.num_steps % self.time_check_steps == 0):
+            is_late = (time.monotonic() - self.start_time) >= (self.minutes * 60)
+            if dist.is_initialized() and (dist.get_world_size() > 1):
+                _is_late = torch.tensor([int(is_late)], device=device)
+                dist.broadcast(_is_late, src=0)
+                is_late = bool(_is_late.item())
+            is_due = is_due or is_late
+        return is_due
+
+
+def to_cpu(obj: Any) -> Any:
+    """
+    Return copy of object whose tensors are copied to CPU, eg. state_dict of optimizer.
+
+    Args:
+        obj (Any): object
+
+    Returns:
+        Any: copy of object
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return obj
+
+
+def get_rng_states(device: torch.device) -> Dict[str, Any]:
+    """
+    Return states of random number generators of process.
+
+    Args:
+        device (torch.device): device of process
+
+    Returns:
+        Dict[str, Any]: states of torch, numpy, random, and CUDA if on GPU
+    """
+    states = {
+            'torch': torch.get_rng_state(),
+            'numpy': np.random.get_state(),
+            'random': random.getstate()
+            }
+    if device.type == 'cuda':
+        states['cuda'] = torch.cuda.get_rng_state(device)
+    return states
+
+
+def set_rng_states(states: Dict[str, Any], device: torch.device) -> None:
+    """
+    Set states of random number generators of process.
+
+    Args:
+        states (Dict[str, Any]): states returned by get_rng_states()
+        device (torch.device): device of process
+    """
+    torch.set_rng_state(states['torch'])
+    np.random.set_state(states['numpy'])
+    random.setstate(states['random'])
+    if (device.type == 'cuda') and ('cuda' in states):
+        torch.cuda.set_rng_state(states['cuda'], device)
+
+
+def gather_rank_states(state: Any) -> List[Any]:
+    """
+    Gather states of all processes, eg. states of random number generators.
+
+    Args:
+        state (Any): state of this process
+
+    Returns:
+        List[Any]: states of processes in order of rank
+    """
+    if dist.is_initialized() and (dist.get_world_size() > 1):
+        states = [None] * dist.get_world_size()
+        dist.all_gather_object(states, state)
+        return states
+    return [state]
+
+
+def load_checkpoint(checkpoint_path: str) -> Dict[str, Any]:
+    """
+    Load checkpoint for resuming training.
+
+    Args:
+        checkpoint_path (str): path to checkpoint
+
+    Returns:
+        Dict[str, Any]: checkpoint
+    """
+    logger.info(f"Load checkpoint: {checkpoint_path}.\n")
+    # Checkpoint includes states of random number generators, which are not only tensors.
+    return torch.load(checkpoint_path, map_location='cpu', weights_only=False)
@@ -4,7 +4,7 @@
 from .net import create_net
 from .criterion import set_criterion
 from .optimizer import set_optimizer
-from .loss import set_loss_store
+from .loss import set_loss_store, LossSum
 from .likelihood import set_likelihood
 
 __all__ = [
@@ -12,5 +12,6 @@ __all__ = [
             'set_criterion',
             'set_optimizer',
             'set_loss_store',
+            'LossSum',
             'set_likelihood'
         ]
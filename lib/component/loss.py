@@ -2,10 +2,12 @@
 # -*- coding: utf-8 -*-
 
 from pathlib import Path
+import copy
 import torch
+import torch.distributed as dist
 import pandas as pd
 from ..logger import BaseLogger
-from typing import List, Dict, Union
+from typing import List, Dict, Tuple, Union
 
 
 logger = BaseLogger.get_logger(__name__)
@@ -41,18 +43,16 @@ class LabelLoss:
         _target = phase + '_' + target + '_loss'
         return getattr(self, _target)
 
-    def store_batch_loss(self, phase: str, new_batch_loss: torch.FloatTensor, batch_size: int) -> None:
+    def add_batch_loss(self, phase: str, loss_sum: float) -> None:
         """
-        Add new batch loss to previous one for phase by multiplying by batch_size.
+        Add sum of losses, ie. loss * batch_size, to previous one for phase.
 
         Args:
             phase (str): 'train' or 'val'
-            new_batch_loss (torch.FloatTensor): batch loss calculated by criterion
-            batch_size (int): batch size
+            loss_sum (float): sum of losses
         """
-        _new = new_batch_loss.item() * batch_size  # torch.FloatTensor -> float
         _prev = self.get_loss(phase, 'batch')
-        _added = _prev + _new
+        _added = _prev + loss_sum
         _target = phase + '_' + 'batch_loss'
         setattr(self, _target, _added)
 
@@ -128,26 +128,43 @@ class LossStore:
         # For counting total number of data learned at phase in each epoch.
         self.total_num_data = {'train': 0, 'val': 0}
 
-    def store(self, phase: str, losses: Dict[str, torch.FloatTensor], batch_size: int = None) -> None:
+    def store_sums(self, phase: str, loss_sums: Dict[str, float], num_data: int) -> None:
         """
-        Store label-wise batch losses of phase to previous one.
+        Store label-wise sums of losses of phase reduced over all processes.
 
         Args:
             phase (str): 'train' or 'val'
-            losses (Dict[str, torch.FloatTensor]): loss for each label calculated by criterion
-            batch_size (int): batch size
+            loss_sums (Dict[str, float]): sum of losses for each label over all processes
+            num_data (int): number of data processed by all processes
 
-        # Note:
-            self.loss_stores['total'] is already total of losses of all label, which is calculated in criterion.py,
-            therefore, it is OK just to multiply by batch_size. This is done in add_batch_loss().
+        Note:
+            Sums are reduced by LossSum at the end of phase or at checkpoint, so that losses are not synchronized at every step.
+            Processes may handle different numbers of data, eg. at validation.
         """
         for label_name in self.label_list + ['total']:
-            _new_batch_loss = losses[label_name]
-            self.label_losses[label_name].store_batch_loss(phase, _new_batch_loss, batch_size)
+            self.label_losses[label_name].add_batch_loss(phase, loss_sums[label_name])
+        self.total_num_data[phase] = self.total_num_data[phase] + num_data
+
+    def pop_sums(self, phase: str) -> Tuple[Dict[str, float], int]:
+        """
+        Return label-wise sums of losses of phase stored so far, and clear them.
+
+        Args:
+            phase (str): 'train' or 'val'
+
+        Returns:
+            Tuple[Dict[str, float], int]: sum of losses for each label, and the number of data
 
-        # Add total number of data in each phase and each iteration.
-        # Each process handles the same number of data.
-        self.total_num_data[phase] = self.total_num_data[phase] + (batch_size * self.world_size)
+        Note:
+            This is used when epoch loss is calculated later, eg. after validated asynchronously.
+        """
+        loss_sums = {}
+        for label_name in self.label_list + ['total']:
+            loss_sums[label_name] = self.label_losses[label_name].get_loss(phase, 'batch')
+            setattr(self.label_losses[label_name], phase + '_' + 'batch_loss', 0.0)
+        num_data = self.total_num_data[phase]
+        self.total_num_data[phase] = 0
+        return loss_sums, num_data
 
     def cal_epoch_loss(self, at_epoch: int = None) -> None:
         """
@@ -182,6 +199,29 @@ class LossStore:
         for phase in ['train', 'val']:
             self.total_num_data[phase] = 0
 
+    def state_dict(self) -> Dict:
+        """
+        Return losses stored so far, including those of epoch in progress, and the best epoch.
+
+        Returns:
+            Dict: state
+        """
+        return {
+                'label_losses': {label_name: copy.deepcopy(vars(label_loss)) for label_name, label_loss in self.label_losses.items()},
+                'total_num_data': dict(self.total_num_data)
+                }
+
+    def load_state_dict(self, state: Dict) -> None:
+        """
+        Load state returned by state_dict().
+
+        Args:
+            state (Dict): state
+        """
+        for label_name, label_loss in state['label_losses'].items():
+            vars(self.label_losses[label_name]).update(copy.deepcopy(label_loss))
+        self.total_num_data = dict(state['total_num_data'])
+
     def is_val_loss_updated(self) -> bool:
         """
         Check if val_loss of 'total' is updated.
@@ -259,3 +299,51 @@ def set_loss_store(label_list: List[str], num_epochs: int, world_size: int) -> L
         LossStore: LossStore
     """
     return LossStore(label_list=label_list, num_epochs=num_epochs, world_size=world_size)
+
+
+class LossSum:
+    """
+    Class to accumulate label-wise sums of losses on device and reduce them over all processes at once.
+    """
+    def __init__(self, label_list: List[str], device: torch.device) -> None:
+        """
+        Args:
+            label_list (List[str]): label list
+            device (torch.device): device
+        """
+        self.loss_names = label_list + ['total']
+        # Sums of losses for each label, and the number of data at the end.
+        self.sums = torch.zeros(len(self.loss_names) + 1, dtype=torch.float64, device=device)
+
+    def add(self, losses: Dict[str, torch.FloatTensor], batch_size: int) -> None:
+        """
+        Add batch losses multiplied by batch_size.
+
+        Args:
+            losses (Dict[str, torch.FloatTensor]): loss for each label calculated by criterion
+            batch_size (int): batch size
+        """
+        _batch = torch.stack([losses[loss_name].detach().sum() for loss_name in self.loss_names])
+        self.sums[:-1] += _batch.to(torch.float64) * batch_size
+        self.sums[-1] += batch_size
+
+    def all_reduce(self) -> Tuple[Dict[str, float], int]:
+        """
+        Reduce sums over all processes with a single all_reduce, and clear them to accumulate again.
+
+        Returns:
+            Tuple[Dict[str, float], int]: sum of losses for each label, and the number of data
+        """
+        dist.all_reduce(self.sums, op=dist.ReduceOp.SUM)
+        return self.pop()
+
+    def pop(self) -> Tuple[Dict[str, float], int]:
+        """
+        Return sums of this process without reducing them, and clear them to accumulate again.
+
+        Returns:
+            Tuple[Dict[str, float], int]: sum of losses for each label, and the number of data
+        """
+        _sums = self.sums.tolist()
+        self.sums.zero_()
+        return dict(zip(self.loss_names, _sums[:-1])), int(_sums[-1])
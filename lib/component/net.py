@@ -10,7 +10,8 @@ from torchvision.ops import MLP
 import torchvision.models as models
 from torchvision.models.convnext import LayerNorm2d
 from torch import Tensor
-from typing import List, Dict, Optional, Union
+from ..dataloader import NORMALIZE_MEAN_STD
+from typing import List, Dict, Optional, Tuple, Union
 
 
 class PermuteWithContiguous(nn.Module):
@@ -41,6 +42,150 @@ class LayerNorm2dWithContiguous(nn.LayerNorm):
         return x
 
 
+class FoldedNormalizeConv2d(nn.Conv2d):
+    """
+    Class of convolution into which image normalization is folded.
+
+    Unnormalized image is input, and weight and bias are folded with mean and std,
+    so that the output is the same as the convolution of normalized image.
+    Since weight and bias are kept as they are, and mean and std are not saved in state_dict,
+    weights are interchangeable with those of nn.Conv2d to which normalized image is input.
+
+    Note:
+        Folding pays off only while weight is unchanged, ie. at validation or test, when folded weight is reused.
+        When grad is needed, weight is updated every step, and folding it per step with the correction at borders
+        costs more than normalization, therefore image is normalized in this module instead.
+    """
+    def __init__(self, *args, mean: List[float] = None, std: List[float] = None, **kwargs) -> None:
+        """
+        Args:
+            mean (List[float]): mean of normalization for each channel
+            std (List[float]): std of normalization for each channel
+        """
+        super().__init__(*args, **kwargs)
+        self.register_buffer('mean', torch.tensor(mean, dtype=torch.float32), persistent=False)
+        self.register_buffer('std', torch.tensor(std, dtype=torch.float32), persistent=False)
+        # Weight and bias folded at validation or test, which are reused while weight is unchanged.
+        self.register_buffer('folded_weight', None, persistent=False)
+        self.register_buffer('folded_bias', None, persistent=False)
+        self.register_buffer('border_correction', None, persistent=False)
+        self._folded_key = None
+
+    @classmethod
+    def fold(cls, conv: nn.Conv2d, mean: List[float], std: List[float]) -> 'FoldedNormalizeConv2d':
+        """
+        Make convolution into which normalization is folded, sharing weight and bias with conv.
+
+        Args:
+            conv (nn.Conv2d): the first convolution of network
+            mean (List[float]): mean of normalization for each channel
+            std (List[float]): std of normalization for each channel
+
+        Returns:
+            FoldedNormalizeConv2d: convolution into which normalization is folded
+        """
+        folded_conv = cls(
+                        conv.in_channels,
+                        conv.out_channels,
+                        conv.kernel_size,
+                        stride=conv.stride,
+                        padding=conv.padding,
+                        dilation=conv.dilation,
+                        groups=conv.groups,
+                        bias=(conv.bias is not None),
+                        padding_mode=conv.padding_mode,
+                        mean=mean,
+                        std=std
+                        )
+        folded_conv.weight = conv.weight
+        folded_conv.bias = conv.bias
+        return folded_conv
+
+    def _is_unpadded(self) -> bool:
+        """
+        Return whether convolution has no padding.
+
+        Returns:
+            bool: True if no padding
+        """
+        return all(padding == 0 for padding in self.padding) or (self.padding == 'valid')
+
+    def _fold(self, x: Tensor) -> Tuple[Tensor, Optional[Tensor], Optional[Tensor]]:
+        """
+        Fold normalization into weight and bias.
+
+        Args:
+            x (Tensor): unnormalized image, whose shape decides the correction at borders
+
+        Returns:
+            Tuple[Tensor, Optional[Tensor], Optional[Tensor]]: folded weight, folded bias, and correction subtracted from output if padded
+
+        Note:
+            conv((x - mean) / std, W) + b = conv(x, W / std) + b - conv(1, W * mean / std)
+            The last term is a constant when no padding. Otherwise, zero padding in the normalized space
+            makes it vary at borders, therefore it is computed by the convolution of an image of ones.
+        """
+        inv_std = 1.0 / self.std
+        weight = self.weight * inv_std.view(1, -1, 1, 1)
+        shift_weight = self.weight * (self.mean * inv_std).view(1, -1, 1, 1)
+
+        if self._is_unpadded():
+            bias = -shift_weight.sum(dim=(1, 2, 3))
+            if self.bias is not None:
+                bias = bias + self.bias
+            return weight, bias, None
+
+        ones = x.new_ones((1, ) + tuple(x.shape[1:]))
+        return weight, self.bias, self._conv_forward(ones, shift_weight, None)
+
+    def _get_folded(self, x: Tensor) -> Tuple[Tensor, Optional[Tensor], Optional[Tensor]]:
+        """
+        Return folded weight, bias and correction, which are cached while weight is unchanged.
+
+        Args:
+            x (Tensor): unnormalized image
+
+        Returns:
+            Tuple[Tensor, Optional[Tensor], Optional[Tensor]]: folded weight, folded bias, and correction subtracted from output if padded
+
+        Note:
+            Cache is dropped when weight or bias is updated in place, eg. by optimizer or load_state_dict,
+            which is detected by their versions, or when shape, dtype or device of image changes.
+        """
+        key = tuple(
+                    (param.data_ptr(), param._version)
+                    for param in (self.weight, self.bias) if param is not None
+                    ) + (tuple(x.shape[1:]), x.dtype, x.device)
+        if key != self._folded_key:
+            # Detached, since bias itself is returned when padded, which must not be registered as parameter again.
+            self.folded_weight, self.folded_bias, self.border_correction = (
+                                                                        None if folded is None else folded.detach()
+                                                                        for folded in self._fold(x)
+                                                                        )
+            self._folded_key = key
+        return self.folded_weight, self.folded_bias, self.border_correction
+
+    def forward(self, x: Tensor) -> Tensor:
+        """
+        Forward.
+
+        Args:
+            x (Tensor): unnormalized image
+
+        Returns:
+            Tensor: the same output as that of the convolution of normalized image
+        """
+        if torch.is_grad_enabled() and self.weight.requires_grad:
+            x = (x - self.mean.view(1, -1, 1, 1).to(x.dtype)) / self.std.view(1, -1, 1, 1).to(x.dtype)
+            return self._conv_forward(x, self.weight, self.bias)
+
+        weight, bias, border_correction = self._get_folded(x)
+        output = self._conv_forward(x, weight, bias)
+        if border_correction is not None:
+            output = output - border_correction
+        return output
+
+
 def replace_all_layer_type_recursive(net: nn.Module) -> None:
     """
     Replace all layer type recursively.
@@ -155,7 +300,8 @@ class BaseNet:
                 net_name: str = None,
                 in_channel: int = None,
                 vit_image_size: int = None,
-                pretrained: bool = None
+                pretrained: bool = None,
+                normalize_image: str = None
                 ) -> nn.Module:
         """
         Modify network depending on in_channel and vit_image_size.
@@ -166,6 +312,7 @@ class BaseNet:
             vit_image_size (int, optional): image size which ViT handles if ViT is used. Defaults to None.
                                             vit_image_size should be power of patch size.
             pretrained (bool, optional): True when use pretrained CNN or ViT, otherwise False. Defaults to None.
+            normalize_image (str, optional): 'fold' if image normalization is folded into the first convolution. Defaults to None.
 
         Returns:
             nn.Module: modified network
@@ -211,6 +358,9 @@ class BaseNet:
         if in_channel == 1:
             net = cls.align_in_channels_1ch(net_name=net_name, net=net)
 
+        if normalize_image == 'fold':
+            net = cls.fold_normalization(net_name=net_name, net=net, in_channel=in_channel)
+
         return net
 
     @classmethod
@@ -284,6 +434,43 @@ class BaseNet:
 
         raise ValueError(f"No specified net: {net_name}.")
 
+    @classmethod
+    def fold_normalization(cls, net_name: str = None, net: nn.Module = None, in_channel: int = None) -> nn.Module:
+        """
+        Fold image normalization into the first layer of network.
+
+        Args:
+            net_name (str): network name
+            net (nn.Module): network itself
+            in_channel (int): image channel(any of 1ch or 3ch)
+
+        Returns:
+            nn.Module: network to which unnormalized image is input
+        """
+        mean, std = NORMALIZE_MEAN_STD[in_channel]
+
+        if net_name.startswith('ResNet'):
+            net.conv1 = FoldedNormalizeConv2d.fold(net.conv1, mean, std)
+            return net
+
+        if net_name.startswith('DenseNet'):
+            net.features.conv0 = FoldedNormalizeConv2d.fold(net.features.conv0, mean, std)
+            return net
+
+        if net_name.startswith('EfficientNet'):
+            net.features[0][0] = FoldedNormalizeConv2d.fold(net.features[0][0], mean, std)
+            return net
+
+        if net_name.startswith('ConvNeXt'):
+            net.features[0][0] = FoldedNormalizeConv2d.fold(net.features[0][0], mean, std)
+            return net
+
+        if net_name.startswith('ViT'):
+            net.conv_proj = FoldedNormalizeConv2d.fold(net.conv_proj, mean, std)
+            return net
+
+        raise ValueError(f"No specified net: {net_name}.")
+
     @classmethod
     def construct_extractor(
                             cls,
@@ -291,7 +478,8 @@ class BaseNet:
                             mlp_num_inputs: int = None,
                             in_channel: int = None,
                             vit_image_size: int = None,
-                            pretrained: bool = None
+                            pretrained: bool = None,
+                            normalize_image: str = None
                             ) -> nn.Module:
         """
         Construct extractor of network depending on net_name.
@@ -302,6 +490,7 @@ class BaseNet:
             in_channel (int, optional): image channel(any of 1ch or 3ch). Defaults to None.
             vit_image_size (int, optional): image size which ViT handles if ViT is used. Defaults to None.
             pretrained (bool, optional): True when use pretrained CNN or ViT, otherwise False. Defaults to None.
+            normalize_image (str, optional): 'fold' if image normalization is folded into the first convolution. Defaults to None.
 
         Returns:
             nn.Module: extractor of network
@@ -313,7 +502,8 @@ class BaseNet:
                                     net_name=net_name,
                                     in_channel=in_channel,
                                     vit_image_size=vit_image_size,
-                                    pretrained=pretrained
+                                    pretrained=pretrained,
+                                    normalize_image=normalize_image
                                     )
             # Replace classifier with DUMMY(=nn.Identity()).
             setattr(extractor, cls.classifier[net_name], cls.DUMMY)
@@ -513,7 +703,8 @@ class MultiNet(MultiWidget):
                 mlp_num_inputs: int = None,
                 in_channel: int = None,
                 vit_image_size: int = None,
-                pretrained: bool = None
+                pretrained: bool = None,
+                normalize_image: str = None
                 ) -> None:
         """
         Args:
@@ -523,6 +714,7 @@ class MultiNet(MultiWidget):
             in_channel (int): number of image channel, ie gray scale(=1) or color image(=3).
             vit_image_size (int): image size to be input to ViT.
             pretrained (bool): True when use pretrained CNN or ViT, otherwise False.
+            normalize_image (str): 'fold' if image normalization is folded into the first convolution.
         """
         super().__init__()
 
@@ -532,6 +724,7 @@ class MultiNet(MultiWidget):
         self.in_channel = in_channel
         self.vit_image_size = vit_image_size
         self.pretrained = pretrained
+        self.normalize_image = normalize_image
 
         # self.extractor_net = MLP or CVmodel
         self.extractor_net = self.construct_extractor(
@@ -539,7 +732,8 @@ class MultiNet(MultiWidget):
                                                     mlp_num_inputs=self.mlp_num_inputs,
                                                     in_channel=self.in_channel,
                                                     vit_image_size=self.vit_image_size,
-                                                    pretrained=self.pretrained
+                                                    pretrained=self.pretrained,
+                                                    normalize_image=self.normalize_image
                                                     )
         # Multi classifier
         self.multi_classifier = self.construct_multi_classifier(net_name=self.net_name, num_outputs_for_label=self.num_outputs_for_label)
@@ -570,7 +764,8 @@ class MultiNetFusion(MultiWidget):
                 mlp_num_inputs: int = None,
                 in_channel: int = None,
                 vit_image_size: int = None,
-                pretrained: bool = None
+                pretrained: bool = None,
+                normalize_image: str = None
                 ) -> None:
         """
         Args:
@@ -580,6 +775,7 @@ class MultiNetFusion(MultiWidget):
             in_channel (int): number of image channel, ie gray scale(=1) or color image(=3).
             vit_image_size (int): image size to be input to ViT.
             pretrained (bool): True when use pretrained CNN or ViT, otherwise False.
+            normalize_image (str): 'fold' if image normalization is folded into the first convolution.
         """
         assert (net_name != 'MLP'), 'net_name should not be MLP.'
 
@@ -591,6 +787,7 @@ class MultiNetFusion(MultiWidget):
         self.in_channel = in_channel
         self.vit_image_size = vit_image_size
         self.pretrained = pretrained
+        self.normalize_image = normalize_image
 
         # Extractor of MLP and Net
         self.extractor_mlp = self.construct_extractor(net_name='MLP', mlp_num_inputs=self.mlp_num_inputs)
@@ -598,7 +795,8 @@ class MultiNetFusion(MultiWidget):
                                                     net_name=self.net_name,
                                                     in_channel=self.in_channel,
                                                     vit_image_size=self.vit_image_size,
-                                                    pretrained=self.pretrained
+                                                    pretrained=self.pretrained,
+                                                    normalize_image=self.normalize_image
                                                     )
         self.aux_module = self.construct_aux_module(self.net_name)
 
@@ -673,7 +871,8 @@ def create_net(
             mlp_num_inputs: int = None,
             in_channel: int = None,
             vit_image_size: int = None,
-            pretrained: bool = None
+            pretrained: bool = None,
+            normalize_image: str = None
             ) -> Union[MultiNet, MultiNetFusion]:
     """
     Create network.
@@ -686,6 +885,7 @@ def create_net(
         in_channel (int): number of image channel, ie gray scale(=1) or color image(=3).
         vit_image_size (int): image size to be input to ViT.
         pretrained (bool): True when use pretrained CNN or ViT, otherwise False.
+        normalize_image (str): 'fold' if image normalization is folded into the first convolution.
 
     Returns:
         Union[MultiNet, MultiNetFusion]: network
@@ -711,7 +911,8 @@ def create_net(
                             mlp_num_inputs=mlp_num_inputs,
                             in_channel=in_channel,
                             vit_image_size=vit_image_size,
-                            pretrained=pretrained
+                            pretrained=pretrained,
+                            normalize_image=normalize_image
                             )
 
     elif _isFusion:
@@ -721,7 +922,8 @@ def create_net(
                                 mlp_num_inputs=mlp_num_inputs,
                                 in_channel=in_channel,
                                 vit_image_size=vit_image_size,
-                                pretrained=pretrained
+                                pretrained=pretrained,
+                                normalize_image=normalize_image
                                 )
     else:
         raise ValueError(f"Invalid model type: mlp={mlp}, net={net}.")
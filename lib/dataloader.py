@@ -1,48 +1,110 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
 import math
+import itertools
+import random
+from pathlib import Path
 import numpy as np
 import pandas as pd
 from PIL import Image
-from sklearn.preprocessing import MinMaxScaler
-import pickle
+import cv2
 import torch
 from torch import Tensor
 import torchvision.transforms as transforms
-from torch.utils.data.dataset import Dataset
-from torch.utils.data.dataloader import DataLoader
+from torch.utils.data.dataset import Dataset, IterableDataset
+from torch.utils.data.dataloader import DataLoader, get_worker_info
+from torch.utils.data.sampler import RandomSampler, SequentialSampler
 import torch.distributed as dist
-from torch.utils.data.sampler import WeightedRandomSampler
-from torch.utils.data.distributed import DistributedSampler
+from .batch_augment import BatchAugmentBase, BatchXrayAugment, BatchTrivialAugmentWide, BatchRandAugment
+from .cache import ImageCache, TensorCache, hash_file, make_cache_key
+from .loader_tuner import tune_loader
+from .shards import load_shard_index, iter_shard
+from .prescan import PrescanIndex, find_invalid_images
+from .prefetch import PrefetchBatch, FilePrefetcher, lookahead_loader_kwargs
+from .profiler import LoadingProfiler
+from .manifest import SharedManifest, StringColumn
+from .scaler import MinMaxScaler
+from .sampler import set_sampler, set_eval_sampler, ResumableSampler
 from .logger import BaseLogger
-from typing import List, Dict, Union, Tuple, Optional, Iterator
+from typing import List, Dict, Union, Tuple, Optional, Iterator, Callable
 
 
 logger = BaseLogger.get_logger(__name__)
 
 
-class InputDataMixin:
+# Mean and std of image normalization for each in_channel
+NORMALIZE_MEAN_STD = {
+                    1: ((0.5, ), (0.5, )),
+                    3: ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))
+                    }
+
+
+def fit_scaler(df_source: Union[pd.DataFrame, SharedManifest], input_list: List[str], chunk_size: int = 65536) -> MinMaxScaler:
     """
-    Class to normalizes input data.
+    Fit scaler to input data of training data, reading rows chunk by chunk.
+
+    Args:
+        df_source (Union[pd.DataFrame, SharedManifest]): parsed csv
+        input_list (List[str]): columns of inputs
+        chunk_size (int): number of rows read at once
+
+    Returns:
+        MinMaxScaler: scaler
+
+    Note:
+        This is done once in the parent process, and the scaler is passed to all ranks and splits.
     """
-    def _make_scaler(self, df_train_input: pd.DataFrame) -> MinMaxScaler:
-        """
-        Make scaler to normalize input data by min-max normalization with train data.
+    if isinstance(df_source, SharedManifest):
+        _columns = [df_source.column(input_name, 'train') for input_name in input_list]
+    else:
+        _is_train = (df_source['split'] == 'train').to_numpy()
+        _columns = [df_source[input_name].to_numpy()[_is_train] for input_name in input_list]
 
-        Args:
-            df_train_input (pd.DataFrame): training data
+    num_rows = len(_columns[0]) if _columns != [] else 0
+    chunks = (
+            torch.from_numpy(np.stack([column[start:start + chunk_size] for column in _columns], axis=1).astype(np.float64, copy=False))
+            for start in range(0, num_rows, chunk_size)
+            )
+    return MinMaxScaler(len(input_list)).fit(chunks)
 
-        Returns:
-            MinMaxScaler: scaler
 
-        Note:
-            Input data should be normalized with min and max of training data.
-        """
-        scaler = MinMaxScaler()
-        _ = scaler.fit(df_train_input)  # fit only
-        return scaler
+def create_tensor_caches(params, splits: List[str]) -> Dict[str, TensorCache]:
+    """
+    Create caches of transformed images for splits without augmentation.
+
+    Args:
+        params (ParamSet): parameter for dataloader
+        splits (List[str]): splits
+
+    Returns:
+        Dict[str, TensorCache]: split and its cache, or empty if tensor_cache_mb is 0
+
+    Note:
+        This is done once in the parent process, and caches are shared by all ranks and workers on the host.
+        At training, train is cached only if no augmentation.
+    """
+    if (params.net is None) or (params.tensor_cache_mb <= 0):
+        return {}
+
+    tensor_caches = {}
+    for split in splits:
+        if params.isTrain and (split == 'train') and (params.augmentation != 'no'):
+            continue
+        if isinstance(params.df_source, SharedManifest):
+            start, stop = params.df_source.split_ranges.get(split, (0, 0))
+            num_rows = stop - start
+        else:
+            num_rows = int((params.df_source['split'] == split).sum())
+        tensor_caches[split] = TensorCache.create(num_rows, params.tensor_cache_mb << 20)
+    return tensor_caches
 
+
+class InputDataMixin:
+    """
+    Class to normalizes input data.
+    """
     def save_scaler(self, save_path :str) -> None:
         """
         Save scaler
@@ -50,23 +112,20 @@ class InputDataMixin:
         Args:
             save_path (str): path for saving scaler.
         """
-        with open(save_path, 'wb') as f:
-            pickle.dump(self.scaler, f)
+        self.scaler.save(save_path)
 
-    def load_scaler(self, scaler_path :str) -> None:
+    def load_scaler(self, scaler_path :str) -> MinMaxScaler:
         """
         Load scaler.
 
         Args:
             scaler_path (str): path to scaler
         """
-        with open(scaler_path, 'rb') as f:
-            scaler = pickle.load(f)
-        return scaler
+        return MinMaxScaler.load(scaler_path)
 
     def _normalize_inputs(self, scaler: MinMaxScaler, df_inputs: pd.DataFrame) -> torch.FloatTensor:
         """
-        Normalize inputs.
+        Normalize inputs of all rows at once.
 
         Args:
             scaler (MinMaxScaler): scaler
@@ -76,14 +135,12 @@ class InputDataMixin:
             torch.FloatTensor: normalized inputs
 
         Note:
-            After iloc[[idx], index_input_list], pd.DataFrame is obtained.
-            DataFrame fits the input type of self.scaler.transform.
-            However, after normalizing, the shape of inputs_value is (1, N), where N is the number of input values.
-            Since the shape (1, N) is not acceptable when forwarding, convert (1, N) -> (N,) is needed.
-        """
-        inputs_value = scaler.transform(df_inputs).reshape(-1)   #    np.float64
-        inputs_value = np.array(inputs_value, dtype=np.float32)  # -> np.float32
-        inputs_value = torch.from_numpy(inputs_value).clone()    # -> torch.float32
+            The shape of inputs_value is (M, N), where M is the number of rows and N is the number of input values.
+            Since this is done once when the dataset is built, each row is obtained just by indexing inputs_value.
+        """
+        inputs_value = torch.from_numpy(df_inputs.to_numpy(dtype=np.float64))     #    torch.float64
+        inputs_value = scaler(inputs_value)
+        inputs_value = inputs_value.to(torch.float32).contiguous()                # -> torch.float32
         return inputs_value
 
 
@@ -260,314 +317,1247 @@ class ToTensorMultiBit:
         return self.__class__.__name__ + f"(bit_depth={self.bit_depth})"
 
 
-class ImageMixin:
+class ResizeMultiBit:
     """
-    Class to normalize and transform image.
+    Resize PIL image or array with different bit depth to square of image_size.
+
+    Note:
+        For PIL image, draft() lets decoder reduce resolution while decoding if supported, ie. JPEG,
+        and resize() reduces image by integer factor before resampling when image is much larger than image_size.
+        Array is resized by area interpolation, which is available for both np.uint8 and np.uint16.
     """
-    def _set_expected_mode(
-                            self,
-                            bit_depth: int,
-                            in_channel: int
-                            ) -> str:
+    # Image is reduced by integer factor until its size is less than reducing_gap times image_size.
+    reducing_gap = 2.0
+    # Interpolation for each decoder, which makes different pixels.
+    interpolations = {'pil': f"draft-bilinear-{reducing_gap}", 'native': 'area'}
+
+    def __init__(self, image_size: int = None) -> None:
         """
-        Set expected mode.
+        Args:
+            image_size (int): size of height and width after resized
+        """
+        assert image_size > 0, f"image_size should be positive integer, but got {image_size}."
+        self.image_size = image_size
+
+    def __call__(self, img: Union[Image.Image, np.ndarray]) -> Union[Image.Image, np.ndarray]:
+        """
+        Resize image.
 
         Args:
-            bit_depth (int): bit depth
-            in_channel (int): number of channels
+            img (Union[Image.Image, np.ndarray]): image
 
         Returns:
-            str: expected mode
+            Union[Image.Image, np.ndarray]: resized image, which is the same type as img
         """
-        if bit_depth == 8:
-            if in_channel == 1:
-                expected_mode = 'L'
-            elif in_channel == 3:
-                expected_mode = 'RGB'
-            else:
-                raise ValueError(f"Not supported in_channel value: {in_channel}.")
+        size = (self.image_size, self.image_size)
 
-        elif bit_depth == 16:
-            if in_channel != 1:
-                raise ValueError(f"Not supported in_channel value: {in_channel}.")
-            expected_mode = 'I'
+        if isinstance(img, Image.Image):
+            if img.size == size:
+                return img
+            img.draft(img.mode, size)
+            return img.resize(size, resample=Image.BILINEAR, reducing_gap=self.reducing_gap)
 
-        else:
-            raise ValueError(f"Not supported bit_depth value: {bit_depth}.")
+        if img.shape[:2] == size:
+            return img
+        return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
 
-        return expected_mode
+    def __repr__(self) -> str:
+        return self.__class__.__name__ + f"(image_size={self.image_size})"
 
-    def _open_image(self, imgpath: str) -> Image:
-        """
-        Open image.
 
+class ArrayToTensorMultiBit:
+    """
+    Convert decoded array to float tensor with bit depth.
+    Unlike ToTensorMultiBit, pixels are converted to float only once,
+    and scaled in place without intermediate tensors.
+    """
+    def __init__(self, bit_depth: int = None) -> None:
+        """
         Args:
-            imgpath (str): path to image
-
-        Returns:
-            Image: PIL image
-
-        Note:
-            PIL doesn't support multi-channel 16-bit/channel images.
+            bit_depth (int): bit depth
         """
-        image = Image.open(imgpath)
-        if image.mode != self.expected_mode:
-            raise ValueError(f"image.mode should be {self.expected_mode} as specified with bit_depth and in_channel, but {image.mode}.")
-        return image
+        if bit_depth not in [8, 16]:
+            raise ValueError(f"bit_depth should be 8 or 16, but {bit_depth} is given.")
+        self.bit_depth = bit_depth
+        self.max_value = float(2 ** bit_depth - 1)
 
-    def _set_augmentations(self, bit_depth: int, in_channel: int, augmentation: str) -> List:
+    def __call__(self, img: np.ndarray) -> Tensor:
         """
-        Define which augmentation is applied.
+        Convert array to tensor of shape (C, H, W).
 
         Args:
-            bit_depth (int): bit depth
-            in_channel (int): number of channels
-            augmentation (str): augmentation method
+            img (np.ndarray): np.uint8 or np.uint16 array of shape (H, W) or (H, W, C)
 
-        When training, augmentation is needed for train data only.
-        When test, no need of augmentation.
+        Returns:
+            Tensor: torch.float32 tensor scaled to [0, 1]
         """
-        if (bit_depth == 16) and (in_channel != 1):
-            raise ValueError(f"Not supported bit_depth and in_channel: bit_depth={bit_depth}, in_channel={in_channel}.")
+        is_uint16 = (img.dtype == np.uint16)
+        # torch.uint16 is not available. 16bit array is reinterpreted as np.int16 without copying.
+        src = torch.from_numpy(img.view(np.int16) if is_uint16 else img)
+        src = src.unsqueeze(0) if (src.ndim == 2) else src.permute(2, 0, 1)
+
+        tensor_img = torch.empty(src.shape, dtype=torch.float32)
+        tensor_img.copy_(src)
+        if is_uint16:
+            # Restore pixels over 32767, which are negative as np.int16.
+            tensor_img.remainder_(65536)
+        return tensor_img.div_(self.max_value)
 
-        _augmentations = []
+    def __repr__(self) -> str:
+        return self.__class__.__name__ + f"(bit_depth={self.bit_depth})"
 
-        if augmentation == 'no':
-            return _augmentations
 
-        if self.isTrain and (self.split == 'train'):
-            if augmentation == 'xrayaug':
-                _augmentations.append(XrayAugmentMultiBit(bit_depth=bit_depth))
+class ToIntegerTensorMultiBit:
+    """
+    Convert PIL image or array to integer tensor without scaling,
+    which is used when augmentation is applied to a batch of images, or when images are transferred as integers.
+    """
+    def __init__(self, bit_depth: int = None, pack_16bit: bool = False) -> None:
+        """
+        Args:
+            bit_depth (int): bit depth
+            pack_16bit (bool): if True, 16bit image is packed into torch.int16 by pack()
+        """
+        if bit_depth not in [8, 16]:
+            raise ValueError(f"bit_depth should be 8 or 16, but {bit_depth} is given.")
+        self.bit_depth = bit_depth
+        self.pack_16bit = pack_16bit
+        self.pil_to_tensor = transforms.PILToTensor()
 
-            elif augmentation == 'trivialaugwide':
-                _augmentations.append(TrivialAugmentWideMultiBit(bit_depth=bit_depth))
+    @staticmethod
+    def pack(images: Tensor) -> Tensor:
+        """
+        Pack 16bit images held as torch.int32 into torch.int16 with the same bits.
+        8bit images are returned as they are.
 
-            elif augmentation == 'randaug':
-                _augmentations.append(RandAugmentMultiBit(bit_depth=bit_depth))
+        Args:
+            images (Tensor): integer images
 
-            else:
-                raise ValueError(f"Unknown augmentation method: {augmentation}")
+        Returns:
+            Tensor: torch.uint8, or torch.int16 whose negative values are pixels over 32767
 
-        return _augmentations
+        Note:
+            torch.uint16 is not available. Packed pixels are restored by ScaleNormalize.
+        """
+        if images.dtype == torch.int32:
+            return images.to(torch.int16)
+        return images
 
-    def _set_normalize(self, in_channel: int)-> List[transforms.Normalize]:
+    def __call__(self, img: Union[Image.Image, np.ndarray]) -> Tensor:
         """
-        Define which normalization is applied.
+        Convert image to tensor of shape (C, H, W).
 
         Args:
-            in_channel (int): in channel, or 1 or 3
+            img (Union[Image.Image, np.ndarray]): image
 
         Returns:
-            List[transforms.Normalize]: image normalization
+            Tensor: torch.uint8 if 8bit, torch.int32 if 16bit, or torch.int16 if 16bit and packed
         """
-        _transform = []
+        if isinstance(img, Image.Image):
+            tensor_img = self.pil_to_tensor(img)
+        elif img.dtype == np.uint16:
+            # torch.uint16 is not available. 16bit array is reinterpreted as np.int16 without copying.
+            tensor_img = torch.from_numpy(np.ascontiguousarray(img).view(np.int16))
+            if not self.pack_16bit:
+                tensor_img = tensor_img.to(torch.int32).bitwise_and_(0xFFFF)
+        else:
+            tensor_img = torch.from_numpy(np.ascontiguousarray(img))
 
-        if self.normalize_image == 'no':
-            return _transform
+        if tensor_img.ndim == 2:
+            tensor_img = tensor_img.unsqueeze(0)
+        elif not isinstance(img, Image.Image):
+            tensor_img = tensor_img.permute(2, 0, 1).contiguous()
 
-        if self.normalize_image == 'yes':
-            # transforms.Normalize accepts only Tensor.
-            if in_channel == 1:
-                _transform.append(transforms.Normalize(mean=(0.5, ), std=(0.5, )))
+        if self.bit_depth == 8:
+            return tensor_img.to(torch.uint8)
 
-            elif in_channel == 3:
-                _transform.append(transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]))
+        if self.pack_16bit:
+            return self.pack(tensor_img)
+        # 16bit image is held as torch.int32 as ToTensor() does.
+        return tensor_img.to(torch.int32)
 
-            else:
-                raise ValueError(f"Not supported in_channel value: {in_channel}.")
+    def __repr__(self) -> str:
+        return self.__class__.__name__ + f"(bit_depth={self.bit_depth}, pack_16bit={self.pack_16bit})"
 
-        return _transform
 
-    def _set_transforms(self, bit_depth: int, in_channel: int, augmentation: str) -> transforms.Compose:
-        """
-        Make list of transforms.
+class ScaleNormalize:
+    """
+    Scale integer images to [0, 1] and normalize them in place.
+    This accepts both an image of shape (C, H, W) and a batch of shape (B, C, H, W).
 
+    Note:
+        Images are converted to float only once, and the rest of operations are done in place
+        in the same order as ToTensorMultiBit and transforms.Normalize, so that the results are the same.
+    """
+    def __init__(self, bit_depth: int = None, in_channel: int = None, normalize_image: str = None) -> None:
+        """
         Args:
-            augmentation (str): augmentation method
-            bit_depth (int): bit depth, or 8 or 16
-            in_channel (int): channel, or 1 or 3
-
-        Returns:
-            list of transforms: image normalization
+            bit_depth (int): bit depth
+            in_channel (int): number of channels
+            normalize_image (str): 'yes' or 'no'
         """
-        augmentations = self._set_augmentations(bit_depth, in_channel, augmentation)
-        totensor = [ToTensorMultiBit(bit_depth=bit_depth)]
-        normalize = self._set_normalize(in_channel)
-        transforms_list = augmentations + totensor  + normalize
-        composed_transforms = transforms.Compose(transforms_list)
-        return composed_transforms
+        self.bit_depth = bit_depth
+        self.max_value = float(2 ** bit_depth - 1)
+        self.normalize_image = normalize_image
 
+        self.mean = None
+        self.std = None
+        if normalize_image == 'yes':
+            if in_channel not in NORMALIZE_MEAN_STD:
+                raise ValueError(f"Not supported in_channel value: {in_channel}.")
+            mean, std = NORMALIZE_MEAN_STD[in_channel]
+            self.mean = torch.tensor(mean).view(-1, 1, 1)
+            self.std = torch.tensor(std).view(-1, 1, 1)
 
-class DeepSurvMixin:
-    """
-    Class to handle required data for deepsurv.
-    """
-    def _load_periods_if_deepsurv(self, idx: int) -> Union[torch.FloatTensor, str]:
+    def __call__(self, images: Tensor) -> Tensor:
         """
-        Return period if deepsurv.
+        Scale and normalize images.
 
         Args:
-            idx (int): index
+            images (Tensor): integer images, or 16bit images packed into torch.int16
 
         Returns:
-            Union[torch.FloatTensor, str]: period, or empty string
+            Tensor: torch.float32 images
         """
-        periods = ''
-
-        if self.task != 'deepsurv':
-            return periods
+        is_packed = (images.dtype == torch.int16)
+        images = images.to(torch.float32)
+        if is_packed:
+            # Restore pixels over 32767, which are negative as torch.int16.
+            images = images.remainder_(65536)
+        images = images.div_(self.max_value)
+        if self.mean is not None:
+            images = images.sub_(self.mean.to(images.device)).div_(self.std.to(images.device))
+        return images
 
-        assert (self.task == 'deepsurv') and (len(self.label_list) == 1), 'Deepsurv cannot work in multi-label.'
-        periods = self.df_split.iat[idx, self.col_index_dict[self.period_name]]  #    int64
-        periods = np.array(periods, dtype=np.float32)                            # -> np.float32
-        periods = torch.from_numpy(periods).clone()                              # -> torch.float32
-        return periods
+    def __repr__(self) -> str:
+        return self.__class__.__name__ + f"(bit_depth={self.bit_depth}, normalize_image={self.normalize_image})"
 
 
-class DataSetWidget(InputDataMixin, ImageMixin, DeepSurvMixin):
-    """
-    Class for a widget to inherit multiple classes simultaneously.
+class Batch:
     """
-    pass
+    Class for a batch of data made by collate_batch.
 
-
-class LoadDataSet(Dataset, DataSetWidget):
-    """
-    Dataset for split.
+    Tensors not in use, eg. inputs when only CNN is used, are None, and metadata are NumPy arrays of strings.
+    Fields are accessed as attributes, or as keys in the same way as dictionary of data.
     """
+    fields = ['uniqID', 'group', 'imgpath', 'split', 'inputs', 'image', 'labels', 'periods']
+
     def __init__(
                 self,
-                params,
-                split: str
+                uniqID: np.ndarray,
+                group: np.ndarray,
+                imgpath: np.ndarray,
+                split: np.ndarray,
+                inputs: Optional[torch.FloatTensor] = None,
+                image: Optional[torch.Tensor] = None,
+                labels: Dict[str, torch.Tensor] = None,
+                periods: Optional[torch.FloatTensor] = None
                 ) -> None:
         """
         Args:
-            params (ParamSet): parameter for model
-            split (str): split
+            uniqID (np.ndarray): uniqIDs
+            group (np.ndarray): groups
+            imgpath (np.ndarray): paths to images
+            split (np.ndarray): splits
+            inputs (Optional[torch.FloatTensor]): input values of shape (B, N), or None if MLP is not used
+            image (Optional[torch.Tensor]): images of shape (B, C, H, W), or None if neither CNN nor ViT is used
+            labels (Dict[str, torch.Tensor]): label name and its values, or empty dictionary if no label
+            periods (Optional[torch.FloatTensor]): periods, or None unless deepsurv
         """
-        self.params = params
+        self.uniqID = uniqID
+        self.group = group
+        self.imgpath = imgpath
         self.split = split
+        self.inputs = inputs
+        self.image = image
+        self.labels = labels if labels is not None else {}
+        self.periods = periods
 
-        self.task = self.params.task
-        self.isTrain = self.params.isTrain
-        self.mlp = self.params.mlp
-        self.net = self.params.net
-        self.bit_depth = self.params.bit_depth
-        self.in_channel = self.params.in_channel
-        self.augmentation = self.params.augmentation
-        self.normalize_image = self.params.normalize_image
-        if self.task == 'deepsurv':
-            self.period_name = self.params.period_name
-
-        self.df_source = self.params.df_source
-        self.input_list = self.params.input_list
-        self.label_list = self.params.label_list
-        self.df_split = self.df_source[self.df_source['split'] == self.split]
-        self.col_index_dict = {col_name: self.df_split.columns.get_loc(col_name) for col_name in self.df_split.columns}
+    def __getitem__(self, key: str) -> Union[np.ndarray, torch.Tensor, Dict[str, torch.Tensor], None]:
+        if key not in self.fields:
+            raise KeyError(key)
+        return getattr(self, key)
 
-        # For input data
-        if self.mlp is not None:
-            assert (self.input_list != []), f"input list is empty."
-            if self.isTrain:
-                # Input data should be normalized with min and max of training data.
-                df_train = self.df_source[self.df_source['split'] == 'train']
-                self.scaler = self._make_scaler(df_train[self.input_list])
-            else:
-                # load scaler used at training.
-                assert hasattr(self.params, 'scaler_path'), f"scaler path is not defined."
-                self.scaler = self.load_scaler(self.params.scaler_path)
+    def __setitem__(self, key: str, value: Union[np.ndarray, torch.Tensor, Dict[str, torch.Tensor], None]) -> None:
+        if key not in self.fields:
+            raise KeyError(key)
+        setattr(self, key, value)
 
-        # For image
-        if self.net is not None:
-            self.expected_mode = self._set_expected_mode(self.bit_depth, self.in_channel)
-            self.transform = self._set_transforms(self.bit_depth, self.in_channel, self.augmentation)
+    def keys(self) -> List[str]:
+        return list(self.fields)
 
     def __len__(self) -> int:
         """
-        Return length of DataFrame.
+        Return batch size.
 
         Returns:
-            int: length of DataFrame
+            int: batch size
         """
-        return len(self.df_split)
+        return len(self.uniqID)
 
-    def _load_input_value_if_mlp(self, idx: int) -> Union[torch.FloatTensor, str]:
+    def pin_memory(self) -> 'Batch':
         """
-        Load input values after converting them into tensor if MLP is used.
-
-        Args:
-            idx (int): index
+        Pin tensors, which is called by DataLoader when pin_memory=True.
 
         Returns:
-            Union[torch.Tensor[float], str]: tensor of input values, or empty string
+            Batch: batch whose tensors are in page-locked memory
         """
-        inputs_value = ''
-
-        if self.mlp is None:
-            return inputs_value
+        if self.inputs is not None:
+            self.inputs = self.inputs.pin_memory()
+        if self.image is not None:
+            self.image = self.image.pin_memory()
+        self.labels = {label_name: label.pin_memory() for label_name, label in self.labels.items()}
+        if self.periods is not None:
+            self.periods = self.periods.pin_memory()
+        return self
 
-        index_input_list = [self.col_index_dict[input] for input in self.input_list]
-        df_inputs = self.df_split.iloc[[idx], index_input_list]
-        inputs_value = self._normalize_inputs(self.scaler, df_inputs)
-        return inputs_value
 
-    def _load_image_if_cnn(self, idx: int) -> Union[torch.Tensor, str]:
-        """
-        Load image and convert it to tensor if any of CNN or ViT is used.
+def _stack(tensors: List[torch.Tensor]) -> torch.Tensor:
+    """
+    Stack tensors of a batch.
 
-        Args:
-            idx (int): index
+    Args:
+        tensors (List[torch.Tensor]): tensors of the same shape
 
-        Returns:
-            Union[torch.Tensor[float], str]: tensor converted from image, or empty string
-        """
-        image = ''
+    Returns:
+        torch.Tensor: stacked tensor
 
-        if self.net is None:
-            return image
+    Note:
+        As with default_collate, the stacked tensor is allocated in shared memory in DataLoader workers,
+        so that it is passed to the main process without copying.
+    """
+    out = None
+    if get_worker_info() is not None:
+        elem = tensors[0]
+        storage = elem._typed_storage()._new_shared(len(tensors) * elem.numel(), device=elem.device)
+        out = elem.new(storage).resize_(len(tensors), *list(elem.size()))
+    return torch.stack(tensors, 0, out=out)
 
-        imgpath = self.df_split.iat[idx, self.col_index_dict['imgpath']]
-        image = self._open_image(imgpath)
-        image = self.transform(image)
-        return image
 
-    def _load_label(self, idx: int) -> Dict[str, Union[int, float]]:
-        """
-        Return labels.
-        If no column of label when csv of external dataset is used,
-        empty dictionary is returned.
+def _gather(values: torch.Tensor, indices: List[int]) -> torch.Tensor:
+    """
+    Gather rows of a batch.
 
-        Args:
-            idx (int): index
+    Args:
+        values (torch.Tensor): values of all rows
+        indices (List[int]): indices of rows
 
-        Returns:
-            Dict[str, Union[int, float]]: dictionary of label name and its value
-        """
-        # For checking if columns of labels exist when used csv for external dataset.
-        label_list_in_split = list(self.df_split.columns[self.df_split.columns.str.startswith('label')])
-        label_dict = {}
-        if label_list_in_split != []:
-            for label_name in self.label_list:
-                label_dict[label_name] = self.df_split.iat[idx, self.col_index_dict[label_name]]
-        return label_dict
+    Returns:
+        torch.Tensor: gathered tensor
 
-    def __getitem__(self, idx: int) -> Dict:
+    Note:
+        As with _stack, the gathered tensor is allocated in shared memory in DataLoader workers.
+    """
+    out = None
+    if get_worker_info() is not None:
+        storage = values._typed_storage()._new_shared(len(indices) * values[0].numel(), device=values.device)
+        out = values.new(storage).resize_(len(indices), *list(values.size()[1:]))
+    return torch.index_select(values, 0, torch.as_tensor(indices, dtype=torch.int64), out=out)
+
+
+def collate_batch(samples: Union[List[Dict], Batch]) -> Batch:
+    """
+    Collate data of rows into a batch.
+    Only tensors in use are stacked, and values of labels are gathered into a tensor for each label at once.
+
+    Args:
+        samples (Union[List[Dict], Batch]): list of dictionary of data, or batch already made by LoadDataSet.__getitems__
+
+    Returns:
+        Batch: batch of data
+    """
+    if isinstance(samples, Batch):
+        return samples
+
+    elem = samples[0]
+    inputs = _stack([sample['inputs'] for sample in samples]) if isinstance(elem['inputs'], torch.Tensor) else None
+    image = _stack([sample['image'] for sample in samples]) if isinstance(elem['image'], torch.Tensor) else None
+    periods = _stack([sample['periods'] for sample in samples]) if isinstance(elem['periods'], torch.Tensor) else None
+    labels = {
+            label_name: torch.as_tensor(np.asarray([sample['labels'][label_name] for sample in samples]))
+            for label_name in elem['labels']
+            }
+    return Batch(
+                uniqID=np.array([sample['uniqID'] for sample in samples], dtype=object),
+                group=np.array([sample['group'] for sample in samples], dtype=object),
+                imgpath=np.array([sample['imgpath'] for sample in samples], dtype=object),
+                split=np.array([sample['split'] for sample in samples], dtype=object),
+                inputs=inputs,
+                image=image,
+                labels=labels,
+                periods=periods
+                )
+
+
+class AugmentCollate:
+    """
+    Collate function which augments a batch of images after collation,
+    then scales and normalizes them.
+    """
+    def __init__(self, batch_augmentation: BatchAugmentBase, scale_normalize: Optional[ScaleNormalize] = None) -> None:
+        """
+        Args:
+            batch_augmentation (BatchAugmentBase): augmentation applied to a batch of images
+            scale_normalize (Optional[ScaleNormalize]): scaling and normalization.
+                If None, images are left as integers, which are scaled and normalized by model.
+        """
+        self.batch_augmentation = batch_augmentation
+        self.scale_normalize = scale_normalize
+
+    def __call__(self, batch: Union[List[Dict], Batch]) -> Batch:
+        """
+        Collate data, then augment images.
+
+        Args:
+            batch (Union[List[Dict], Batch]): list of data, or batch already made
+
+        Returns:
+            Batch: batch of data
+        """
+        data = collate_batch(batch)
+        images = self.batch_augmentation(data['image'])
+        if self.scale_normalize is None:
+            data['image'] = ToIntegerTensorMultiBit.pack(images)
+        else:
+            data['image'] = self.scale_normalize(images)
+        return data
+
+
+class ImageMixin:
+    """
+    Class to normalize and transform image.
+    """
+    def _set_expected_mode(
+                            self,
+                            bit_depth: int,
+                            in_channel: int
+                            ) -> str:
+        """
+        Set expected mode.
+
+        Args:
+            bit_depth (int): bit depth
+            in_channel (int): number of channels
+
+        Returns:
+            str: expected mode
+        """
+        if bit_depth == 8:
+            if in_channel == 1:
+                expected_mode = 'L'
+            elif in_channel == 3:
+                expected_mode = 'RGB'
+            else:
+                raise ValueError(f"Not supported in_channel value: {in_channel}.")
+
+        elif bit_depth == 16:
+            if in_channel != 1:
+                raise ValueError(f"Not supported in_channel value: {in_channel}.")
+            expected_mode = 'I'
+
+        else:
+            raise ValueError(f"Not supported bit_depth value: {bit_depth}.")
+
+        return expected_mode
+
+    def _accepted_modes(self) -> List[str]:
+        """
+        Return modes of image accepted by both decoders.
+
+        Returns:
+            List[str]: modes
+
+        Note:
+            16bit grayscale image is accepted whether PIL reports it as 'I' or as raw 16bit mode, ie. 'I;16'.
+            Pixels of image of 'I' are 32bit integers, which have to be within 16bit.
+        """
+        accepted_modes = [self.expected_mode]
+        if self.expected_mode == 'I':
+            accepted_modes = accepted_modes + ['I;16', 'I;16L', 'I;16B']
+        return accepted_modes
+
+    @staticmethod
+    def _check_16bit_range(min_value: int, max_value: int, source: str) -> None:
+        """
+        Check that pixels of image of 32bit integers are within 16bit.
+
+        Args:
+            min_value (int): minimum of pixels
+            max_value (int): maximum of pixels
+            source (str): path to image, or name of image for message
+        """
+        if (min_value < 0) or (max_value > 65535):
+            raise ValueError(f"Pixels of image should be within 16bit as specified with bit_depth, but [{min_value}, {max_value}]: {source}.")
+
+    def _open_image(self, imgpath: Union[str, io.BytesIO], check_mode: bool = True) -> Image:
+        """
+        Open image.
+
+        Args:
+            imgpath (Union[str, io.BytesIO]): path to image, or image file in memory
+            check_mode (bool): if False, mode is not checked, eg. it has been checked by prescan
+
+        Returns:
+            Image: PIL image, whose mode is 'I' if 16bit
+
+        Note:
+            PIL doesn't support multi-channel 16-bit/channel images.
+        """
+        image = Image.open(imgpath)
+        if check_mode and (image.mode not in self._accepted_modes()):
+            raise ValueError(f"image.mode should be {self.expected_mode} as specified with bit_depth and in_channel, but {image.mode}.")
+
+        if image.mode in ['I;16', 'I;16L', 'I;16B']:
+            # Transforms expect 16bit image as mode 'I'.
+            image = image.convert('I')
+        elif check_mode and (image.mode == 'I'):
+            self._check_16bit_range(*image.getextrema(), imgpath)
+        return image
+
+    def _check_image_header(self, imgpath: Union[str, io.BytesIO]) -> Tuple[int, ...]:
+        """
+        Check mode of image from its header without decoding pixels.
+
+        Args:
+            imgpath (Union[str, io.BytesIO]): path to image, or image file in memory
+
+        Returns:
+            Tuple[int, ...]: (H, W) if 1 channel, otherwise (H, W, C)
+
+        Note:
+            PIL reads only the header when opening image, and decodes pixels when they are accessed.
+            Pixels of image of 'I' are checked when decoded.
+        """
+        with Image.open(imgpath) as image:
+            mode = image.mode
+            width, height = image.size
+
+        if mode not in self._accepted_modes():
+            raise ValueError(f"image.mode should be {self.expected_mode} as specified with bit_depth and in_channel, but {mode}.")
+
+        if self.in_channel == 1:
+            return (height, width)
+        return (height, width, self.in_channel)
+
+    def _read_image_shape(self, imgpath: str) -> Tuple[int, ...]:
+        """
+        Read shape of image from its header without decoding pixels.
+        If image is resized, the shape after resized is returned.
+
+        Args:
+            imgpath (str): path to image
+
+        Returns:
+            Tuple[int, ...]: (H, W) if 1 channel, otherwise (H, W, C)
+        """
+        height, width = self._check_image_header(imgpath)[:2]
+
+        if self.image_size > 0:
+            height, width = self.image_size, self.image_size
+
+        if self.in_channel == 1:
+            return (height, width)
+        return (height, width, self.in_channel)
+
+    def _decode_image_native(self, imgpath: str, check_header: bool = True) -> np.ndarray:
+        """
+        Decode image straight into array with OpenCV after checking its header.
+
+        Args:
+            imgpath (str): path to image
+            check_header (bool): if False, header is not checked, eg. it has been checked by prescan
+
+        Returns:
+            np.ndarray: np.uint8 if 8bit, np.uint16 if 16bit, whose shape is (H, W) or (H, W, C) in RGB order
+        """
+        if check_header:
+            self._check_image_header(imgpath)
+
+        # IMREAD_UNCHANGED keeps bit depth and channels as stored in file.
+        image = cv2.imread(imgpath, cv2.IMREAD_UNCHANGED)
+        return self._align_decoded_array(image, imgpath)
+
+    def _align_decoded_array(self, image: Optional[np.ndarray], source: str) -> np.ndarray:
+        """
+        Check array decoded by OpenCV and align its channels in RGB order.
+
+        Args:
+            image (Optional[np.ndarray]): decoded array, or None if failed to decode
+            source (str): path to image, or name of image for message
+
+        Returns:
+            np.ndarray: np.uint8 if 8bit, np.uint16 if 16bit, whose shape is (H, W) or (H, W, C) in RGB order
+        """
+        if image is None:
+            raise ValueError(f"Failed to decode image: {source}.")
+
+        pixel_dtype = np.uint8 if self.bit_depth == 8 else np.uint16
+        if (pixel_dtype == np.uint16) and (image.dtype == np.int32) and (image.ndim == 2):
+            # Image of 'I' is decoded as 32bit integers as with PIL.
+            self._check_16bit_range(int(image.min()), int(image.max()), source)
+            image = image.astype(np.uint16)
+        if image.dtype != pixel_dtype:
+            raise ValueError(f"Decoded image should be {np.dtype(pixel_dtype)} as specified with bit_depth, but {image.dtype}: {source}.")
+
+        if image.ndim == 3:
+            # OpenCV decodes color image in BGR order.
+            cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+        return image
+
+    def _decode_encoded_image(self, encoded: bytes, source: str) -> Union[Image.Image, np.ndarray]:
+        """
+        Decode image file held in memory, eg. read from shard.
+
+        Args:
+            encoded (bytes): contents of image file
+            source (str): name of image for message
+
+        Returns:
+            Union[Image.Image, np.ndarray]: array if native decoder is used, otherwise PIL image
+        """
+        if self.image_decoder == 'native':
+            self._check_image_header(io.BytesIO(encoded))
+            image = cv2.imdecode(np.frombuffer(encoded, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+            return self._align_decoded_array(image, source)
+
+        return self._open_image(io.BytesIO(encoded))
+
+    def _decode_image(self, imgpath: str) -> np.ndarray:
+        """
+        Decode image into array, which is resized if image_size is specified.
+
+        Args:
+            imgpath (str): path to image
+
+        Returns:
+            np.ndarray: np.uint8 if 8bit, np.uint16 if 16bit
+        """
+        resize = self._set_resize(self.image_size)
+
+        if self.image_decoder == 'native':
+            image = self._decode_image_native(imgpath)
+            return transforms.Compose(resize)(image)
+
+        image = transforms.Compose(resize)(self._open_image(imgpath))
+        pixel_dtype = np.uint8 if self.bit_depth == 8 else np.uint16
+        # PIL returns np.int32 for 16bit image.
+        image = np.asarray(image).astype(pixel_dtype, copy=False)
+        return image
+
+    def _set_image_cache(self) -> ImageCache:
+        """
+        Set cache of decoded images.
+        If not built yet, decode all images in csv into the cache.
+        Only one process builds it, while the others wait for the lock.
+
+        Returns:
+            ImageCache: cache of decoded images
+        """
+        # Images resized to each image_size are cached separately, as well as those resized by each decoder.
+        key = make_cache_key(hash_file(self.params.csvpath), self.bit_depth, self.in_channel, self.image_size, self.image_decoder, ResizeMultiBit.interpolations[self.image_decoder])
+        pixel_dtype = np.uint8 if self.bit_depth == 8 else np.uint16
+        image_cache = ImageCache(self.params.cache_dir, key, pixel_dtype)
+
+        with image_cache.lock():
+            if not image_cache.exists():
+                if isinstance(self.df_source, SharedManifest):
+                    imgpaths = pd.unique(np.array(self.df_source.column('imgpath').tolist(), dtype=object)).tolist()
+                else:
+                    imgpaths = self.df_source['imgpath'].unique().tolist()
+                image_cache.build(imgpaths, self._read_image_shape, self._decode_image)
+
+        image_cache.open()
+        return image_cache
+
+    def _prescan_images(self) -> None:
+        """
+        Check headers of all images of split before loading them, so that invalid images are found at once.
+        Headers are read in parallel and saved in the index, and only images modified since then are read again.
+        Only one process updates the index, while the others wait for the lock.
+        """
+        # Modes accepted depend on bit_depth and in_channel, but headers do not.
+        # Bits of image of mode I are those which its pixels need since v2 of index.
+        key = make_cache_key(Path(self.params.csvpath).resolve(), 'v2')
+        prescan_index = PrescanIndex(self.params.cache_dir, key)
+
+        with prescan_index.lock():
+            prescan_index.load()
+            entries = prescan_index.update(self.row_store.column('imgpath'))
+
+        invalid_images = find_invalid_images(entries, self._accepted_modes(), self.bit_depth)
+        if invalid_images != []:
+            raise ValueError(
+                            f"{len(invalid_images)} images of {self.split} are invalid as specified with bit_depth={self.bit_depth} and in_channel={self.in_channel}:\n"
+                            + '\n'.join(invalid_images[:20])
+                            + ('\n...' if len(invalid_images) > 20 else '')
+                            )
+
+    def _array_to_pil(self, image: np.ndarray) -> Image.Image:
+        """
+        Convert decoded array to PIL image, to which augmentations are applied.
+
+        Args:
+            image (np.ndarray): np.uint8 or np.uint16 array
+
+        Returns:
+            Image.Image: PIL image
+        """
+        if self.bit_depth == 16:
+            # As with PIL, ToTensorMultiBit expects 16bit image as mode 'I', ie. np.int32.
+            image = image.astype(np.int32)
+        return Image.fromarray(image)
+
+    def _set_augmentations(self, bit_depth: int, in_channel: int, augmentation: str) -> List:
+        """
+        Define which augmentation is applied.
+
+        Args:
+            bit_depth (int): bit depth
+            in_channel (int): number of channels
+            augmentation (str): augmentation method
+
+        When training, augmentation is needed for train data only.
+        When test, no need of augmentation.
+        """
+        if (bit_depth == 16) and (in_channel != 1):
+            raise ValueError(f"Not supported bit_depth and in_channel: bit_depth={bit_depth}, in_channel={in_channel}.")
+
+        _augmentations = []
+
+        if augmentation == 'no':
+            return _augmentations
+
+        if self.augmentation_stage == 'batch':
+            # Augmentation is applied to a batch of images after collation.
+            return _augmentations
+
+        if self.isTrain and (self.split == 'train'):
+            if augmentation == 'xrayaug':
+                _augmentations.append(XrayAugmentMultiBit(bit_depth=bit_depth))
+
+            elif augmentation == 'trivialaugwide':
+                _augmentations.append(TrivialAugmentWideMultiBit(bit_depth=bit_depth))
+
+            elif augmentation == 'randaug':
+                _augmentations.append(RandAugmentMultiBit(bit_depth=bit_depth))
+
+            else:
+                raise ValueError(f"Unknown augmentation method: {augmentation}")
+
+        return _augmentations
+
+    def _set_batch_augmentation(self, bit_depth: int, augmentation: str) -> Optional[BatchAugmentBase]:
+        """
+        Define augmentation applied to a batch of images after collation.
+
+        Args:
+            bit_depth (int): bit depth
+            augmentation (str): augmentation method
+
+        Returns:
+            Optional[BatchAugmentBase]: augmentation, or None if not applied
+
+        Note:
+            Operations and their parameters for bit depth are taken from the augmentation applied to each image.
+        """
+        if (augmentation == 'no') or (self.augmentation_stage != 'batch'):
+            return None
+
+        if not (self.isTrain and (self.split == 'train')):
+            return None
+
+        if augmentation == 'xrayaug':
+            return BatchXrayAugment(XrayAugmentMultiBit(bit_depth=bit_depth))
+
+        elif augmentation == 'trivialaugwide':
+            return BatchTrivialAugmentWide(TrivialAugmentWideMultiBit(bit_depth=bit_depth))
+
+        elif augmentation == 'randaug':
+            return BatchRandAugment(RandAugmentMultiBit(bit_depth=bit_depth))
+
+        else:
+            raise ValueError(f"Unknown augmentation method: {augmentation}")
+
+    def _set_resize(self, image_size: int) -> List[ResizeMultiBit]:
+        """
+        Define resize of image.
+
+        Args:
+            image_size (int): size of image after resized, or 0 if not resized
+
+        Returns:
+            List[ResizeMultiBit]: resize
+        """
+        if image_size == 0:
+            return []
+        return [ResizeMultiBit(image_size=image_size)]
+
+    def _set_normalize(self, in_channel: int, inplace: bool = False)-> List[transforms.Normalize]:
+        """
+        Define which normalization is applied.
+
+        Args:
+            in_channel (int): in channel, or 1 or 3
+            inplace (bool): if True, tensor is normalized in place
+
+        Returns:
+            List[transforms.Normalize]: image normalization
+        """
+        _transform = []
+
+        if self.normalize_image == 'no':
+            return _transform
+
+        if self.normalize_image == 'yes':
+            # transforms.Normalize accepts only Tensor.
+            if in_channel not in NORMALIZE_MEAN_STD:
+                raise ValueError(f"Not supported in_channel value: {in_channel}.")
+            mean, std = NORMALIZE_MEAN_STD[in_channel]
+            _transform.append(transforms.Normalize(mean=mean, std=std, inplace=inplace))
+
+        return _transform
+
+    def _set_transforms(self, bit_depth: int, in_channel: int, augmentations: List) -> transforms.Compose:
+        """
+        Make list of transforms.
+
+        Args:
+            bit_depth (int): bit depth, or 8 or 16
+            in_channel (int): channel, or 1 or 3
+            augmentations (List): augmentations made by _set_augmentations
+
+        Returns:
+            list of transforms: image normalization
+
+        Note:
+            Images are resized first if image_size is specified, so that augmentations are applied at that size.
+            When augmentation is applied to a batch, images are only converted to integer tensors here,
+            and scaled and normalized after the batch is augmented.
+            When images are transferred as integers, they are scaled and normalized in set_data() of model.
+            When images are decoded into arrays, ie. with cache or native decoder, and no augmentation is applied to them,
+            ArrayToTensorMultiBit is used instead of ToTensorMultiBit.
+        """
+        resize = self._set_resize(self.image_size)
+
+        if self.batch_augmentation is not None:
+            return transforms.Compose(resize + [ToIntegerTensorMultiBit(bit_depth=bit_depth)])
+
+        if self.image_transfer == 'uint':
+            # Images are scaled and normalized by model after transferred to device.
+            return transforms.Compose(resize + augmentations + [ToIntegerTensorMultiBit(bit_depth=bit_depth, pack_16bit=True)])
+
+        if self.image_as_array and (augmentations == []):
+            # Decoded array is converted to float once, then normalized in place.
+            return transforms.Compose(resize + [ArrayToTensorMultiBit(bit_depth=bit_depth)] + self._set_normalize(in_channel, inplace=True))
+
+        totensor = [ToTensorMultiBit(bit_depth=bit_depth)]
+        normalize = self._set_normalize(in_channel)
+        transforms_list = resize + augmentations + totensor  + normalize
+        composed_transforms = transforms.Compose(transforms_list)
+        return composed_transforms
+
+
+class DeepSurvMixin:
+    """
+    Class to handle required data for deepsurv.
+    """
+    def _load_periods_if_deepsurv(self, idx: int) -> Union[torch.FloatTensor, str]:
+        """
+        Return period if deepsurv.
+
+        Args:
+            idx (int): index
+
+        Returns:
+            Union[torch.FloatTensor, str]: period, or empty string
+        """
+        periods = ''
+
+        if self.task != 'deepsurv':
+            return periods
+
+        assert (self.task == 'deepsurv') and (len(self.label_list) == 1), 'Deepsurv cannot work in multi-label.'
+        periods = self.row_store.get(self.period_name, idx)  #    np.float32, cast when the row store is made
+        periods = torch.tensor(periods)                       # -> torch.float32
+        return periods
+
+
+class RowStore:
+    """
+    Class to hold columns of split as typed NumPy arrays.
+
+    Note:
+        Columns of strings are held as a fixed-width table of UTF-8 bytes, not as Python objects,
+        or as StringColumn when made from SharedManifest.
+        Looking up a row never touches reference counts of Python objects,
+        therefore memory pages shared with DataLoader workers after fork are not copied.
+    """
+    def __init__(self, columns: Dict[str, Union[np.ndarray, StringColumn]]) -> None:
+        """
+        Args:
+            columns (Dict[str, Union[np.ndarray, StringColumn]]): column name and its values, all of which have the same length
+        """
+        self.columns = columns
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, column_names: List[str]) -> 'RowStore':
+        """
+        Make row store from DataFrame.
+
+        Args:
+            df (pd.DataFrame): DataFrame
+            column_names (List[str]): columns to be held
+
+        Returns:
+            RowStore: row store
+        """
+        columns = {column_name: cls._to_array(df[column_name]) for column_name in column_names}
+        return cls(columns)
+
+    @classmethod
+    def from_manifest(cls, manifest: SharedManifest, split: str, column_names: List[str]) -> 'RowStore':
+        """
+        Make row store of split from views of shared manifest, without copying columns.
+
+        Args:
+            manifest (SharedManifest): shared manifest
+            split (str): split
+            column_names (List[str]): columns to be held
+
+        Returns:
+            RowStore: row store
+        """
+        columns = {column_name: manifest.column(column_name, split) for column_name in column_names}
+        return cls(columns)
+
+    @staticmethod
+    def _to_array(column: pd.Series) -> np.ndarray:
+        """
+        Convert column into typed array.
+
+        Args:
+            column (pd.Series): column
+
+        Returns:
+            np.ndarray: array of numbers, or fixed-width array of UTF-8 bytes if column consists of strings
+        """
+        if (column.dtype.kind not in 'biufcmM') and column.map(lambda value: isinstance(value, str)).all():
+            return np.array(column.str.encode('utf-8').tolist(), dtype=np.bytes_)
+        return column.to_numpy(copy=True)
+
+    def __len__(self) -> int:
+        """
+        Return the number of rows.
+
+        Returns:
+            int: the number of rows
+        """
+        return len(next(iter(self.columns.values())))
+
+    def column(self, column_name: str) -> np.ndarray:
+        """
+        Return all values of column.
+
+        Args:
+            column_name (str): column name
+
+        Returns:
+            np.ndarray: values of column, where strings are fixed-width UTF-8 bytes
+        """
+        values = self.columns[column_name]
+        if isinstance(values, StringColumn):
+            return values.to_numpy()
+        return values
+
+    def get(self, column_name: str, idx: int) -> Union[str, np.generic]:
+        """
+        Return value of column at row specified by index.
+
+        Args:
+            column_name (str): column name
+            idx (int): index
+
+        Returns:
+            Union[str, np.generic]: value
+        """
+        value = self.columns[column_name][idx]
+        if isinstance(value, bytes):
+            return value.decode('utf-8')
+        return value
+
+
+class DataSetWidget(InputDataMixin, ImageMixin, DeepSurvMixin):
+    """
+    Class for a widget to inherit multiple classes simultaneously.
+    """
+    pass
+
+
+class LoadDataSet(Dataset, DataSetWidget):
+    """
+    Dataset for split.
+    """
+    def __init__(
+                self,
+                params,
+                split: str
+                ) -> None:
+        """
+        Args:
+            params (ParamSet): parameter for model
+            split (str): split
+        """
+        self.params = params
+        self.split = split
+
+        self.task = self.params.task
+        self.isTrain = self.params.isTrain
+        self.mlp = self.params.mlp
+        self.net = self.params.net
+        self.bit_depth = self.params.bit_depth
+        self.in_channel = self.params.in_channel
+        self.image_size = self.params.image_size
+        self.augmentation = self.params.augmentation
+        self.augmentation_stage = self.params.augmentation_stage
+        self.normalize_image = self.params.normalize_image
+        self.image_decoder = self.params.image_decoder
+        self.image_transfer = self.params.image_transfer
+        if self.task == 'deepsurv':
+            self.period_name = self.params.period_name
+
+        self.df_source = self.params.df_source
+        self.input_list = self.params.input_list
+        self.label_list = self.params.label_list
+
+        # For checking if columns of labels exist when used csv for external dataset.
+        self.has_label = any(column_name.startswith('label') for column_name in self.df_source.columns)
+        self.row_store = self._make_row_store()
+
+        # For input data
+        if self.mlp is not None:
+            assert (self.input_list != []), f"input list is empty."
+            if self.isTrain:
+                # Input data should be normalized with min and max of training data.
+                if hasattr(self.params, 'scaler'):
+                    # Fitted once in the parent process.
+                    self.scaler = self.params.scaler
+                else:
+                    self.scaler = fit_scaler(self.df_source, self.input_list)
+            else:
+                # load scaler used at training.
+                assert hasattr(self.params, 'scaler_path'), f"scaler path is not defined."
+                self.scaler = self.load_scaler(self.params.scaler_path)
+
+            # Normalize input data of split all at once.
+            self.inputs_value = self._normalize_inputs(self.scaler, self._split_frame(self.split, self.input_list))
+
+        # For image
+        if self.net is not None:
+            self.expected_mode = self._set_expected_mode(self.bit_depth, self.in_channel)
+            self.augmentations = self._set_augmentations(self.bit_depth, self.in_channel, self.augmentation)
+            self.batch_augmentation = self._set_batch_augmentation(self.bit_depth, self.augmentation)
+            # Whether images are decoded into arrays instead of PIL images.
+            self.image_as_array = (self.params.image_cache == 'yes') or (self.image_decoder == 'native')
+            self.transform = self._set_transforms(self.bit_depth, self.in_channel, self.augmentations)
+
+            # Whether images have been checked in advance, and are not checked each time they are loaded.
+            self.prescanned = False
+            if self.params.prescan == 'yes':
+                self._prescan_images()
+                self.prescanned = True
+
+            self.image_cache = None
+            if self.params.image_cache == 'yes':
+                self.image_cache = self._set_image_cache()
+                self.cache_positions = self.image_cache.positions(self.row_store.column('imgpath'))
+
+            # Files are read by threads ahead of decoding, unless read from cache or shards.
+            self.prefetcher = None
+            if (self.params.io_prefetch > 0) and (self.image_cache is None) and (self.params.shard_dir is None):
+                self.prefetcher = FilePrefetcher(self.params.io_prefetch)
+
+            # Images of split without augmentation are the same every epoch.
+            self.tensor_cache = None
+            if (self.augmentations == []) and (self.batch_augmentation is None):
+                self.tensor_cache = getattr(self.params, 'tensor_caches', {}).get(self.split)
+
+        self.profiler = None
+        if self.params.profile_loading == 'yes':
+            self.profiler = LoadingProfiler()
+            self._set_profiler()
+
+    def _set_profiler(self) -> None:
         """
-        Return data row specified by index.
+        Wrap methods and transform of this dataset to measure time of each phase of loading.
+
+        Note:
+            Only wrapped methods of this instance are measured, therefore nothing is measured when not profiled.
+        """
+        if self.net is not None:
+            for method_name in ['_open_image', '_decode_image_native', '_decode_encoded_image']:
+                setattr(self, method_name, self.profiler.timed('read', getattr(self, method_name)))
+            self.transform = self.profiler.timed('transform', self.transform)
+
+        for method_name in ['_load_label', '_load_periods_if_deepsurv']:
+            setattr(self, method_name, self.profiler.timed('tabular', getattr(self, method_name)))
+        self._make_data = self.profiler.timed_sample(self._make_data)
+
+    def collate_fn(self) -> Callable[[Union[List[Dict], Batch]], Batch]:
+        """
+        Return collate function of DataLoader.
+
+        Returns:
+            Callable[[Union[List[Dict], Batch]], Batch]: collate_batch, or AugmentCollate which also augments a batch of images
+        """
+        if (self.net is None) or (self.batch_augmentation is None):
+            return collate_batch
+
+        if self.image_transfer == 'uint':
+            return AugmentCollate(self.batch_augmentation)
+
+        scale_normalize = ScaleNormalize(bit_depth=self.bit_depth, in_channel=self.in_channel, normalize_image=self.normalize_image)
+        return AugmentCollate(self.batch_augmentation, scale_normalize)
+
+    def _split_frame(self, split: str, column_names: List[str]) -> pd.DataFrame:
+        """
+        Return DataFrame of columns of split.
+
+        Args:
+            split (str): split
+            column_names (List[str]): column names
+
+        Returns:
+            pd.DataFrame: DataFrame of split
+        """
+        if isinstance(self.df_source, SharedManifest):
+            return self.df_source.frame(split, column_names)
+        return self.df_source.loc[self.df_source['split'] == split, column_names]
+
+    def _make_row_store(self) -> RowStore:
+        """
+        Make row store of columns looked up for each row.
+
+        Returns:
+            RowStore: row store
+
+        Note:
+            With SharedManifest, columns are views of shared memory, which all ranks and workers read.
+        """
+        column_names = ['uniqID', 'group', 'imgpath']
+        if self.has_label:
+            column_names = column_names + self.label_list
+
+        if isinstance(self.df_source, SharedManifest):
+            row_store = RowStore.from_manifest(self.df_source, self.split, column_names)
+        else:
+            row_store = RowStore.from_frame(self.df_source[self.df_source['split'] == self.split], column_names)
+
+        if self.task == 'deepsurv':
+            row_store.columns[self.period_name] = self._split_frame(self.split, [self.period_name])[self.period_name].to_numpy(dtype=np.float32)
+        return row_store
+
+    def __len__(self) -> int:
+        """
+        Return the number of rows in split.
+
+        Returns:
+            int: the number of rows in split
+        """
+        return len(self.row_store)
+
+    def _load_input_value_if_mlp(self, idx: int) -> Union[torch.FloatTensor, str]:
+        """
+        Load input values normalized in advance if MLP is used.
+
+        Args:
+            idx (int): index
+
+        Returns:
+            Union[torch.Tensor[float], str]: tensor of input values, or empty string
+        """
+        inputs_value = ''
+
+        if self.mlp is None:
+            return inputs_value
+
+        inputs_value = self.inputs_value[idx]
+        return inputs_value
+
+    def _load_image_if_cnn(self, idx: int, encoded: bytes = None) -> Union[torch.Tensor, str]:
+        """
+        Load image and convert it to tensor if any of CNN or ViT is used.
+
+        Args:
+            idx (int): index
+            encoded (bytes, optional): image file already read, eg. from shard. If None, image is read from imgpath or cache.
+
+        Returns:
+            Union[torch.Tensor[float], str]: tensor converted from image, or empty string
+        """
+        image = ''
+
+        if self.net is None:
+            return image
+
+        if self.tensor_cache is not None:
+            image = self.tensor_cache.get(idx)
+            if image is not None:
+                return image
+
+        if encoded is not None:
+            image = self._decode_encoded_image(encoded, self.row_store.get('imgpath', idx))
+        elif self.image_cache is not None:
+            image = self.image_cache.get(self.cache_positions[idx])
+        elif self.image_decoder == 'native':
+            image = self._decode_image_native(self.row_store.get('imgpath', idx), check_header=(not self.prescanned))
+        else:
+            image = self._open_image(self.row_store.get('imgpath', idx), check_mode=(not self.prescanned))
+
+        if isinstance(image, np.ndarray) and (self.augmentations != []):
+            # Augmentations are applied to PIL image.
+            image = self._array_to_pil(image)
+
+        image = self.transform(image)
+        if self.tensor_cache is not None:
+            self.tensor_cache.put(idx, image)
+        return image
+
+    def _load_label(self, idx: int) -> Dict[str, Union[int, float]]:
+        """
+        Return labels.
+        If no column of label when csv of external dataset is used,
+        empty dictionary is returned.
+
+        Args:
+            idx (int): index
+
+        Returns:
+            Dict[str, Union[int, float]]: dictionary of label name and its value
+        """
+        label_dict = {}
+        if self.has_label:
+            for label_name in self.label_list:
+                label_dict[label_name] = self.row_store.get(label_name, idx)
+        return label_dict
+
+    def _make_data(self, idx: int, inputs_value: Union[torch.FloatTensor, str], encoded: bytes = None) -> Dict:
+        """
+        Make dictionary of data for row specified by index.
 
         Args:
             idx (int): index
+            inputs_value (Union[torch.FloatTensor, str]): tensor of input values, or empty string
+            encoded (bytes, optional): image file already read, eg. from shard
 
         Returns:
             Dict: dictionary of data to be passed model
         """
-        uniqID = self.df_split.iat[idx, self.col_index_dict['uniqID']]
-        group = self.df_split.iat[idx, self.col_index_dict['group']]
-        imgpath = self.df_split.iat[idx, self.col_index_dict['imgpath']]
-        split = self.df_split.iat[idx, self.col_index_dict['split']]
+        uniqID = self.row_store.get('uniqID', idx)
+        group = self.row_store.get('group', idx)
+        imgpath = self.row_store.get('imgpath', idx)
+        split = self.split
 
-        inputs_value = self._load_input_value_if_mlp(idx)
-        image = self._load_image_if_cnn(idx)
+        image = self._load_image_if_cnn(idx, encoded=encoded)
         label_dict = self._load_label(idx)
         periods = self._load_periods_if_deepsurv(idx)
         _data = {
@@ -582,207 +1572,392 @@ class LoadDataSet(Dataset, DataSetWidget):
                 }
         return _data
 
+    def __getitem__(self, idx: int) -> Dict:
+        """
+        Return data row specified by index.
+
+        Args:
+            idx (int): index
+
+        Returns:
+            Dict: dictionary of data to be passed model
+        """
+        inputs_value = self._load_input_value_if_mlp(idx)
+        _data = self._make_data(idx, inputs_value)
+        return _data
+
+    def __getitems__(self, indices: Union[List[int], PrefetchBatch]) -> Batch:
+        """
+        Return batch of data rows specified by indices of a batch.
+        DataLoader calls this instead of __getitem__ for each index when batching, and collate_fn passes the batch through.
+
+        Args:
+            indices (Union[List[int], PrefetchBatch]): indices of a batch, or with indices of the next batch if files are read ahead
+
+        Returns:
+            Batch: batch of data to be passed model
+
+        Note:
+            Input values of the whole batch are gathered with a single indexing of inputs_value,
+            and put into the batch as they are instead of being split into rows and stacked again.
+        """
+        upcoming = []
+        if isinstance(indices, PrefetchBatch):
+            indices, upcoming = indices
+
+        if (self.net is None) or (self.prefetcher is None):
+            batch_encoded = [None] * len(indices)
+        else:
+            # Files of the next batch are read while the current batch is decoded.
+            batch_encoded = self.prefetcher.fetch(indices, [self.row_store.get('imgpath', idx) for idx in indices])
+            self.prefetcher.read_ahead(upcoming, [self.row_store.get('imgpath', idx) for idx in upcoming])
+
+        batch_data = []
+        for idx, encoded in zip(indices, batch_encoded):
+            if encoded is not None:
+                encoded = encoded.result()
+            batch_data.append(self._make_data(idx, '', encoded=encoded))
+
+        batch = collate_batch(batch_data)
+        if self.mlp is not None:
+            batch.inputs = _gather(self.inputs_value, indices)
+
+        if self.profiler is not None:
+            self.profiler.flush()
+        return batch
 
-class DistributedWeightedSampler:
+
+class ShardDataSet(LoadDataSet, IterableDataset):
+    """
+    Dataset streaming samples from shards made by make_shards.py.
+
+    Shards are read sequentially, and samples are shuffled through a buffer at training.
+    Shards are split across DDP ranks, and then across DataLoader workers of each rank.
+    At training, every rank yields the same number of samples so that all ranks run the same number of iterations.
+    If shards are uneven among ranks, some samples are dropped or repeated in the epoch, which varies with the order of shards.
+    Otherwise, each sample is yielded by exactly one rank, as with DistributedEvalSampler.
+    Data of each sample are the same as those of LoadDataSet, where values other than image are looked up by uniqID.
+    """
     def __init__(
                 self,
-                weights: torch.tensor,
-                split_data: LoadDataSet,
-                num_replicas:Optional[int] = None,
-                rank: Optional[int] = None,
-                replacement: bool = True,
-                shuffle: bool = True,
-                drop_last: bool = False
+                params,
+                split: str
                 ) -> None:
         """
-        Distributed Weighted Sampler.
-        This is used when distributed training is performed with imbalanced dataset.
-
-        Args:
-            weights (torch.tensor): weights for each label in split_data
-            split_data (LoadDataSet): dataset
-            num_replicas (Optional[int]): number of replicas
-            rank (Optional[int]): rank of the current process within num_replicas.
-                                By default, rank is retrieved from the current distributed group.
-            replacement (bool): if True, samples are drawn with replacement.
-                                If not, they are drawn without replacement,
-                                which means that when a sample index is drawn for a row,
-                                it cannot be drawn again for that row.
-            shuffle (bool): if True, sampler will shuffle the indices.
-            drop_last (bool): if True, the sampler will drop the last batch
-        """
-        if num_replicas is None:
-            if not dist.is_available():
-                raise RuntimeError("Requires distributed package to be available")
-            num_replicas = dist.get_world_size()
-
-        if rank is None:
-            if not dist.is_available():
-                raise RuntimeError("Requires distributed package to be available")
-            rank = dist.get_rank()
-
-        self.weights = weights
-        self.split_data = split_data
-        self.num_replicas = num_replicas
-        self.rank = rank
-        self.epoch = 0
-        self.replacement = replacement
-        self.drop_last = drop_last
-        # If the dataset length is evenly divisible by the number of replicas, then
-        # there is no need to drop any data, since the dataset will be split equally.
-        if self.drop_last and len(self.split_data) % self.num_replicas != 0:
-            # Split to nearest available length that is evenly divisible.
-            # This is to ensure each rank receives the same amount of data when
-            # using this Sampler.
-            self.num_samples = math.ceil(
-                                    (len(self.split_data) - self.num_replicas) / self.num_replicas
-                                )
+        Args:
+            params (ParamSet): parameter for model
+            split (str): split
+        """
+        assert (params.image_cache == 'no'), 'image_cache is not available with shards.'
+        super().__init__(params, split)
+
+        index = load_shard_index(self.params.shard_dir, self.params.csvpath)
+        _shards = index['splits'].get(self.split, [])
+        self.shard_paths = [str(Path(self.params.shard_dir, shard['path'])) for shard in _shards]
+        self.shard_sizes = [shard['num_samples'] for shard in _shards]
+        assert (sum(self.shard_sizes) == len(self.row_store)), f"Number of samples in shards of {self.split} does not match csv."
+
+        self.shuffle = self.isTrain and (self.split == 'train')
+        self.shuffle_buffer = self.params.shuffle_buffer if self.shuffle else 0
+
+        # Epoch and batch which it starts from are shared with DataLoader workers, which may persist over epochs.
+        self.epoch = torch.zeros(1, dtype=torch.int64).share_memory_()
+        self.start_batch = torch.zeros(1, dtype=torch.int64).share_memory_()
+
+        if dist.is_available() and dist.is_initialized():
+            self.rank = dist.get_rank()
+            self.num_replicas = dist.get_world_size()
+        else:
+            self.rank = 0
+            self.num_replicas = 1
+        if self.shuffle:
+            self.num_samples = math.ceil(len(self.row_store) / self.num_replicas)
         else:
-            self.num_samples = math.ceil(len(self.split_data) / self.num_replicas)
+            self.num_samples = self._count_samples(self._make_rank_layout(self._shard_order(0)))
 
-        self.total_size = self.num_samples * self.num_replicas
-        self.shuffle = shuffle
+        # uniqIDs as UTF-8 bytes sorted for lookup of row by uniqID read from shard.
+        _uniqIDs = np.array([str(self.row_store.get('uniqID', idx)).encode('utf-8') for idx in range(len(self.row_store))], dtype=np.bytes_)
+        self.uniqID_order = np.argsort(_uniqIDs, kind='stable')
+        self.sorted_uniqIDs = _uniqIDs[self.uniqID_order]
 
-    def __iter__(self) -> Iterator[int]:
+    def __len__(self) -> int:
         """
-        Return the iterator of the indices.
+        Return the number of samples yielded by this rank in an epoch.
 
         Returns:
-            Iterator[int]: the balanced indices depending on weights
+            int: the number of samples
         """
-        if self.shuffle:
-            # Deterministically shuffle based on epoch
-            g = torch.Generator()
-            g.manual_seed(self.epoch)
-            indices = torch.randperm(len(self.split_data), generator=g).tolist()  # all indices
-        else:
-            indices = list(range(len(self.split_data)))
+        return self.num_samples
 
-        if not self.drop_last:
-            # Add extra samples to make it evenly divisible
-            padding_size = self.total_size - len(indices)
-            if padding_size <= len(indices):
-                indices += indices[:padding_size]
-            else:
-                indices += (indices * math.ceil(padding_size / len(indices)))[:padding_size]
-        else:
-            # Remove tail of data to make it evenly divisible.
-            indices = indices[:self.total_size]
-        assert len(indices) == self.total_size
+    def set_epoch(self, epoch: int) -> None:
+        """
+        Set epoch, which determines order of shards and shuffling.
 
-        # subsample indices
-        indices = indices[self.rank:self.total_size:self.num_replicas]
-        assert len(indices) == self.num_samples
+        Args:
+            epoch (int): epoch number
+        """
+        self.epoch[0] = epoch
 
-        # Select only the wanted weights for this subsample
-        _weights = self.weights[indices]
+    def set_start_batch(self, start_batch: int) -> None:
+        """
+        Set the batch which the epoch starts from.
 
-        # Do the weighted sampling
-        # Randomly sample this subset, producing balanced classes
-        subsample_balanced_indices = torch.multinomial(_weights, self.num_samples, self.replacement)
+        Args:
+            start_batch (int): number of batches already done in the epoch
+        """
+        self.start_batch[0] = start_batch
 
-        # Subsample the balanced indices
-        # Now, map these subsample_balanced_indices back to the original dataset index
-        subsample_balanced_indices = torch.tensor(indices)[subsample_balanced_indices]
-        return iter(subsample_balanced_indices.tolist())
+    def state_dict(self) -> Dict:
+        """
+        Return state to reproduce the order of samples, which is empty since it depends only on epoch.
 
-    def __len__(self) -> int:
-        return self.num_samples
+        Returns:
+            Dict: state
+        """
+        return {}
 
-    def set_epoch(self, epoch: int) -> None:
+    def load_state_dict(self, state: Dict) -> None:
+        """
+        Load state returned by state_dict().
+
+        Args:
+            state (Dict): state
+        """
+        pass
+
+    def _lookup(self, uniqID: str) -> int:
         """
-        Sets the epoch for this sampler. When :attr:`shuffle=True`, this ensures all replicas
-        use a different random ordering for each epoch. Otherwise, the next iteration of this
-        sampler will yield the same ordering.
+        Return index of row specified by uniqID.
+
+        Args:
+            uniqID (str): uniqID
+
+        Returns:
+            int: index of row
+        """
+        key = uniqID.encode('utf-8')
+        position = np.searchsorted(self.sorted_uniqIDs, key)
+        assert (position < len(self.sorted_uniqIDs)) and (self.sorted_uniqIDs[position] == key), f"uniqID {uniqID} in shard is not in csv."
+        return int(self.uniqID_order[position])
+
+    def _shard_order(self, epoch: int) -> List[int]:
+        """
+        Return order of shards in epoch.
 
         Args:
             epoch (int): epoch number
+
+        Returns:
+            List[int]: indices of shards
         """
-        self.epoch = epoch
+        if not self.shuffle:
+            return list(range(len(self.shard_paths)))
 
+        # The same order on all ranks, since it depends only on epoch.
+        generator = torch.Generator()
+        generator.manual_seed(epoch)
+        return torch.randperm(len(self.shard_paths), generator=generator).tolist()
 
-def calculate_weights(targets: List[int]) -> torch.tensor:
-    """
-    Calculate weights for each element.
+    @staticmethod
+    def _split_layout(layout: Tuple[List[int], List[Tuple[int, int]]], num_parts: int, part: int) -> Tuple[List[int], List[Tuple[int, int]]]:
+        """
+        Split layout into parts, and return one of them.
 
-    Args:
-        targets (List[int]): elements to be calculated weight
+        Args:
+            layout (Tuple[List[int], List[Tuple[int, int]]]): indices of shards, and strides and offsets of samples to be kept
+            num_parts (int): number of parts
+            part (int): part to be returned
 
-    Returns:
-        torch.tensor: weights for each element
-    """
-    targets = torch.tensor(targets)
-    class_sample_count = torch.tensor(
-                                [(targets == t).sum() for t in torch.unique(targets, sorted=True)]
-                            )
-    weight = 1. / class_sample_count.double()
-    samples_weight = torch.tensor([weight[t] for t in targets])
-    return samples_weight
+        Returns:
+            Tuple[List[int], List[Tuple[int, int]]]: layout of part
 
+        Note:
+            If there are at least as many shards as parts, each part reads its own shards.
+            Otherwise, every part reads all shards and keeps every num_parts-th sample.
+        """
+        shard_ids, filters = layout
+        if (filters == []) and (len(shard_ids) >= num_parts):
+            return shard_ids[part::num_parts], []
+        return shard_ids, filters + [(num_parts, part)]
 
-def set_sampler(
-                task: str = None,
-                label_list: List[str] = None,
-                sampler: str = None,
-                split_data: LoadDataSet = None
-                ) -> Union[DistributedSampler, WeightedRandomSampler, DistributedWeightedSampler]:
-    """
-    Set sampler.
+    def _make_rank_layout(self, shard_order: List[int]) -> Tuple[List[int], List[Tuple[int, int]]]:
+        """
+        Return layout of this rank.
 
-    Args:
-        task (str): task
-        label_list (List[str]): label list
-        sampler (str): sampler
-        split_data (LoadDataSet): dataset
+        Args:
+            shard_order (List[int]): indices of shards
 
-    Returns:
-        Union[DistributedSampler, WeightedRandomSampler, DistributedWeightedSampler]: sampler
+        Returns:
+            Tuple[List[int], List[Tuple[int, int]]]: indices of shards, and strides and offsets of samples to be kept
+        """
+        return self._split_layout((shard_order, []), self.num_replicas, self.rank)
 
-    Note:
-        Samplers are used only at training.
-    """
-    shuffle = True
-    drop_last = False
-    _sampler = None
-
-    if sampler == 'no':
-        return _sampler
-
-    elif sampler == 'distributed':
-        _sampler = DistributedSampler(
-                                    split_data,
-                                    shuffle=shuffle,
-                                    drop_last=drop_last
-                                    )
-        return _sampler
-
-    elif sampler in ['weighted', 'distweight']:
-        assert (task == 'classification') or (task == 'deepsurv'), 'Cannot make sampler based on weight in regression.'
-        assert (len(label_list) == 1), 'Cannot make sampler for multi-label.'
-
-        # Calculate weights on the whole targets
-        _target_label = label_list[0]
-        _targets = split_data.df_split[_target_label].tolist()
-        weights = calculate_weights(_targets)
-
-        if sampler == 'weighted':
-            # WeightedRandomSampler does shuffle automatically.
-            _sampler = WeightedRandomSampler(
-                                            weights,
-                                            len(weights)
-                                            )
-            return _sampler
-
-        if sampler == 'distweight':
-            _sampler = DistributedWeightedSampler(
-                                            weights,
-                                            split_data,
-                                            shuffle=shuffle,
-                                            drop_last=drop_last
-                                            )
-            return _sampler
-    else:
-        raise ValueError(f"Invalid sampler: {sampler}.")
+    def _count_samples(self, layout: Tuple[List[int], List[Tuple[int, int]]]) -> int:
+        """
+        Return the number of samples kept in layout.
+
+        Args:
+            layout (Tuple[List[int], List[Tuple[int, int]]]): indices of shards, and strides and offsets
+
+        Returns:
+            int: the number of samples
+        """
+        shard_ids, filters = layout
+        num_samples = sum(self.shard_sizes[shard_id] for shard_id in shard_ids)
+        for stride, offset in filters:
+            num_samples = len(range(offset, num_samples, stride))
+        return num_samples
+
+    def _split_quota(self, sizes: List[int]) -> List[int]:
+        """
+        Split the number of samples of this rank among workers.
+
+        Args:
+            sizes (List[int]): number of samples kept by each worker
+
+        Returns:
+            List[int]: number of samples yielded by each worker
+
+        Note:
+            Excess samples are dropped from the last workers,
+            and missing ones are taken from the beginning of the stream again by workers which have samples.
+        """
+        quotas = list(sizes)
+        excess = sum(sizes) - self.num_samples
+        for worker_id in reversed(range(len(quotas))):
+            if excess <= 0:
+                break
+            dropped = min(excess, quotas[worker_id])
+            quotas[worker_id] -= dropped
+            excess -= dropped
+
+        active_workers = [worker_id for worker_id, size in enumerate(sizes) if size > 0]
+        if active_workers == []:
+            return quotas
+        for i in range(-excess):
+            quotas[active_workers[i % len(active_workers)]] += 1
+        return quotas
+
+    @staticmethod
+    def _split_done_batches(num_batches: List[int], start_batch: int) -> Tuple[List[int], int]:
+        """
+        Return the number of batches of each worker among batches already done.
+
+        Args:
+            num_batches (List[int]): number of batches of each worker
+            start_batch (int): number of batches already done in the epoch
+
+        Returns:
+            Tuple[List[int], int]: number of batches done by each worker, and worker whose batch is the next
+
+        Note:
+            DataLoader takes batches from workers in turn, skipping workers which have no more batches.
+        """
+        done = [0] * len(num_batches)
+        next_worker = 0
+        for _ in range(min(start_batch, sum(num_batches))):
+            while done[next_worker] >= num_batches[next_worker]:
+                next_worker = (next_worker + 1) % len(num_batches)
+            done[next_worker] += 1
+            next_worker = (next_worker + 1) % len(num_batches)
+        return done, next_worker
+
+    def _iter_layout(self, layout: Tuple[List[int], List[Tuple[int, int]]], quota: int) -> Iterator[Tuple[str, bytes]]:
+        """
+        Read samples of layout sequentially up to quota, going back to the beginning if needed.
+
+        Args:
+            layout (Tuple[List[int], List[Tuple[int, int]]]): indices of shards, and strides and offsets
+            quota (int): number of samples to be yielded
+
+        Yields:
+            Tuple[str, bytes]: uniqID and image file
+        """
+        shard_ids, filters = layout
+        num_yielded = 0
+        while num_yielded < quota:
+            # Each filter counts samples passed through the preceding filters.
+            sample_ids = [0] * len(filters)
+            for shard_id in shard_ids:
+                for sample in iter_shard(self.shard_paths[shard_id]):
+                    is_kept = True
+                    for i, (stride, offset) in enumerate(filters):
+                        is_kept = (sample_ids[i] % stride) == offset
+                        sample_ids[i] += 1
+                        if not is_kept:
+                            break
+                    if not is_kept:
+                        continue
+
+                    yield sample
+                    num_yielded += 1
+                    if num_yielded >= quota:
+                        return
+
+    def _shuffle_samples(self, samples: Iterator[Tuple[str, bytes]], seed: int) -> Iterator[Tuple[str, bytes]]:
+        """
+        Shuffle samples through a buffer.
+
+        Args:
+            samples (Iterator[Tuple[str, bytes]]): samples
+            seed (int): seed of shuffling
+
+        Yields:
+            Tuple[str, bytes]: uniqID and image file
+        """
+        generator = random.Random(seed)
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            i = generator.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = sample
+
+        generator.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self) -> Iterator[Dict]:
+        """
+        Return the iterator of data of this rank and worker.
+
+        Returns:
+            Iterator[Dict]: dictionary of data to be passed model
+        """
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        epoch = int(self.epoch.item())
+        start_batch = int(self.start_batch.item())
+
+        rank_layout = self._make_rank_layout(self._shard_order(epoch))
+        layouts = [self._split_layout(rank_layout, num_workers, i) for i in range(num_workers)]
+        sizes = [self._count_samples(layout) for layout in layouts]
+        # Only at training, ranks are aligned to the same number of samples.
+        quotas = self._split_quota(sizes) if self.shuffle else sizes
+
+        num_done = 0
+        if start_batch > 0:
+            num_batches = [math.ceil(quota / self.params.batch_size) for quota in quotas]
+            done, next_worker = self._split_done_batches(num_batches, start_batch)
+            # DataLoader takes the first batch from the first worker, which continues samples of the worker whose batch is the next.
+            worker_id = (worker_id + next_worker) % num_workers
+            num_done = done[worker_id]
+
+        samples = self._iter_layout(layouts[worker_id], quotas[worker_id])
+        if self.shuffle_buffer > 0:
+            seed = (epoch * self.num_replicas + self.rank) * num_workers + worker_id
+            samples = self._shuffle_samples(samples, seed)
+        # Samples of batches already done are skipped before being decoded.
+        samples = itertools.islice(samples, num_done * self.params.batch_size, None)
+
+        for uniqID, encoded in samples:
+            idx = self._lookup(uniqID)
+            inputs_value = self._load_input_value_if_mlp(idx)
+            yield self._make_data(idx, inputs_value, encoded=encoded)
+
+        if self.profiler is not None:
+            self.profiler.flush()
 
 
 def create_dataloader(
@@ -799,17 +1974,36 @@ def create_dataloader(
     Returns:
         DataLoader: data loader
     """
-    split_data = LoadDataSet(params, split)
+    if params.shard_dir is None:
+        split_data = LoadDataSet(params, split)
+    else:
+        split_data = ShardDataSet(params, split)
 
-    if params.isTrain:
+    if params.isTrain and (params.shard_dir is not None):
+        # Samples are split across ranks and shuffled by dataset.
+        assert (params.sampler in ['distributed', 'no']), f"Cannot use sampler with shards: {params.sampler}."
+        _sampler = None
+        shuffle = False
+        batch_size = params.batch_size
+    elif params.isTrain and (split == 'train'):
         _sampler = set_sampler(
                             task=params.task,
                             label_list=params.label_list,
                             sampler=params.sampler,
-                            split_data=split_data
+                            split_data=split_data,
+                            balance=params.balance
                             )
-        # Shuffle during training
-        shuffle = False if _sampler is not None else True
+        if _sampler is None:
+            # Shuffle during training
+            _sampler = RandomSampler(split_data)
+        # Training may be resumed from the middle of epoch.
+        _sampler = ResumableSampler(_sampler, params.batch_size)
+        shuffle = False
+        batch_size = params.batch_size
+    elif params.isTrain:
+        # Each row of validation is evaluated exactly once.
+        _sampler = set_eval_sampler(sampler=params.sampler, split_data=split_data)
+        shuffle = False
         batch_size = params.batch_size
     else:
         assert (params.sampler == 'no'), 'Cannot use sampler during testing.'
@@ -824,12 +2018,36 @@ def create_dataloader(
         num_workers = 0
         pin_memory = False
 
+    hasPrefetcher = (getattr(split_data, 'prefetcher', None) is not None)
+    if hasPrefetcher and (_sampler is None):
+        # Batch sampler which reads files ahead needs sampler.
+        _sampler = RandomSampler(split_data) if shuffle else SequentialSampler(split_data)
+        shuffle = False
+
+    loader_kwargs = {
+                    'batch_size': batch_size,
+                    'sampler': _sampler,
+                    'shuffle': shuffle,
+                    'pin_memory': pin_memory,
+                    'collate_fn': split_data.collate_fn()
+                    }
+
+    if getattr(params, 'num_workers', None) is not None:
+        # Specified explicitly, eg. for evaluator of async_val.
+        worker_kwargs = {'num_workers': params.num_workers}
+    elif params.loader_tuning == 'auto':
+        # num_workers, prefetch_factor and persistent_workers
+        worker_kwargs = tune_loader(params, split, split_data, loader_kwargs)
+    else:
+        worker_kwargs = {'num_workers': num_workers}
+
+    if hasPrefetcher:
+        # Each batch is passed with indices of the next batch of the same worker, whose files are read ahead.
+        loader_kwargs = lookahead_loader_kwargs(loader_kwargs, worker_kwargs['num_workers'])
+
     split_loader = DataLoader(
                             dataset=split_data,
-                            batch_size=batch_size,
-                            sampler=_sampler,
-                            shuffle=shuffle,
-                            num_workers=num_workers,
-                            pin_memory=pin_memory
+                            **loader_kwargs,
+                            **worker_kwargs
                             )
     return split_loader
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import copy
+import queue
+import traceback
+import multiprocessing.util
+from collections import OrderedDict
+import torch
+import torch.multiprocessing as mp
+from .framework import create_model, set_device
+from .dataloader import create_dataloader
+from .component import set_criterion, LossSum
+from .logger import BaseLogger
+from lib import ParamSet
+from typing import Any, Dict, List, Tuple
+
+
+logger = BaseLogger.get_logger(__name__)
+
+
+def _validate(
+            args_model: ParamSet,
+            args_dataloader: ParamSet,
+            criterion_name: str,
+            label_list: List[str],
+            num_threads: int,
+            jobs: mp.Queue,
+            results: mp.Queue
+            ) -> None:
+    """
+    Validate weights received from jobs, and put sums of losses into results until None is received.
+
+    Args:
+        args_model (ParamSet): parameters for model
+        args_dataloader (ParamSet): parameters for dataloader, whose gpu_ids is the device of evaluator
+        criterion_name (str): criterion
+        label_list (List[str]): label list
+        num_threads (int): number of threads, or 0 if default of torch
+        jobs (mp.Queue): epoch and weight to be validated
+        results (mp.Queue): epoch, sums of losses and the number of data, or error
+    """
+    try:
+        if num_threads > 0:
+            torch.set_num_threads(num_threads)
+        device = set_device(gpu_ids=args_dataloader.gpu_ids)
+        if device.type == 'cuda':
+            torch.cuda.set_device(device)
+        model = create_model(args_model)
+        model.network.to(device)
+        model.network.eval()
+        criterion = set_criterion(criterion_name, device)
+        val_dataloader = create_dataloader(args_dataloader, split='val')
+        loss_sum = LossSum(label_list, device)
+
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            epoch, weight = job
+            model.network.load_state_dict(weight)
+
+            profiler = val_dataloader.dataset.profiler
+            if profiler is not None:
+                profiler.reset()
+
+            with torch.no_grad():
+                for data in val_dataloader:
+                    in_data, labels = model.set_data(data, device)
+                    outputs = model(in_data)
+                    losses = criterion(outputs, labels)
+                    loss_sum.add(losses, batch_size=len(data['imgpath']))
+
+            if profiler is not None:
+                logger.info(profiler.report('val', lambda idx: val_dataloader.dataset.row_store.get('imgpath', idx)))
+            results.put((epoch, *loss_sum.pop()))
+
+    except Exception:
+        results.put(('error', traceback.format_exc(), None))
+
+
+class AsyncValidator:
+    """
+    Class to validate snapshots of weight in a separate process while training proceeds with the next epoch.
+
+    Epochs are finished in order when their results are received,
+    therefore training is ahead of validation by the number of epochs pending.
+
+    Note:
+        The evaluator reads the whole validation split by itself, ie. without DDP, on CPU or a GPU.
+        Only snapshots of weight passed to it are on CPU.
+    """
+    def __init__(
+                self,
+                args_model: ParamSet,
+                args_dataloader: ParamSet,
+                criterion_name: str,
+                label_list: List[str],
+                gpu_ids: List[int] = None,
+                num_workers: int = 0,
+                num_threads: int = 0
+                ) -> None:
+        """
+        Args:
+            args_model (ParamSet): parameters for model
+            args_dataloader (ParamSet): parameters for dataloader
+            criterion_name (str): criterion
+            label_list (List[str]): label list
+            gpu_ids (List[int]): GPU id of evaluator, or [] or None if CPU
+            num_workers (int): number of workers of DataLoader of evaluator
+            num_threads (int): number of threads of evaluator, or 0 if default of torch
+        """
+        # Pretrained weight is not needed since weight is replaced.
+        _args_model = copy.copy(args_model)
+        _args_model.pretrained = False
+        # Validation split is not divided among processes.
+        _args_dataloader = copy.copy(args_dataloader)
+        _args_dataloader.gpu_ids = [] if gpu_ids is None else gpu_ids
+        _args_dataloader.sampler = 'no'
+        _args_dataloader.num_workers = num_workers
+
+        # Spawned, since threads and CUDA of training process are not inherited safely by fork.
+        # Not daemonic, so that it can start workers of DataLoader.
+        context = mp.get_context('spawn')
+        self.jobs = context.Queue()
+        self.results = context.Queue()
+        self.process = context.Process(
+                                    target=_validate,
+                                    args=(_args_model, _args_dataloader, criterion_name, label_list, num_threads, self.jobs, self.results)
+                                    )
+        self.process.start()
+        # Terminated if training exits without close(), before non-daemonic processes are joined.
+        multiprocessing.util.Finalize(self, self.process.terminate, exitpriority=0)
+
+        # Epoch -> sums of losses at training and weight, which wait for results.
+        self.pending = OrderedDict()
+
+    @property
+    def num_pending(self) -> int:
+        """
+        Return the number of epochs waiting for results.
+
+        Returns:
+            int: the number of epochs
+        """
+        return len(self.pending)
+
+    def submit(self, epoch: int, train_loss_sums: Dict[str, float], train_num_data: int, weight: Dict[str, torch.Tensor]) -> None:
+        """
+        Submit weight at the end of training of epoch to be validated.
+
+        Args:
+            epoch (int): epoch number
+            train_loss_sums (Dict[str, float]): sums of losses at training of epoch
+            train_num_data (int): number of data at training of epoch
+            weight (Dict[str, torch.Tensor]): snapshot of weight on CPU, which must not be modified
+        """
+        self.pending[epoch] = {'train_loss_sums': train_loss_sums, 'train_num_data': train_num_data, 'weight': weight}
+        self.jobs.put((epoch, weight))
+
+    def _receive(self) -> Tuple[Any, Any, Any]:
+        """
+        Wait for result of evaluator.
+
+        Returns:
+            Tuple[Any, Any, Any]: epoch, sums of losses and the number of data
+        """
+        while True:
+            try:
+                result = self.results.get(timeout=1.0)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError('Evaluator of validation exited unexpectedly.')
+                continue
+
+            if result[0] == 'error':
+                raise RuntimeError(f"Validation failed in evaluator:\n{result[1]}")
+            return result
+
+    def next_result(self) -> Dict[str, Any]:
+        """
+        Wait for result of the oldest epoch pending.
+
+        Returns:
+            Dict[str, Any]: epoch, sums of losses and the number of data at training and validation, and weight validated
+        """
+        epoch, val_loss_sums, val_num_data = self._receive()
+        _epoch, pending = self.pending.popitem(last=False)
+        assert (epoch == _epoch), f"Result of epoch {epoch} is received instead of epoch {_epoch}."
+        return {'epoch': epoch, 'val_loss_sums': val_loss_sums, 'val_num_data': val_num_data, **pending}
+
+    def state_dict(self) -> Dict[str, Any]:
+        """
+        Return epochs pending, which are validated again when resumed.
+
+        Returns:
+            Dict[str, Any]: state
+        """
+        return {'pending': list(self.pending.items())}
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        """
+        Submit epochs pending in state returned by state_dict().
+
+        Args:
+            state (Dict[str, Any]): state
+        """
+        for epoch, pending in state['pending']:
+            self.submit(epoch, pending['train_loss_sums'], pending['train_num_data'], pending['weight'])
+
+    def close(self) -> None:
+        """
+        Stop evaluator.
+        """
+        self.jobs.put(None)
+        self.process.join()
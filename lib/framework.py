@@ -8,6 +8,8 @@ import torch
 import torch.nn as nn
 import torch.distributed as dist
 from .component import create_net
+from .dataloader import ScaleNormalize, Batch
+from .checkpoint import CheckpointWriter, to_cpu
 from .logger import BaseLogger
 from lib import ParamSet
 from typing import List, Dict, Tuple, Union
@@ -41,38 +43,112 @@ class BaseModel(ABC):
                                 mlp_num_inputs=self.params.mlp_num_inputs,
                                 in_channel=self.params.in_channel,
                                 vit_image_size=self.params.vit_image_size,
-                                pretrained=self.params.pretrained
+                                pretrained=self.params.pretrained,
+                                normalize_image=self.params.normalize_image
                                 )
 
+        # When images are transferred as integers, they are scaled and normalized on device.
+        self.scale_normalize = None
+        if (self.params.net is not None) and (self.params.image_transfer == 'uint'):
+            self.scale_normalize = ScaleNormalize(
+                                                bit_depth=self.params.bit_depth,
+                                                in_channel=self.params.in_channel,
+                                                normalize_image=self.params.normalize_image
+                                                )
+
         # variables to keep temporary best_weight and best_epoch
         self.acting_best_weight = None
         self.acting_best_epoch = None
+        # Event recorded after weight is copied from GPU.
+        self.acting_best_weight_copied = None
+
+        # Weights are written in background by master process.
+        self.checkpoint_writer = None
+        self.saved_weight_paths = set()
 
     @abstractmethod
     def set_data(
                 self,
-                data: Dict
+                data: Batch
                 ) -> Tuple[
                         Dict[str, torch.FloatTensor],
                         Dict[str, Union[LabelDict, torch.IntTensor, nn.Module]]
                         ]:
         raise NotImplementedError
 
-    def store_weight(self, at_epoch: int = None) -> None:
+    def _set_image(self, image: torch.Tensor, device: torch.device) -> torch.FloatTensor:
+        """
+        Pass image to device.
+        If image is transferred as integers, it is scaled and normalized on device.
+
+        Args:
+            image (torch.Tensor): batch of images
+            device (torch.device): device
+
+        Returns:
+            torch.FloatTensor: batch of images on device
+        """
+        image = image.to(device)
+        if self.scale_normalize is not None:
+            image = self.scale_normalize(image)
+        return image
+
+    def store_weight(self, at_epoch: int = None, state_dict: Dict[str, torch.Tensor] = None) -> None:
         """
         Store weight and epoch number when it is saved.
 
         Args:
             at_epoch (int): epoch number when save weight
+            state_dict (Dict[str, torch.Tensor], optional): weight stored instead of the current one of network,
+                                                            eg. snapshot validated asynchronously. Defaults to None.
+
+        Note:
+            Buffers on CPU are allocated at the first call, and parameters and buffers of network are copied into them in place.
+            From GPU, they are copied asynchronously into pinned memory, and waited for only when written.
         """
         self.acting_best_epoch = at_epoch
 
-        _network = copy.deepcopy(self.network)
-        if hasattr(_network, 'module'):
-            # When using DDP at training, pass weight to CPU.
-            self.acting_best_weight = copy.deepcopy(_network.module.to(torch.device('cpu')).state_dict())
-        else:
-            self.acting_best_weight = copy.deepcopy(_network.state_dict())
+        if self.checkpoint_writer is not None:
+            # Buffers are not overwritten until weight stored previously is written.
+            self.checkpoint_writer.wait()
+
+        if state_dict is None:
+            # When using DDP at training, weight without the wrapper is stored.
+            _network = self.network.module if hasattr(self.network, 'module') else self.network
+            state_dict = _network.state_dict()
+
+        if self.acting_best_weight is None:
+            self.acting_best_weight = {
+                                    name: (self._allocate_snapshot(value) if isinstance(value, torch.Tensor) else None)
+                                    for name, value in state_dict.items()
+                                    }
+
+        on_gpu = False
+        for name, value in state_dict.items():
+            if isinstance(value, torch.Tensor):
+                self.acting_best_weight[name].copy_(value, non_blocking=True)
+                on_gpu = on_gpu or value.is_cuda
+            else:
+                self.acting_best_weight[name] = copy.deepcopy(value)
+
+        self.acting_best_weight_copied = None
+        if on_gpu:
+            # Copies are done in order on the current stream, ie. before weight is updated next.
+            self.acting_best_weight_copied = torch.cuda.Event()
+            self.acting_best_weight_copied.record()
+
+    @staticmethod
+    def _allocate_snapshot(tensor: torch.Tensor) -> torch.Tensor:
+        """
+        Allocate buffer on CPU for snapshot of tensor.
+
+        Args:
+            tensor (torch.Tensor): parameter or buffer of network
+
+        Returns:
+            torch.Tensor: buffer on CPU, which is pinned if tensor is on GPU
+        """
+        return torch.empty(tensor.shape, dtype=tensor.dtype, device='cpu', pin_memory=tensor.is_cuda)
 
     def save_weight(self, save_datetime_dir: str, as_best: bool = None) -> None:
         """
@@ -81,7 +157,12 @@ class BaseModel(ABC):
         Args:
             save_datetime_dir (str): save_datetime_dir
             as_best (bool): True if weight is saved as best, otherwise False. Defaults to None.
+
+        Note:
+            Weight is written in background, and training continues immediately.
         """
+        if self.checkpoint_writer is None:
+            self.checkpoint_writer = CheckpointWriter()
 
         save_dir = Path(save_datetime_dir, 'weights')
         save_dir.mkdir(parents=True, exist_ok=True)
@@ -91,14 +172,69 @@ class BaseModel(ABC):
         if as_best:
             save_name_as_best = 'weight_epoch-' + str(self.acting_best_epoch).zfill(3) + '_best' + '.pt'
             save_path_as_best = Path(save_dir, save_name_as_best)
-            if save_path.exists():
+            if (save_path in self.saved_weight_paths) or save_path.exists():
                 # Check if best weight already saved. If exists, rename with '_best'
-                save_path.rename(save_path_as_best)
+                self.checkpoint_writer.rename(save_path, save_path_as_best)
             else:
-                torch.save(self.acting_best_weight, save_path_as_best)
+                self.checkpoint_writer.save(self.acting_best_weight, save_path_as_best, ready=self.acting_best_weight_copied)
         else:
             save_name = 'weight_epoch-' + str(self.acting_best_epoch).zfill(3) + '.pt'
-            torch.save(self.acting_best_weight, save_path)
+            self.checkpoint_writer.save(self.acting_best_weight, save_path, ready=self.acting_best_weight_copied)
+            self.saved_weight_paths.add(save_path)
+
+    def snapshot_weight(self) -> Dict[str, torch.Tensor]:
+        """
+        Return copy of the current weight on CPU.
+
+        Returns:
+            Dict[str, torch.Tensor]: weight without the wrapper of DDP
+        """
+        _network = self.network.module if hasattr(self.network, 'module') else self.network
+        return to_cpu(_network.state_dict())
+
+    def save_checkpoint(self, save_datetime_dir: str, checkpoint: Dict) -> None:
+        """
+        Save checkpoint for resuming training with weight of network and the best weight.
+
+        Args:
+            save_datetime_dir (str): save_datetime_dir
+            checkpoint (Dict): states other than network, eg. optimizer and epoch
+
+        Note:
+            Checkpoint is written in background after weights saved before, and replaced each time.
+        """
+        if self.checkpoint_writer is None:
+            self.checkpoint_writer = CheckpointWriter()
+
+        checkpoint = {
+                    **checkpoint,
+                    'network': self.snapshot_weight(),
+                    'best_weight': self.acting_best_weight,
+                    'best_epoch': self.acting_best_epoch
+                    }
+        save_path = Path(save_datetime_dir, 'checkpoint.pt')
+        save_path.parent.mkdir(parents=True, exist_ok=True)
+        self.checkpoint_writer.save(checkpoint, save_path, ready=self.acting_best_weight_copied)
+
+    def load_checkpoint(self, checkpoint: Dict) -> None:
+        """
+        Load weight of network and the best weight from checkpoint.
+
+        Args:
+            checkpoint (Dict): checkpoint saved by save_checkpoint()
+        """
+        _network = self.network.module if hasattr(self.network, 'module') else self.network
+        _network.load_state_dict(checkpoint['network'])
+        self.acting_best_weight = checkpoint['best_weight']
+        self.acting_best_epoch = checkpoint['best_epoch']
+
+    def finish_saving(self) -> None:
+        """
+        Wait until all weights are written, and stop writing in background.
+        """
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.close()
+            self.checkpoint_writer = None
 
     def load_weight(self, weight_path: Path, on_device: torch.device = None) -> None:
         """
@@ -124,7 +260,8 @@ class BaseModel(ABC):
                                 mlp_num_inputs=self.params.mlp_num_inputs,
                                 in_channel=self.params.in_channel,
                                 vit_image_size=self.params.vit_image_size,
-                                pretrained=self.params.pretrained
+                                pretrained=self.params.pretrained,
+                                normalize_image=self.params.normalize_image
                                 )
 
 
@@ -142,7 +279,7 @@ class MLPModel(BaseModel):
 
     def set_data(
                 self,
-                data: Dict,
+                data: Batch,
                 device: torch.device
                 ) -> Tuple[
                         Dict[str, torch.FloatTensor],
@@ -154,7 +291,7 @@ class MLPModel(BaseModel):
         When deepsurv, period and network are also returned.
 
         Args:
-            data (Dict): dictionary of data
+            data (Batch): batch of data
             device (torch.device): device
 
         Returns:
@@ -168,7 +305,7 @@ class MLPModel(BaseModel):
         in_data = {'inputs': data['inputs'].to(device)}
         labels = {'labels': {label_name: label.to(device) for label_name, label in data['labels'].items()}}
 
-        if not any(data['periods']):
+        if data['periods'] is None:
             return in_data, labels
 
         # When deepsurv
@@ -206,7 +343,7 @@ class CVModel(BaseModel):
 
     def set_data(
                 self,
-                data: Dict,
+                data: Batch,
                 device: torch.device
                 ) -> Tuple[
                         Dict[str, torch.FloatTensor],
@@ -217,7 +354,7 @@ class CVModel(BaseModel):
         When deepsurv, period and network are also returned.
 
         Args:
-            data (Dict): dictionary of data
+            data (Batch): batch of data
             device (torch.device): device
 
         Returns:
@@ -228,10 +365,10 @@ class CVModel(BaseModel):
         eg.
         ({image}, {labels}), or ({image}, {labels, periods, network}) when deepsurv
         """
-        in_data = {'image': data['image'].to(device)}
+        in_data = {'image': self._set_image(data['image'], device)}
         labels = {'labels': {label_name: label.to(device) for label_name, label in data['labels'].items()}}
 
-        if not any(data['periods']):
+        if data['periods'] is None:
             return in_data, labels
 
         # When deepsurv
@@ -269,7 +406,7 @@ class FusionModel(BaseModel):
 
     def set_data(
                 self,
-                data: Dict,
+                data: Batch,
                 device: torch.device
                 ) -> Tuple[
                         Dict[str, torch.FloatTensor],
@@ -281,7 +418,7 @@ class FusionModel(BaseModel):
         When deepsurv, period and network are also returned.
 
         Args:
-            data (Dict): dictionary of data
+            data (Batch): batch of data
             device (torch.device): device
 
         Returns:
@@ -294,11 +431,11 @@ class FusionModel(BaseModel):
         """
         in_data = {
                 'inputs': data['inputs'].to(device),
-                'image': data['image'].to(device)
+                'image': self._set_image(data['image'], device)
                 }
         labels = {'labels': {label_name: label.to(device) for label_name, label in data['labels'].items()}}
 
-        if not any(data['periods']):
+        if data['periods'] is None:
             return in_data, labels
 
         # When deepsurv
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import json
+import socket
+from pathlib import Path
+from torch.utils.data.dataset import Dataset
+from torch.utils.data.dataloader import DataLoader
+from .cache import file_lock, make_cache_key
+from .prefetch import lookahead_loader_kwargs
+from .logger import BaseLogger
+from typing import List, Dict, Union
+
+
+logger = BaseLogger.get_logger(__name__)
+
+
+class LoaderTuner:
+    """
+    Class to tune settings of DataLoader by benchmarking candidates on the real dataset.
+
+    The fastest settings are cached per host and per configuration,
+    so that later runs with the same configuration start tuned without benchmarking.
+    """
+    # Number of batches fetched per pass, and passes per candidate.
+    # Two passes, ie. two epochs, are needed to measure the gain of persistent workers.
+    num_batches = 20
+    num_passes = 2
+
+    # Throughput has to be improved at least by this ratio to try more workers.
+    min_gain = 0.05
+
+    prefetch_factors = [2, 4, 8]
+
+    def __init__(self, cache_dir: str, config: Dict[str, Union[str, int]], world_size: int = 1) -> None:
+        """
+        Args:
+            cache_dir (str): directory of caches
+            config (Dict[str, Union[str, int]]): configuration which affects loading, eg. split, batch_size, net
+            world_size (int): number of processes sharing CPUs of the host
+        """
+        self.cache_path = Path(cache_dir, 'loader_tuning.json')
+        self.lock_path = Path(cache_dir, 'loader_tuning.lock')
+        self.world_size = world_size
+        self.max_workers = max(self._count_cpus() // world_size, 0)
+        self.key = make_cache_key(socket.gethostname(), self._count_cpus(), world_size, *[f"{k}={v}" for k, v in sorted(config.items())])
+
+    @staticmethod
+    def _count_cpus() -> int:
+        """
+        Return number of CPUs available to this process.
+
+        Returns:
+            int: number of CPUs
+        """
+        if hasattr(os, 'sched_getaffinity'):
+            return len(os.sched_getaffinity(0))
+        return os.cpu_count()
+
+    def _candidate_workers(self) -> List[int]:
+        """
+        Return candidates of number of workers, ie. 0 and powers of 2 up to max_workers.
+
+        Returns:
+            List[int]: candidates of number of workers
+        """
+        candidates = [0]
+        num_workers = 1
+        while num_workers <= self.max_workers:
+            candidates.append(num_workers)
+            num_workers *= 2
+        if candidates[-1] != self.max_workers:
+            candidates.append(self.max_workers)
+        return candidates
+
+    @staticmethod
+    def _to_loader_kwargs(num_workers: int, prefetch_factor: int, persistent_workers: bool) -> Dict[str, Union[int, bool]]:
+        """
+        Return keyword arguments of DataLoader.
+
+        Args:
+            num_workers (int): number of workers
+            prefetch_factor (int): number of batches loaded in advance by each worker
+            persistent_workers (bool): whether to keep workers alive between epochs
+
+        Returns:
+            Dict[str, Union[int, bool]]: keyword arguments of DataLoader
+
+        Note:
+            prefetch_factor and persistent_workers are available only when num_workers > 0.
+        """
+        if num_workers == 0:
+            return {'num_workers': 0}
+        return {'num_workers': num_workers, 'prefetch_factor': prefetch_factor, 'persistent_workers': persistent_workers}
+
+    def _benchmark(self, dataset: Dataset, loader_kwargs: Dict, candidate: Dict[str, Union[int, bool]]) -> float:
+        """
+        Measure throughput of candidate.
+
+        Args:
+            dataset (Dataset): dataset
+            loader_kwargs (Dict): keyword arguments of DataLoader other than candidate
+            candidate (Dict[str, Union[int, bool]]): settings to be benchmarked
+
+        Returns:
+            float: samples per second
+        """
+        if getattr(dataset, 'prefetcher', None) is not None:
+            # Files are read ahead in the same way as DataLoader to be used, which depends on the number of workers.
+            loader_kwargs = lookahead_loader_kwargs(loader_kwargs, candidate['num_workers'])
+        loader = DataLoader(dataset=dataset, **loader_kwargs, **candidate)
+        num_samples = 0
+        start = time.perf_counter()
+        for _ in range(self.num_passes):
+            for i, data in enumerate(loader):
+                num_samples += len(data['imgpath'])
+                if (i + 1) >= self.num_batches:
+                    break
+        elapsed = time.perf_counter() - start
+        # Shut down workers.
+        del loader
+        return num_samples / elapsed
+
+    def tune(self, dataset: Dataset, loader_kwargs: Dict) -> Dict[str, Union[int, bool]]:
+        """
+        Return the fastest settings of DataLoader.
+
+        Args:
+            dataset (Dataset): dataset
+            loader_kwargs (Dict): keyword arguments of DataLoader other than settings to be tuned,
+                                  ie. batch_size, sampler, shuffle, pin_memory, and collate_fn.
+
+        Returns:
+            Dict[str, Union[int, bool]]: num_workers, prefetch_factor, and persistent_workers
+
+        Note:
+            Among processes on a host, only one benchmarks at a time while the others wait for the lock,
+            and then they use the cached result.
+        """
+        with file_lock(self.lock_path):
+            cached = self._load()
+            if self.key in cached:
+                logger.info(f"Use tuned DataLoader: {cached[self.key]}.")
+                return cached[self.key]
+
+            logger.info('Tuning DataLoader ...')
+            best = self._search(dataset, loader_kwargs)
+            cached[self.key] = best
+            self._save(cached)
+
+        logger.info(f"Tuned DataLoader: {best}.")
+        return best
+
+    def _search(self, dataset: Dataset, loader_kwargs: Dict) -> Dict[str, Union[int, bool]]:
+        """
+        Search the fastest settings.
+        Number of workers is increased while throughput improves,
+        then prefetch_factor and persistent_workers are chosen for that number of workers.
+
+        Args:
+            dataset (Dataset): dataset
+            loader_kwargs (Dict): keyword arguments of DataLoader other than settings to be tuned
+
+        Returns:
+            Dict[str, Union[int, bool]]: the fastest settings
+        """
+        best = self._to_loader_kwargs(0, None, False)
+        best_throughput = self._benchmark(dataset, loader_kwargs, best)
+
+        for num_workers in self._candidate_workers()[1:]:
+            candidate = self._to_loader_kwargs(num_workers, self.prefetch_factors[0], True)
+            throughput = self._benchmark(dataset, loader_kwargs, candidate)
+            if throughput < best_throughput * (1 + self.min_gain):
+                break
+            best, best_throughput = candidate, throughput
+
+        if best['num_workers'] == 0:
+            return best
+
+        num_workers = best['num_workers']
+        for prefetch_factor in self.prefetch_factors[1:]:
+            candidate = self._to_loader_kwargs(num_workers, prefetch_factor, True)
+            throughput = self._benchmark(dataset, loader_kwargs, candidate)
+            if throughput > best_throughput:
+                best, best_throughput = candidate, throughput
+
+        candidate = self._to_loader_kwargs(num_workers, best['prefetch_factor'], False)
+        throughput = self._benchmark(dataset, loader_kwargs, candidate)
+        if throughput > best_throughput:
+            best, best_throughput = candidate, throughput
+
+        return best
+
+    def _load(self) -> Dict[str, Dict[str, Union[int, bool]]]:
+        """
+        Load cached results.
+
+        Returns:
+            Dict[str, Dict[str, Union[int, bool]]]: key and settings
+        """
+        if not self.cache_path.exists():
+            return {}
+        with open(self.cache_path) as f:
+            return json.load(f)
+
+    def _save(self, cached: Dict[str, Dict[str, Union[int, bool]]]) -> None:
+        """
+        Save cached results.
+
+        Args:
+            cached (Dict[str, Dict[str, Union[int, bool]]]): key and settings
+        """
+        tmp_path = self.cache_path.with_suffix('.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(cached, f, indent=4)
+        os.replace(tmp_path, self.cache_path)
+
+
+def tune_loader(
+                params,
+                split: str,
+                dataset: Dataset,
+                loader_kwargs: Dict
+                ) -> Dict[str, Union[int, bool]]:
+    """
+    Tune settings of DataLoader for split.
+
+    Args:
+        params (ParamSet): parameter for dataloader
+        split (str): split
+        dataset (Dataset): dataset of split
+        loader_kwargs (Dict): keyword arguments of DataLoader other than settings to be tuned
+
+    Returns:
+        Dict[str, Union[int, bool]]: num_workers, prefetch_factor, and persistent_workers
+    """
+    config = {
+            'csvpath': str(Path(params.csvpath).resolve()),
+            'split': split,
+            'num_rows': len(dataset),
+            'isTrain': params.isTrain,
+            'mlp': params.mlp,
+            'net': params.net,
+            'bit_depth': params.bit_depth,
+            'in_channel': params.in_channel,
+            'image_size': params.image_size,
+            'augmentation': params.augmentation,
+            'augmentation_stage': params.augmentation_stage,
+            'normalize_image': params.normalize_image,
+            'image_decoder': params.image_decoder,
+            'image_transfer': params.image_transfer,
+            'image_cache': params.image_cache,
+            'tensor_cache_mb': params.tensor_cache_mb,
+            'prescan': params.prescan,
+            'io_prefetch': params.io_prefetch,
+            'profile_loading': params.profile_loading,
+            'shard_dir': params.shard_dir,
+            'batch_size': loader_kwargs['batch_size'],
+            'pin_memory': loader_kwargs['pin_memory']
+            }
+    world_size = max(len(params.gpu_ids), 1)
+    loader_tuner = LoaderTuner(params.cache_dir, config, world_size=world_size)
+    return loader_tuner.tune(dataset, loader_kwargs)
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+from .logger import BaseLogger
+from typing import List, Dict, Tuple, Union
+
+
+logger = BaseLogger.get_logger(__name__)
+
+
+def aligned_size(nbytes: int, alignment: int = 64) -> int:
+    """
+    Return size rounded up to alignment, which is used for buffers in a block of shared memory.
+
+    Args:
+        nbytes (int): size in bytes
+        alignment (int): alignment in bytes
+
+    Returns:
+        int: aligned size
+    """
+    return -(-nbytes // alignment) * alignment
+
+
+class StringColumn:
+    """
+    Class for column of strings held as UTF-8 bytes and offsets, as in Apache Arrow.
+
+    The i-th string is data[offsets[i]:offsets[i + 1]].
+    Slicing rows makes a view of offsets, and data is never copied.
+    """
+    def __init__(self, offsets: np.ndarray, data: np.ndarray) -> None:
+        """
+        Args:
+            offsets (np.ndarray): np.int64 offsets of strings, whose length is the number of strings + 1
+            data (np.ndarray): np.uint8 UTF-8 bytes of all strings concatenated
+        """
+        self.offsets = offsets
+        self.data = data
+
+    @staticmethod
+    def encode(values: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Encode strings into offsets and data.
+
+        Args:
+            values (pd.Series): strings
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: offsets and data
+        """
+        encoded = [value.encode('utf-8') for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return offsets, data
+
+    def __len__(self) -> int:
+        """
+        Return the number of strings.
+
+        Returns:
+            int: the number of strings
+        """
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: Union[int, slice]) -> Union[bytes, 'StringColumn']:
+        """
+        Return string at index as UTF-8 bytes, or column of contiguous rows.
+
+        Args:
+            idx (Union[int, slice]): index, or slice with step 1
+
+        Returns:
+            Union[bytes, StringColumn]: UTF-8 bytes, or column sharing data
+        """
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            assert (step == 1), 'Only contiguous rows can be sliced.'
+            return StringColumn(self.offsets[start:max(start, stop) + 1], self.data)
+        return self.data[self.offsets[idx]:self.offsets[idx + 1]].tobytes()
+
+    def tolist(self) -> List[str]:
+        """
+        Return all strings.
+
+        Returns:
+            List[str]: strings
+        """
+        return [self[i].decode('utf-8') for i in range(len(self))]
+
+    def to_numpy(self) -> np.ndarray:
+        """
+        Return all strings as fixed-width UTF-8 bytes.
+
+        Returns:
+            np.ndarray: fixed-width array of UTF-8 bytes
+        """
+        return np.array([self[i] for i in range(len(self))], dtype=np.bytes_)
+
+
+class SharedManifest:
+    """
+    Class to hold parsed csv as columns in a single block of shared memory.
+
+    The parent process publishes it once, and spawned ranks attach to the block when unpickled,
+    so that columns are read without copying the DataFrame into each rank.
+    Rows are sorted by split, therefore each split is a contiguous range and its columns are views of the block.
+
+    Note:
+        Numeric columns are held as they are, and columns of strings as StringColumn.
+        Columns which are neither of them, eg. strings with missing values, are pickled as object arrays.
+    """
+    # Alignment of each buffer in the block.
+    alignment = 64
+
+    def __init__(
+                self,
+                shm: shared_memory.SharedMemory,
+                layout: Dict[str, Tuple],
+                objects: Dict[str, np.ndarray],
+                split_ranges: Dict[str, Tuple[int, int]],
+                owner: bool = False
+                ) -> None:
+        """
+        Args:
+            shm (shared_memory.SharedMemory): block of shared memory
+            layout (Dict[str, Tuple]): column name and its kind, dtype, offsets and sizes of buffers in the block
+            objects (Dict[str, np.ndarray]): column name and its values not held in the block
+            split_ranges (Dict[str, Tuple[int, int]]): split and its range of rows
+            owner (bool): whether this process unlinks the block
+        """
+        self.shm = shm
+        self.layout = layout
+        self.objects = objects
+        self.split_ranges = split_ranges
+        self.owner = owner
+
+    @classmethod
+    def publish(cls, df_source: pd.DataFrame) -> 'SharedManifest':
+        """
+        Copy DataFrame into shared memory.
+
+        Args:
+            df_source (pd.DataFrame): parsed csv
+
+        Returns:
+            SharedManifest: manifest owned by this process
+        """
+        # Stable sort keeps the order of rows in each split.
+        df_source = df_source.sort_values('split', kind='stable')
+        _splits = df_source['split'].to_numpy()
+        split_ranges = {}
+        for split in pd.unique(_splits):
+            _rows = np.flatnonzero(_splits == split)
+            split_ranges[split] = (int(_rows[0]), int(_rows[-1]) + 1)
+
+        buffers = {}
+        objects = {}
+        for column_name in df_source.columns:
+            column = df_source[column_name]
+            if column.dtype.kind in 'biuf':
+                buffers[column_name] = ('numeric', [column.to_numpy()])
+            elif column.map(lambda value: isinstance(value, str)).all():
+                buffers[column_name] = ('string', list(StringColumn.encode(column)))
+            else:
+                objects[column_name] = column.to_numpy(copy=True)
+
+        total_size = sum(aligned_size(array.nbytes, cls.alignment) for _, arrays in buffers.values() for array in arrays)
+        shm = shared_memory.SharedMemory(create=True, size=max(total_size, 1))
+
+        layout = {}
+        position = 0
+        for column_name, (kind, arrays) in buffers.items():
+            _buffers = []
+            for array in arrays:
+                np.frombuffer(shm.buf, dtype=array.dtype, count=array.size, offset=position)[:] = array
+                _buffers.append((array.dtype.str, position, array.size))
+                position += aligned_size(array.nbytes, cls.alignment)
+            layout[column_name] = (kind, _buffers)
+
+        logger.info(f"Published manifest of {len(df_source)} rows in shared memory ({total_size / (1 << 20):.1f} MiB).")
+        return cls(shm, layout, objects, split_ranges, owner=True)
+
+    def __getstate__(self) -> Dict:
+        """
+        Return state to be pickled, which refers to the block by name.
+
+        Returns:
+            Dict: state
+        """
+        return {'name': self.shm.name, 'layout': self.layout, 'objects': self.objects, 'split_ranges': self.split_ranges}
+
+    def __setstate__(self, state: Dict) -> None:
+        """
+        Attach to the block without copying.
+
+        Args:
+            state (Dict): state
+        """
+        self.__init__(shared_memory.SharedMemory(name=state['name']), state['layout'], state['objects'], state['split_ranges'], owner=False)
+
+    @property
+    def columns(self) -> List[str]:
+        """
+        Return column names.
+
+        Returns:
+            List[str]: column names
+        """
+        return list(self.layout.keys()) + list(self.objects.keys())
+
+    def __len__(self) -> int:
+        """
+        Return the number of rows.
+
+        Returns:
+            int: the number of rows
+        """
+        return max([stop for _, stop in self.split_ranges.values()], default=0)
+
+    def _view(self, dtype: str, offset: int, size: int) -> np.ndarray:
+        """
+        Return array of buffer in the block without copying.
+
+        Args:
+            dtype (str): dtype of buffer
+            offset (int): offset of buffer in the block
+            size (int): number of elements
+
+        Returns:
+            np.ndarray: read-only array
+        """
+        array = np.frombuffer(self.shm.buf, dtype=np.dtype(dtype), count=size, offset=offset)
+        array.flags.writeable = False
+        return array
+
+    def column(self, column_name: str, split: str = None) -> Union[np.ndarray, StringColumn]:
+        """
+        Return values of column.
+
+        Args:
+            column_name (str): column name
+            split (str, optional): split. If None, all rows are returned.
+
+        Returns:
+            Union[np.ndarray, StringColumn]: view of values, or StringColumn if column consists of strings
+        """
+        if column_name in self.objects:
+            values = self.objects[column_name]
+        else:
+            kind, _buffers = self.layout[column_name]
+            if kind == 'numeric':
+                values = self._view(*_buffers[0])
+            else:
+                values = StringColumn(self._view(*_buffers[0]), self._view(*_buffers[1]))
+
+        if split is None:
+            return values
+        start, stop = self.split_ranges.get(split, (0, 0))
+        return values[start:stop]
+
+    def frame(self, split: str, column_names: List[str]) -> pd.DataFrame:
+        """
+        Return DataFrame of columns of split.
+
+        Args:
+            split (str): split
+            column_names (List[str]): column names
+
+        Returns:
+            pd.DataFrame: DataFrame, whose strings are decoded
+        """
+        _columns = {}
+        for column_name in column_names:
+            values = self.column(column_name, split)
+            _columns[column_name] = values.tolist() if isinstance(values, StringColumn) else values
+        return pd.DataFrame(_columns)
+
+    def unlink(self) -> None:
+        """
+        Release the block. Only the owner frees it.
+        """
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -8,6 +8,7 @@ from pathlib import Path
 import json
 import pandas as pd
 from distutils.util import strtobool
+from .cache import make_cache_key
 from .logger import BaseLogger
 from typing import List, Dict, Tuple, Union
 
@@ -28,11 +29,32 @@ class Options:
         self.parser = argparse.ArgumentParser(description='Options for training or test')
 
         # CSV
-        self.parser.add_argument('--csvpath', type=str, required=True, help='path to csv for training or test')
+        self.parser.add_argument('--csvpath', type=str, required=True, help='path to csv for training or test, which may be Parquet (.parquet) or Feather (.feather)')
 
         # GPU Ids
         self.parser.add_argument('--gpu_ids', type=str, default='cpu', help='gpu ids: e.g. 0, 0-1-2, 0-2. Use cpu for CPU (Default: cpu)')
 
+        # Image decoding
+        self.parser.add_argument('--image_decoder', type=str, default='pil', choices=['pil', 'native'], help='decoder of images: pil, or native which decodes images straight into arrays (Default: pil)')
+
+        # Image transfer
+        self.parser.add_argument('--image_transfer', type=str, default='float', choices=['float', 'uint'], help='dtype of images transferred from DataLoader: float, or uint which is scaled and normalized on device (Default: float)')
+
+        # Cache
+        self.parser.add_argument('--cache_dir',   type=str, default='cache', help='directory of caches (Default: cache)')
+        self.parser.add_argument('--csv_cache',   type=str, default='no', choices=['yes', 'no'], help='cache parsed csv in cache_dir as Feather, which needs pyarrow: yes, no (Default: no)')
+        self.parser.add_argument('--image_cache', type=str, default='no', choices=['yes', 'no'], help='cache decoded images on disk and read them through memory map: yes, no (Default: no)')
+        self.parser.add_argument('--prescan',     type=str, default='no', choices=['yes', 'no'], help='check headers of all images in parallel before loading them, and skip checks of each image: yes, no (Default: no)')
+        self.parser.add_argument('--tensor_cache_mb', type=int, default=0, metavar='N', help='budget in MiB of shared memory cache of transformed images of each split without augmentation, or 0 if not cached (Default: 0)')
+
+        # Shards
+        self.parser.add_argument('--shard_dir', type=str, default=None, help='directory of shards made by make_shards.py, which are streamed instead of reading each image (Default: None)')
+
+        # DataLoader
+        self.parser.add_argument('--io_prefetch',   type=int, default=0, metavar='N', help='number of threads in each worker of DataLoader to read files of images ahead of decoding, or 0 if not read ahead (Default: 0)')
+        self.parser.add_argument('--profile_loading', type=str, default='no', choices=['yes', 'no'], help='measure time of each phase of loading samples, and report histograms and the slowest files every epoch: yes, no (Default: no)')
+        self.parser.add_argument('--loader_tuning', type=str, default='no', choices=['auto', 'no'], help='tune workers of DataLoader by benchmarking them at startup: auto, no (Default: no)')
+
         if isTrain:
             # Task
             self.parser.add_argument('--task', type=str, required=True, choices=['classification', 'regression', 'deepsurv'], help='Task')
@@ -54,16 +76,31 @@ class Options:
             self.parser.add_argument('--bit_depth',       type=int, required=True, choices=[8, 16], help='bit depth of input image')
             self.parser.add_argument('--in_channel',      type=int, required=True, choices=[1, 3],  help='channel of input image')
             self.parser.add_argument('--vit_image_size',  type=int, default=0,                      help='input image size for ViT. Set 0 except when using ViT (Default: 0)')
+            self.parser.add_argument('--image_size',      type=int, default=0,                      help='size which image is resized to. Set 0 if not resized (Default: 0)')
             self.parser.add_argument('--augmentation',    type=str, default='no',  choices=['xrayaug', 'trivialaugwide', 'randaug', 'no'], help='kind of augmentation')
-            self.parser.add_argument('--normalize_image', type=str,                choices=['yes', 'no'], default='yes', help='image normalization: yes, no (Default: yes)')
+            self.parser.add_argument('--augmentation_stage', type=str, default='sample', choices=['sample', 'batch'], help='augmentation applied to each image or to a batch of images: sample, batch (Default: sample)')
+            self.parser.add_argument('--normalize_image', type=str,                choices=['yes', 'no', 'fold'], default='yes', help='image normalization: yes, no, or fold into the first convolution (Default: yes)')
 
             # Sampler
             self.parser.add_argument('--sampler',         type=str, required=True, choices=['weighted', 'distributed', 'distweight', 'no'], help='kind of sampler')
+            self.parser.add_argument('--balance',         type=str, default='label', choices=['label', 'group', 'label_group'], help='what weighted samplers balance: label, group, or label_group (Default: label)')
+            self.parser.add_argument('--shuffle_buffer',  type=int, default=1000, help='number of samples in buffer to shuffle samples streamed from shards (Default: 1000)')
 
             # Weight saving strategy
             self.parser.add_argument('--save_weight_policy', type=str,  choices=['best', 'each'], default='best',
                                                             help='Save weight policy: best, or each(ie. save each time loss decreases when multi-label output) (Default: best)')
 
+            # Validation
+            self.parser.add_argument('--async_val',         type=str, default='no', choices=['yes', 'no'], help='validate snapshot of weight in a separate process while training proceeds with the next epoch: yes, no (Default: no)')
+            self.parser.add_argument('--async_val_gpu_id',  type=str, default='cpu', help='gpu id of evaluator of async_val: e.g. 0. Use cpu for CPU (Default: cpu)')
+            self.parser.add_argument('--async_val_workers', type=int, default=0, metavar='N', help='number of workers of DataLoader of evaluator of async_val (Default: 0)')
+            self.parser.add_argument('--async_val_threads', type=int, default=0, metavar='N', help='number of threads of evaluator of async_val, or 0 if default of torch (Default: 0)')
+
+            # Checkpoint for resuming training
+            self.parser.add_argument('--checkpoint_steps',   type=int,   default=0, metavar='N', help='save checkpoint for resuming training every N steps, or 0 if not by steps (Default: 0)')
+            self.parser.add_argument('--checkpoint_minutes', type=float, default=0, metavar='N', help='save checkpoint for resuming training every N minutes, or 0 if not by minutes (Default: 0)')
+            self.parser.add_argument('--resume',             type=str,   default=None, help='path to checkpoint, or to directory of trial which contains checkpoint.pt, to resume training from (Default: None)')
+
         else:
             # Weight at training
             self.parser.add_argument('--weight', type=str, default=None,
@@ -93,41 +130,155 @@ class Options:
         return self.args
 
 
+def read_manifest_columns(csvpath: str) -> List[str]:
+    """
+    Return column names of csv, Parquet or Feather without reading rows.
+
+    Args:
+        csvpath (str): path to csv, Parquet (.parquet) or Feather (.feather)
+
+    Returns:
+        List[str]: column names
+
+    Note:
+        Parquet and Feather require pyarrow.
+    """
+    suffix = Path(csvpath).suffix.lower()
+    if suffix == '.parquet':
+        import pyarrow.parquet as pq
+        _columns = pq.read_schema(csvpath).names
+        # Index of DataFrame saved by pandas is not a column of manifest.
+        return [column for column in _columns if not column.startswith('__index_level_')]
+    elif suffix == '.feather':
+        import pyarrow.ipc as ipc
+        with ipc.open_file(csvpath) as reader:
+            return reader.schema.names
+    else:
+        return pd.read_csv(csvpath, nrows=0).columns.tolist()
+
+
+def read_manifest(csvpath: str, columns: List[str] = None) -> pd.DataFrame:
+    """
+    Read csv, Parquet or Feather.
+
+    Args:
+        csvpath (str): path to csv, Parquet (.parquet) or Feather (.feather)
+        columns (List[str], optional): columns to be read. If None, all columns are read.
+
+    Returns:
+        pd.DataFrame: manifest
+    """
+    suffix = Path(csvpath).suffix.lower()
+    if suffix == '.parquet':
+        return pd.read_parquet(csvpath, columns=columns)
+    elif suffix == '.feather':
+        return pd.read_feather(csvpath, columns=columns)
+    else:
+        return pd.read_csv(csvpath, usecols=columns)
+
+
 class CSVParser:
     """
     Class to get information of csv and cast csv.
+
+    Only columns used for training or test are read, and the excluded and cast DataFrame is cached in cache_dir as Feather if specified,
+    so that the later runs with the same csv and task load it without parsing csv.
     """
-    def __init__(self, csvpath: str, task: str, isTrain: bool = None) -> None:
+    # Columns read other than those of inputs, labels and period.
+    base_columns = ['uniqID', 'imgpath', 'split', 'group']
+
+    def __init__(self, csvpath: str, task: str, isTrain: bool = None, cache_dir: str = None) -> None:
         """
         Args:
-            csvpath (str): path to csv
+            csvpath (str): path to csv, Parquet (.parquet) or Feather (.feather)
             task (str): task
             isTrain (bool): if training or not
+            cache_dir (str, optional): directory of caches. If None, csv is not cached.
         """
         self.csvpath = csvpath
         self.task = task
 
-        _df_source = pd.read_csv(self.csvpath)
-        _df_source = _df_source[_df_source['split'] != 'exclude']
+        cache_path = self._cache_path(cache_dir) if cache_dir is not None else None
+        if (cache_path is not None) and cache_path.exists():
+            _df_source = pd.read_feather(cache_path)
+            self._set_column_names(_df_source.columns.tolist())
+        else:
+            _df_source = self._parse()
+            if cache_path is not None:
+                self._save(_df_source, cache_path)
+
+        self.df_source = _df_source
+
+        if isTrain:
+            self.mlp_num_inputs = len(self.input_list)
+            self.num_outputs_for_label = self._define_num_outputs_for_label(self.df_source, self.label_list, self.task)
 
-        self.input_list = list(_df_source.columns[_df_source.columns.str.startswith('input')])
-        self.label_list = list(_df_source.columns[_df_source.columns.str.startswith('label')])
+    def _cache_path(self, cache_dir: str) -> Path:
+        """
+        Return path to cache of csv.
+
+        Args:
+            cache_dir (str): directory of caches
+
+        Returns:
+            Path: path to cache, which depends on path and modification time of csv, and task
+        """
+        _stat = os.stat(self.csvpath)
+        key = make_cache_key(Path(self.csvpath).resolve(), _stat.st_mtime_ns, _stat.st_size, self.task)
+        return Path(cache_dir, f"manifest_{key}.feather")
+
+    @staticmethod
+    def _save(df_source: pd.DataFrame, cache_path: Path) -> None:
+        """
+        Save cache of csv.
+
+        Args:
+            df_source (pd.DataFrame): excluded and cast DataFrame
+            cache_path (Path): path to cache
+
+        Note:
+            Columns are saved with their types, but not index, which is not used.
+        """
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        df_source.reset_index(drop=True).to_feather(tmp_path)
+        os.replace(tmp_path, cache_path)
+
+    def _set_column_names(self, columns: List[str]) -> None:
+        """
+        Set names of columns of inputs, labels and period.
+
+        Args:
+            columns (List[str]): column names of csv
+        """
+        self.input_list = [column for column in columns if column.startswith('input')]
+        self.label_list = [column for column in columns if column.startswith('label')]
         if self.task == 'deepsurv':
-            _period_name_list = list(_df_source.columns[_df_source.columns.str.startswith('period')])
+            _period_name_list = [column for column in columns if column.startswith('period')]
             assert (len(_period_name_list) == 1), f"Only one column on period should be included in {self.csvpath} when deepsurv."
             self.period_name = _period_name_list[0]
 
+    def _parse(self) -> pd.DataFrame:
+        """
+        Read columns used for training or test, exclude rows, and cast them.
+
+        Returns:
+            pd.DataFrame: excluded and cast DataFrame
+        """
+        _columns = read_manifest_columns(self.csvpath)
+        self._set_column_names(_columns)
+
+        _period_list = [self.period_name] if self.task == 'deepsurv' else []
+        _required = set(self.base_columns + self.input_list + self.label_list + _period_list)
+        _df_source = read_manifest(self.csvpath, columns=[column for column in _columns if column in _required])
+        _df_source = _df_source[_df_source['split'] != 'exclude']
+
         _df_source = self._cast(_df_source, self.task)
 
         # If no column of group, add it.
         if 'group' not in _df_source.columns:
             _df_source = _df_source.assign(group='all')
-
-        self.df_source = _df_source
-
-        if isTrain:
-            self.mlp_num_inputs = len(self.input_list)
-            self.num_outputs_for_label = self._define_num_outputs_for_label(self.df_source, self.label_list, self.task)
+        return _df_source
 
     def _cast(self, df_source: pd.DataFrame, task: str) -> pd.DataFrame:
         """
@@ -268,6 +419,22 @@ def _collect_weight_paths(weight_dir: str) -> List[str]:
     return weight_paths
 
 
+def _get_checkpoint_path(resume: str) -> str:
+    """
+    Return path to checkpoint to resume training from.
+
+    Args:
+        resume (str): path to checkpoint, or to directory of trial which contains checkpoint.pt
+
+    Returns:
+        str: path to checkpoint
+    """
+    checkpoint_path = Path(resume, 'checkpoint.pt') if Path(resume).is_dir() else Path(resume)
+    if not checkpoint_path.is_file():
+        raise ValueError(f"Invalid checkpoint path: {resume}.")
+    return str(checkpoint_path)
+
+
 class ParamSet:
     """
     Class to store required parameters for each group.
@@ -306,7 +473,7 @@ class ParamTable:
         self.dispatch = {
                 'datetime': [sa],
                 'project': [sa, trp, tsp],
-                'csvpath': [sa, trp, tsp],
+                'csvpath': [dl, sa, trp, tsp],
                 'task': [dl, tsc, sa, lo, trp, tsp],
                 'isTrain': [dl],
 
@@ -314,6 +481,7 @@ class ParamTable:
                 'mlp': [mo, dl],
                 'net': [mo, dl],
                 'vit_image_size': [mo, sa, lo, trp, tsp],
+                'image_size': [dl, sa, lo, trp, tsp],
                 'pretrained': [mo, sa, trp],
 
                 'weight': [tsp],
@@ -328,12 +496,15 @@ class ParamTable:
                 'test_batch_size': [dl, tsp],
                 'test_splits': [tsc, tsp],
 
-                'bit_depth': [dl, sa, lo, trp, tsp],
+                'bit_depth': [mo, dl, sa, lo, trp, tsp],
                 'in_channel': [mo, dl, sa, lo, trp, tsp],
                 'augmentation': [dl, sa, trp],
-                'normalize_image': [dl, sa, lo, trp, tsp],
+                'augmentation_stage': [dl, sa, trp],
+                'normalize_image': [mo, dl, sa, lo, trp, tsp],
 
                 'sampler': [dl, sa, trp],
+                'balance': [dl, sa, trp],
+                'shuffle_buffer': [dl, trp],
 
                 'df_source': [dl],
                 'label_list': [dl, trc, sa, lo],
@@ -343,10 +514,28 @@ class ParamTable:
                 'num_outputs_for_label': [mo, sa, lo, tsc],
 
                 'save_weight_policy': [sa, trp, trc],
+                'async_val': [sa, trp, trc],
+                'async_val_gpu_id': [sa, trp, trc],
+                'async_val_workers': [sa, trp, trc],
+                'async_val_threads': [sa, trp, trc],
+                'checkpoint_steps': [sa, trp, trc],
+                'checkpoint_minutes': [sa, trp, trc],
+                'resume': [sa, trp, trc],
                 'scaler_path': [dl, tsp],
                 'save_datetime_dir': [trc, tsc, trp, tsp],
 
                 'gpu_ids': [dl, trc, tsc, sa, trp, tsp],
+                'cache_dir': [dl, trp, tsp],
+                'image_decoder': [dl, trp, tsp],
+                'image_transfer': [mo, dl, trp, tsp],
+                'csv_cache': [trp, tsp],
+                'image_cache': [dl, trp, tsp],
+                'tensor_cache_mb': [dl, trp, tsp],
+                'prescan': [dl, trp, tsp],
+                'shard_dir': [dl, trp, tsp],
+                'io_prefetch': [dl, trp, tsp],
+                'profile_loading': [dl, trp, tsp],
+                'loader_tuning': [dl, trp, tsp],
                 'dataset_info': [sa, trp, tsp]
                 }
 
@@ -503,6 +692,13 @@ def _arg2str(param: str, arg: Union[str, int, float]) -> str:
                 str_arg = f"{arg}  (Primary GPU:{arg[0]})"
             return str_arg
 
+        elif param == 'async_val_gpu_id':
+            if arg == []:
+                str_arg = 'CPU selected'
+            else:
+                str_arg = str(arg[0])
+            return str_arg
+
         elif param == 'test_splits':
             str_arg = ', '.join(arg)
             return str_arg
@@ -561,6 +757,21 @@ def _check_if_valid_criterion(criterion: str, task: str) -> None:
             f"Invalid criterion for task: task={task}, criterion={criterion}. Specify any of {valid_criterion[task]}."
 
 
+def _check_if_valid_image_size(image_size: int, net: str, vit_image_size: int) -> None:
+    """
+    Check if image_size is valid for network at training.
+
+    Args:
+        image_size (int): size which image is resized to, or 0 if not resized
+        net (str): CNN or ViT name, or None
+        vit_image_size (int): input image size for ViT
+    """
+    assert (image_size >= 0), f"image_size should be 0 or positive integer, but got {image_size}."
+    if (image_size > 0) and (net is not None) and net.startswith('ViT'):
+        assert (image_size == vit_image_size), \
+                f"image_size should be the same as vit_image_size when using ViT: image_size={image_size}, vit_image_size={vit_image_size}."
+
+
 def train_parse(args: argparse.Namespace) -> Dict[str, ParamSet]:
     """
     Parse parameters required at training.
@@ -573,6 +784,8 @@ def train_parse(args: argparse.Namespace) -> Dict[str, ParamSet]:
     """
     args.project = Path(args.csvpath).stem
     args.gpu_ids = _parse_gpu_ids(args.gpu_ids)
+    args.async_val_gpu_id = _parse_gpu_ids(args.async_val_gpu_id)
+    assert (len(args.async_val_gpu_id) <= 1), f"Evaluator of async_val uses a single GPU: {args.async_val_gpu_id}."
 
     # Check validity of sampler
     _check_if_valid_sampler(args.sampler, args.gpu_ids)
@@ -582,10 +795,17 @@ def train_parse(args: argparse.Namespace) -> Dict[str, ParamSet]:
 
     args.mlp, args.net = _parse_model(args.model)
     args.pretrained = bool(args.pretrained)  # strtobool('False') = 0 (== False)
+
+    # Check validity of image_size
+    _check_if_valid_image_size(args.image_size, args.net, args.vit_image_size)
     args.save_datetime_dir = str(Path('results', args.project, 'trials', args.datetime))
+    if args.resume is not None:
+        args.resume = _get_checkpoint_path(args.resume)
+        # Weights and learning curve are saved into the trial resumed.
+        args.save_datetime_dir = str(Path(args.resume).parent)
 
     # Parse csv
-    csvparser = CSVParser(args.csvpath, args.task, args.isTrain)
+    csvparser = CSVParser(args.csvpath, args.task, args.isTrain, cache_dir=(args.cache_dir if args.csv_cache == 'yes' else None))
     args.df_source = csvparser.df_source
     args.dataset_info = {split: len(args.df_source[args.df_source['split'] == split]) for split in ['train', 'val']}
     args.input_list = csvparser.input_list
@@ -642,6 +862,9 @@ def test_parse(args: argparse.Namespace) -> Dict[str, ParamSet]:
     # Make parameter table
     param_table = ParamTable()
 
+    # Not resized if not saved at training. Otherwise, overwritten by the value at training.
+    args.image_size = 0
+
     # Retrieve parameters required only at test
     param_path = str(Path(train_datetime_dir, 'parameters.json'))
     args = param_table.retrieve_parameter(args, param_path)
@@ -651,15 +874,19 @@ def test_parse(args: argparse.Namespace) -> Dict[str, ParamSet]:
 
     # Retrieve scaler path
     if args.mlp is not None:
-        args.scaler_path = str(Path(train_datetime_dir, 'scaler.pkl'))
+        args.scaler_path = str(Path(train_datetime_dir, 'scaler.pt'))
+        if not Path(args.scaler_path).exists():
+            # Scaler of sklearn saved at older training.
+            args.scaler_path = str(Path(train_datetime_dir, 'scaler.pkl'))
 
     # When test, the followings are always fixed.
     args.augmentation = 'no'
+    args.augmentation_stage = 'sample'
     args.sampler = 'no'
     args.pretrained = False
 
     # Parse csv
-    csvparser = CSVParser(args.csvpath, args.task)
+    csvparser = CSVParser(args.csvpath, args.task, cache_dir=(args.cache_dir if args.csv_cache == 'yes' else None))
     args.df_source = csvparser.df_source
 
     # Align test_splits
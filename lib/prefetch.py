@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from torch.utils.data.sampler import Sampler, BatchSampler
+from .logger import BaseLogger
+from typing import List, Dict, Iterator, NamedTuple
+
+
+logger = BaseLogger.get_logger(__name__)
+
+
+class PrefetchBatch(NamedTuple):
+    """
+    Indices of a batch, and indices of the batch which the same worker loads next.
+    """
+    indices: List[int]
+    upcoming: List[int]
+
+
+class LookaheadBatchSampler(BatchSampler):
+    """
+    Batch sampler which passes indices of the next batch of the same worker with each batch,
+    so that the worker reads files of the next batch while decoding the current one.
+
+    Note:
+        DataLoader dispatches batches to workers in turn, therefore the next batch of the same worker
+        is num_workers batches ahead, or the next one without workers.
+    """
+    def __init__(self, sampler: Sampler, batch_size: int, num_workers: int) -> None:
+        """
+        Args:
+            sampler (Sampler): sampler of indices
+            batch_size (int): batch size
+            num_workers (int): number of workers of DataLoader
+        """
+        super().__init__(sampler, batch_size, drop_last=False)
+        self.num_workers = num_workers
+
+    def __iter__(self) -> Iterator[PrefetchBatch]:
+        """
+        Return the iterator of batches.
+
+        Returns:
+            Iterator[PrefetchBatch]: indices of each batch and of the next batch of the same worker
+        """
+        stride = max(self.num_workers, 1)
+        batches = super().__iter__()
+        window = deque(itertools.islice(batches, stride))
+        for batch in batches:
+            indices = window.popleft()
+            window.append(batch)
+            yield PrefetchBatch(indices, batch)
+
+        while len(window) > 0:
+            yield PrefetchBatch(window.popleft(), [])
+
+
+def lookahead_loader_kwargs(loader_kwargs: Dict, num_workers: int) -> Dict:
+    """
+    Replace batch_size and sampler of keyword arguments of DataLoader with LookaheadBatchSampler for num_workers.
+
+    Args:
+        loader_kwargs (Dict): keyword arguments of DataLoader, whose sampler is not None and shuffle is False
+        num_workers (int): number of workers of DataLoader
+
+    Returns:
+        Dict: keyword arguments of DataLoader with batch_sampler
+    """
+    batch_sampler = LookaheadBatchSampler(loader_kwargs['sampler'], loader_kwargs['batch_size'], num_workers)
+    _loader_kwargs = {key: value for key, value in loader_kwargs.items() if key not in ['batch_size', 'sampler', 'shuffle']}
+    _loader_kwargs['batch_sampler'] = batch_sampler
+    return _loader_kwargs
+
+
+class FilePrefetcher:
+    """
+    Class to read files with a pool of threads in each DataLoader worker.
+
+    Files of the current batch are read in parallel, and files of the next batch are read while the current batch is decoded.
+    Since only files of these two batches are read ahead, the number of files held is bounded by twice the batch size.
+    """
+    def __init__(self, num_threads: int) -> None:
+        """
+        Args:
+            num_threads (int): number of threads to read files
+        """
+        self.num_threads = num_threads
+        self._executor = None
+        self._pending = {}
+        self._pid = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """
+        Return pool of threads of this process.
+
+        Returns:
+            ThreadPoolExecutor: pool of threads
+
+        Note:
+            Threads are not inherited by forked workers, therefore the pool is made in each process.
+        """
+        if self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.num_threads)
+            self._pending = {}
+            self._pid = os.getpid()
+        return self._executor
+
+    def __getstate__(self) -> dict:
+        """
+        Return state without the pool of threads, which is made again when used.
+
+        Returns:
+            dict: state
+        """
+        return {'num_threads': self.num_threads, '_executor': None, '_pending': {}, '_pid': None}
+
+    @staticmethod
+    def _read(path: str) -> bytes:
+        """
+        Read file.
+
+        Args:
+            path (str): path to file
+
+        Returns:
+            bytes: contents of file
+        """
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def fetch(self, indices: List[int], paths: List[str]) -> List[Future]:
+        """
+        Return files of the current batch being read, which are read now unless read ahead.
+
+        Args:
+            indices (List[int]): indices of the current batch
+            paths (List[str]): paths to files
+
+        Returns:
+            List[Future]: contents of files
+        """
+        executor = self._get_executor()
+        futures = []
+        for idx, path in zip(indices, paths):
+            future = self._pending.pop(idx, None)
+            if future is None:
+                future = executor.submit(self._read, path)
+            futures.append(future)
+        return futures
+
+    def read_ahead(self, indices: List[int], paths: List[str]) -> None:
+        """
+        Start reading files of the next batch.
+
+        Args:
+            indices (List[int]): indices of the next batch
+            paths (List[str]): paths to files
+        """
+        executor = self._get_executor()
+        for idx, path in zip(indices, paths):
+            if idx not in self._pending:
+                self._pending[idx] = executor.submit(self._read, path)
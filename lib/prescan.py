@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import contextlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+from .cache import file_lock
+from .logger import BaseLogger
+from typing import List, Dict, Tuple
+
+
+logger = BaseLogger.get_logger(__name__)
+
+
+# Bits per channel of PIL modes.
+MODE_BITS = {
+            '1': 1,
+            'L': 8,
+            'P': 8,
+            'LA': 8,
+            'RGB': 8,
+            'RGBA': 8,
+            'CMYK': 8,
+            'I;16': 16,
+            'I;16L': 16,
+            'I;16B': 16,
+            'I': 32,
+            'F': 32
+            }
+
+
+def stat_image(imgpath: str) -> Tuple[int, int]:
+    """
+    Return modification time and size of image file.
+
+    Args:
+        imgpath (str): path to image
+
+    Returns:
+        Tuple[int, int]: modification time in nanoseconds and size, or (-1, -1) if not found
+    """
+    try:
+        _stat = os.stat(imgpath)
+    except OSError:
+        return (-1, -1)
+    return (_stat.st_mtime_ns, _stat.st_size)
+
+
+def read_header(imgpath: str) -> Tuple[str, int, int, int]:
+    """
+    Read mode, size and bit depth of image from its header without decoding pixels, except for image of mode 'I'.
+
+    Args:
+        imgpath (str): path to image
+
+    Returns:
+        Tuple[str, int, int, int]: mode, height, width and bits per channel, or ('', 0, 0, 0) if it is not readable as image
+
+    Note:
+        Pixels of image of 'I' are 32bit integers, which are read to find whether they are within 16bit,
+        since such image is decoded as 16bit.
+    """
+    try:
+        with Image.open(imgpath) as image:
+            mode = image.mode
+            width, height = image.size
+            bits = MODE_BITS.get(mode, 0)
+            if mode == 'I':
+                min_value, max_value = image.getextrema()
+                bits = 16 if (min_value >= 0) and (max_value <= 65535) else 32
+    except (OSError, SyntaxError, ValueError):
+        return ('', 0, 0, 0)
+    return (mode, height, width, bits)
+
+
+class PrescanIndex:
+    """
+    Class for sidecar index of headers of images, ie. mode, size and bit depth.
+
+    Headers are read in parallel once before training or test, and saved with modification times and sizes of files.
+    When the index is updated again, only images whose modification time or size has changed are read.
+
+    Note:
+        The index is prescan_<key>.npz, whose arrays are aligned with imgpaths sorted as UTF-8 bytes.
+    """
+    def __init__(self, cache_dir: str, key: str) -> None:
+        """
+        Args:
+            cache_dir (str): directory of cache
+            key (str): key of index
+        """
+        self.cache_dir = Path(cache_dir)
+        self.key = key
+        self.index_path = Path(self.cache_dir, 'prescan_' + self.key + '.npz')
+        self.lock_path = Path(self.cache_dir, 'prescan_' + self.key + '.lock')
+        self.entries = self._empty()
+
+    @staticmethod
+    def _empty() -> Dict[str, np.ndarray]:
+        """
+        Return entries of no image.
+
+        Returns:
+            Dict[str, np.ndarray]: empty entries
+        """
+        return {
+                'imgpaths': np.array([], dtype=np.bytes_),
+                'mtime_ns': np.array([], dtype=np.int64),
+                'size': np.array([], dtype=np.int64),
+                'mode': np.array([], dtype=np.bytes_),
+                'height': np.array([], dtype=np.int64),
+                'width': np.array([], dtype=np.int64),
+                'bits': np.array([], dtype=np.int64)
+                }
+
+    def lock(self) -> contextlib.AbstractContextManager:
+        """
+        Return lock to update index only once among processes.
+
+        Returns:
+            contextlib.AbstractContextManager: lock
+        """
+        return file_lock(self.lock_path)
+
+    def load(self) -> None:
+        """
+        Load index if it exists.
+        """
+        if self.index_path.exists():
+            with np.load(self.index_path) as index:
+                self.entries = {name: index[name] for name in index.files}
+
+    def save(self) -> None:
+        """
+        Save index, which is written into temporary file first.
+        """
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_index_path = self.index_path.with_suffix('.tmp.npz')
+        np.savez(tmp_index_path, **self.entries)
+        os.replace(tmp_index_path, self.index_path)
+
+    def _positions(self, imgpaths: np.ndarray) -> np.ndarray:
+        """
+        Return positions of images in index.
+
+        Args:
+            imgpaths (np.ndarray): sorted paths to images as fixed-width UTF-8 bytes
+
+        Returns:
+            np.ndarray: positions of images, or -1 if not in index
+        """
+        if len(self.entries['imgpaths']) == 0:
+            return np.full(len(imgpaths), -1, dtype=np.int64)
+        positions = np.searchsorted(self.entries['imgpaths'], imgpaths)
+        positions = np.minimum(positions, len(self.entries['imgpaths']) - 1)
+        return np.where(self.entries['imgpaths'][positions] == imgpaths, positions, -1)
+
+    def update(self, imgpaths: np.ndarray, num_threads: int = None) -> Dict[str, np.ndarray]:
+        """
+        Read headers of images which are not in index or have been modified, and save index if any.
+
+        Args:
+            imgpaths (np.ndarray): paths to images as fixed-width UTF-8 bytes
+            num_threads (int, optional): number of threads to read files. Defaults to the number of CPUs.
+
+        Returns:
+            Dict[str, np.ndarray]: entries of images, which are aligned with unique imgpaths sorted
+        """
+        _imgpaths = np.unique(np.asarray(imgpaths, dtype=np.bytes_))
+        _decoded_paths = [imgpath.decode('utf-8') for imgpath in _imgpaths]
+        num_threads = os.cpu_count() if num_threads is None else num_threads
+
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            stats = np.array(list(executor.map(stat_image, _decoded_paths)), dtype=np.int64).reshape(-1, 2)
+
+        positions = self._positions(_imgpaths)
+        found = positions >= 0
+        stale = ~found.copy()
+        stale[found] = (self.entries['mtime_ns'][positions[found]] != stats[found, 0]) | (self.entries['size'][positions[found]] != stats[found, 1])
+
+        entries = {'imgpaths': _imgpaths, 'mtime_ns': stats[:, 0], 'size': stats[:, 1]}
+        modes = np.full(len(_imgpaths), b'', dtype=object)
+        modes[found] = self.entries['mode'][positions[found]]
+        for name in ['height', 'width', 'bits']:
+            entries[name] = np.zeros(len(_imgpaths), dtype=np.int64)
+            entries[name][found] = self.entries[name][positions[found]]
+
+        stale_rows = np.flatnonzero(stale)
+        if len(stale_rows) > 0:
+            logger.info(f"Scanning headers of {len(stale_rows)} of {len(_imgpaths)} images ...")
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                headers = list(executor.map(read_header, [_decoded_paths[i] for i in stale_rows]))
+            for i, (mode, height, width, bits) in zip(stale_rows, headers):
+                modes[i] = mode.encode('utf-8')
+                entries['height'][i] = height
+                entries['width'][i] = width
+                entries['bits'][i] = bits
+        entries['mode'] = np.array(modes.tolist(), dtype=np.bytes_)
+
+        if len(stale_rows) > 0:
+            # Entries of images of other splits are kept.
+            others = np.ones(len(self.entries['imgpaths']), dtype=bool)
+            others[positions[found]] = False
+            self.entries = {name: np.concatenate([self.entries[name][others], entries[name]]) for name in entries.keys()}
+            order = np.argsort(self.entries['imgpaths'], kind='stable')
+            self.entries = {name: values[order] for name, values in self.entries.items()}
+            self.save()
+
+        return entries
+
+
+def find_invalid_images(entries: Dict[str, np.ndarray], accepted_modes: List[str], bit_depth: int) -> List[str]:
+    """
+    Return images which are not found, not readable, of modes not accepted, or of more bits than bit_depth.
+
+    Args:
+        entries (Dict[str, np.ndarray]): entries of images returned by PrescanIndex.update
+        accepted_modes (List[str]): modes accepted
+        bit_depth (int): bits per channel which decoders make images into
+
+    Returns:
+        List[str]: messages of invalid images
+    """
+    _accepted_modes = np.array([mode.encode('utf-8') for mode in accepted_modes], dtype=np.bytes_)
+    invalid = np.flatnonzero(~np.isin(entries['mode'], _accepted_modes) | (entries['bits'] > bit_depth))
+    messages = []
+    for i in invalid:
+        imgpath = entries['imgpaths'][i].decode('utf-8')
+        if entries['mtime_ns'][i] < 0:
+            messages.append(f"{imgpath}: not found")
+        elif entries['mode'][i] == b'':
+            messages.append(f"{imgpath}: not readable as image")
+        elif entries['bits'][i] > bit_depth:
+            messages.append(f"{imgpath}: {entries['bits'][i]} bits of mode {entries['mode'][i].decode('utf-8')}")
+        else:
+            messages.append(f"{imgpath}: mode {entries['mode'][i].decode('utf-8')}")
+    return messages
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import multiprocessing
+import numpy as np
+import torch
+from .logger import BaseLogger
+from typing import Callable, Any
+
+
+logger = BaseLogger.get_logger(__name__)
+
+
+class LoadingProfiler:
+    """
+    Class to measure time of loading each sample by phase.
+
+    Histograms and the slowest samples are held in shared memory tensors made before DataLoader workers are forked,
+    so that all workers of a process add their measurements to them.
+    Each worker accumulates measurements locally, and adds them under lock once per batch.
+
+    Note:
+        Phases are read, ie. opening or decoding image, transform, tabular, ie. labels and periods, and total.
+        Since PIL decodes pixels when they are accessed, pixels are decoded in transform with pil decoder.
+        Bins of histograms are powers of 2 in microseconds, ie. the k-th bin holds times in [2^(k-1), 2^k) microseconds.
+    """
+    phases = ['read', 'transform', 'tabular', 'total']
+    num_bins = 32
+
+    def __init__(self, top_k: int = 10, flush_every: int = 64) -> None:
+        """
+        Args:
+            top_k (int): number of the slowest samples reported
+            flush_every (int): number of samples accumulated locally at most
+        """
+        self.top_k = top_k
+        self.flush_every = flush_every
+        self.counts = torch.zeros((len(self.phases), self.num_bins), dtype=torch.int64).share_memory_()
+        self.sums = torch.zeros(len(self.phases), dtype=torch.int64).share_memory_()
+        self.slowest_times = torch.full((top_k, len(self.phases)), -1, dtype=torch.int64).share_memory_()
+        self.slowest_rows = torch.full((top_k,), -1, dtype=torch.int64).share_memory_()
+        self.lock = multiprocessing.Lock()
+
+        self._current = np.zeros(len(self.phases), dtype=np.int64)
+        self._records = []
+
+    def timed(self, phase: str, func: Callable) -> 'TimedCall':
+        """
+        Wrap function to add its time to phase of the current sample.
+
+        Args:
+            phase (str): phase
+            func (Callable): function
+
+        Returns:
+            TimedCall: wrapped function
+        """
+        return TimedCall(self, self.phases.index(phase), func)
+
+    def timed_sample(self, func: Callable) -> 'TimedSample':
+        """
+        Wrap function making sample from index to record time of each phase and total.
+
+        Args:
+            func (Callable): function whose first argument is index of sample
+
+        Returns:
+            TimedSample: wrapped function
+        """
+        return TimedSample(self, func)
+
+    def start_sample(self) -> None:
+        """
+        Start measuring sample.
+        """
+        self._current = np.zeros(len(self.phases), dtype=np.int64)
+
+    def add_time(self, phase_index: int, elapsed: int) -> None:
+        """
+        Add time to phase of the current sample.
+
+        Args:
+            phase_index (int): index of phase
+            elapsed (int): time in nanoseconds
+        """
+        self._current[phase_index] += elapsed
+
+    def end_sample(self, idx: int, elapsed: int) -> None:
+        """
+        Record the current sample.
+
+        Args:
+            idx (int): index of sample
+            elapsed (int): total time in nanoseconds
+        """
+        self._current[-1] = elapsed
+        self._records.append((idx, self._current))
+        if len(self._records) >= self.flush_every:
+            self.flush()
+
+    def __getstate__(self) -> dict:
+        """
+        Return state without measurements accumulated locally.
+
+        Returns:
+            dict: state
+        """
+        state = self.__dict__.copy()
+        state['_current'] = np.zeros(len(self.phases), dtype=np.int64)
+        state['_records'] = []
+        return state
+
+    def _to_bins(self, times: np.ndarray) -> np.ndarray:
+        """
+        Return bins of times.
+
+        Args:
+            times (np.ndarray): times in nanoseconds
+
+        Returns:
+            np.ndarray: bins
+        """
+        microseconds = times // 1000
+        bins = np.where(microseconds > 0, np.floor(np.log2(np.maximum(microseconds, 1))).astype(np.int64) + 1, 0)
+        return np.minimum(bins, self.num_bins - 1)
+
+    def flush(self) -> None:
+        """
+        Add measurements accumulated locally to shared tensors.
+        """
+        if self._records == []:
+            return
+
+        rows = np.array([row for row, _ in self._records], dtype=np.int64)
+        times = np.stack([_times for _, _times in self._records])
+        self._records = []
+
+        # Phases which are not done for sample, eg. read of cached image, are not counted.
+        phase_indices, sample_indices = np.nonzero(times.T > 0)
+        counts = np.zeros((len(self.phases), self.num_bins), dtype=np.int64)
+        np.add.at(counts, (phase_indices, self._to_bins(times.T[phase_indices, sample_indices])), 1)
+
+        candidates = np.argsort(-times[:, -1], kind='stable')[:self.top_k]
+        with self.lock:
+            self.counts += torch.from_numpy(counts)
+            self.sums += torch.from_numpy(times.sum(axis=0))
+            slowest_times = torch.cat([self.slowest_times, torch.from_numpy(times[candidates])])
+            slowest_rows = torch.cat([self.slowest_rows, torch.from_numpy(rows[candidates])])
+            order = torch.argsort(slowest_times[:, -1], descending=True, stable=True)[:self.top_k]
+            self.slowest_times.copy_(slowest_times[order])
+            self.slowest_rows.copy_(slowest_rows[order])
+
+    def reset(self) -> None:
+        """
+        Clear measurements, which is done at the beginning of each epoch.
+        """
+        with self.lock:
+            self.counts.zero_()
+            self.sums.zero_()
+            self.slowest_times.fill_(-1)
+            self.slowest_rows.fill_(-1)
+
+    def _percentile(self, counts: torch.Tensor, q: float) -> float:
+        """
+        Return upper bound of percentile from histogram.
+
+        Args:
+            counts (torch.Tensor): histogram of phase
+            q (float): percentile in [0, 1]
+
+        Returns:
+            float: upper bound in milliseconds
+        """
+        cumulative = torch.cumsum(counts, dim=0).double()
+        _bin = int(torch.searchsorted(cumulative, torch.tensor([q * cumulative[-1]], dtype=torch.float64))[0])
+        return (2 ** _bin) / 1000
+
+    def report(self, name: str, describe: Callable[[int], str]) -> str:
+        """
+        Return report of histograms and the slowest samples.
+
+        Args:
+            name (str): name of report, eg. split
+            describe (Callable[[int], str]): function to return description of sample from index, eg. imgpath
+
+        Returns:
+            str: report
+        """
+        with self.lock:
+            counts = self.counts.clone()
+            sums = self.sums.clone()
+            slowest_times = self.slowest_times.clone()
+            slowest_rows = self.slowest_rows.clone()
+
+        num_samples = int(counts[-1].sum())
+        lines = [f"Loading profile of {name}: {num_samples} samples."]
+        for phase_index, phase in enumerate(self.phases):
+            num_done = int(counts[phase_index].sum())
+            if num_done == 0:
+                continue
+            mean = int(sums[phase_index]) / num_done / 1e6
+            lines.append(
+                        f"{phase:>9}: mean {mean:.2f} ms, "
+                        f"p50 < {self._percentile(counts[phase_index], 0.5):.3f} ms, "
+                        f"p90 < {self._percentile(counts[phase_index], 0.9):.3f} ms, "
+                        f"p99 < {self._percentile(counts[phase_index], 0.99):.3f} ms "
+                        f"({num_done} samples)"
+                        )
+
+        lines.append(f"The slowest samples ({', '.join(self.phases)} in ms):")
+        for _times, row in zip(slowest_times.tolist(), slowest_rows.tolist()):
+            if row < 0:
+                break
+            _phases = ', '.join(f"{_time / 1e6:.2f}" for _time in _times)
+            lines.append(f"  {_phases}: {describe(row)}")
+        return '\n'.join(lines)
+
+
+class TimedCall:
+    """
+    Function wrapped to add its time to phase of the current sample.
+    This is a class instead of closure, so that dataset is pickled into DataLoader workers.
+    """
+    def __init__(self, profiler: LoadingProfiler, phase_index: int, func: Callable) -> None:
+        """
+        Args:
+            profiler (LoadingProfiler): profiler
+            phase_index (int): index of phase
+            func (Callable): function
+        """
+        self.profiler = profiler
+        self.phase_index = phase_index
+        self.func = func
+
+    def __call__(self, *args, **kwargs) -> Any:
+        start = time.perf_counter_ns()
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            self.profiler.add_time(self.phase_index, time.perf_counter_ns() - start)
+
+
+class TimedSample:
+    """
+    Function making sample from index wrapped to record time of each phase and total.
+    """
+    def __init__(self, profiler: LoadingProfiler, func: Callable) -> None:
+        """
+        Args:
+            profiler (LoadingProfiler): profiler
+            func (Callable): function whose first argument is index of sample
+        """
+        self.profiler = profiler
+        self.func = func
+
+    def __call__(self, idx: int, *args, **kwargs) -> Any:
+        self.profiler.start_sample()
+        start = time.perf_counter_ns()
+        result = self.func(idx, *args, **kwargs)
+        self.profiler.end_sample(idx, time.perf_counter_ns() - start)
+        return result
@@ -0,0 +1,443 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import math
+import itertools
+import numpy as np
+import pandas as pd
+import torch
+import torch.distributed as dist
+from torch.utils.data.dataset import Dataset
+from torch.utils.data.sampler import Sampler, WeightedRandomSampler
+from torch.utils.data.distributed import DistributedSampler
+from .logger import BaseLogger
+from typing import List, Dict, Iterator, Optional, Union
+
+
+logger = BaseLogger.get_logger(__name__)
+
+
+class DistributedWeightedSampler:
+    def __init__(
+                self,
+                weights: torch.tensor,
+                split_data: Dataset,
+                num_replicas:Optional[int] = None,
+                rank: Optional[int] = None,
+                replacement: bool = True,
+                shuffle: bool = True,
+                drop_last: bool = False
+                ) -> None:
+        """
+        Distributed Weighted Sampler.
+        This is used when distributed training is performed with imbalanced dataset.
+
+        Args:
+            weights (torch.tensor): weights for each label in split_data
+            split_data (Dataset): dataset
+            num_replicas (Optional[int]): number of replicas
+            rank (Optional[int]): rank of the current process within num_replicas.
+                                By default, rank is retrieved from the current distributed group.
+            replacement (bool): if True, samples are drawn with replacement.
+                                If not, they are drawn without replacement,
+                                which means that when a sample index is drawn for a row,
+                                it cannot be drawn again for that row.
+            shuffle (bool): if True, sampler will shuffle the indices.
+            drop_last (bool): if True, the sampler will drop the last batch
+        """
+        if num_replicas is None:
+            if not dist.is_available():
+                raise RuntimeError("Requires distributed package to be available")
+            num_replicas = dist.get_world_size()
+
+        if rank is None:
+            if not dist.is_available():
+                raise RuntimeError("Requires distributed package to be available")
+            rank = dist.get_rank()
+
+        self.weights = weights
+        self.split_data = split_data
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.replacement = replacement
+        self.drop_last = drop_last
+        # If the dataset length is evenly divisible by the number of replicas, then
+        # there is no need to drop any data, since the dataset will be split equally.
+        if self.drop_last and len(self.split_data) % self.num_replicas != 0:
+            # Split to nearest available length that is evenly divisible.
+            # This is to ensure each rank receives the same amount of data when
+            # using this Sampler.
+            self.num_samples = math.ceil(
+                                    (len(self.split_data) - self.num_replicas) / self.num_replicas
+                                )
+        else:
+            self.num_samples = math.ceil(len(self.split_data) / self.num_replicas)
+
+        self.total_size = self.num_samples * self.num_replicas
+        self.shuffle = shuffle
+
+    def make_plan(self, epoch: int) -> torch.Tensor:
+        """
+        Make indices of this rank for epoch.
+
+        Args:
+            epoch (int): epoch number
+
+        Returns:
+            torch.Tensor: the balanced indices depending on weights
+
+        Note:
+            Indices are computed as tensors at once, and depend only on epoch and rank.
+        """
+        # Deterministically shuffle and sample based on epoch
+        g = torch.Generator()
+        g.manual_seed(epoch)
+
+        if self.shuffle:
+            indices = torch.randperm(len(self.split_data), generator=g)  # all indices
+        else:
+            indices = torch.arange(len(self.split_data))
+
+        if not self.drop_last:
+            # Add extra samples to make it evenly divisible
+            indices = indices.repeat(math.ceil(self.total_size / len(indices)))
+        # Remove tail of data to make it evenly divisible.
+        indices = indices[:self.total_size]
+
+        # subsample indices
+        indices = indices[self.rank:self.total_size:self.num_replicas]
+        assert len(indices) == self.num_samples
+
+        # Do the weighted sampling on the weights of this subsample,
+        # and map the balanced indices back to the original dataset index.
+        subsample_balanced_indices = torch.multinomial(self.weights[indices], self.num_samples, self.replacement, generator=g)
+        return indices[subsample_balanced_indices]
+
+    def __iter__(self) -> Iterator[int]:
+        """
+        Return the iterator of the indices.
+
+        Returns:
+            Iterator[int]: the balanced indices depending on weights
+        """
+        return iter(self.make_plan(self.epoch).tolist())
+
+    def __len__(self) -> int:
+        return self.num_samples
+
+    def set_epoch(self, epoch: int) -> None:
+        """
+        Sets the epoch for this sampler. When :attr:`shuffle=True`, this ensures all replicas
+        use a different random ordering for each epoch. Otherwise, the next iteration of this
+        sampler will yield the same ordering.
+
+        Args:
+            epoch (int): epoch number
+        """
+        self.epoch = epoch
+
+
+class DistributedEvalSampler:
+    """
+    Sampler to give each row to exactly one rank, which is used for evaluation in distributed training.
+
+    Unlike DistributedSampler, no rows are added to make the number of rows evenly divisible,
+    therefore ranks may have different numbers of rows, which should be taken into account when losses are reduced.
+
+    Note:
+        If there are fewer rows than ranks, a rank without rows is given the first row as padding,
+        since buffers of DDP are broadcast at the first forward of evaluation, which all ranks have to run.
+        Losses of padding, whose number is num_padding, should not be added.
+    """
+    def __init__(
+                self,
+                split_data: Dataset,
+                num_replicas: Optional[int] = None,
+                rank: Optional[int] = None
+                ) -> None:
+        """
+        Args:
+            split_data (Dataset): dataset
+            num_replicas (Optional[int]): number of replicas
+            rank (Optional[int]): rank of the current process within num_replicas.
+                                By default, rank is retrieved from the current distributed group.
+        """
+        if num_replicas is None:
+            if not dist.is_available():
+                raise RuntimeError("Requires distributed package to be available")
+            num_replicas = dist.get_world_size()
+
+        if rank is None:
+            if not dist.is_available():
+                raise RuntimeError("Requires distributed package to be available")
+            rank = dist.get_rank()
+
+        self.split_data = split_data
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.num_samples = len(range(self.rank, len(self.split_data), self.num_replicas))
+        self.num_padding = 1 if (self.num_samples == 0) and (len(self.split_data) > 0) else 0
+
+    def __iter__(self) -> Iterator[int]:
+        """
+        Return the iterator of the indices of this rank.
+
+        Returns:
+            Iterator[int]: the indices, or the first index as padding if no rows
+        """
+        if self.num_padding > 0:
+            return iter([0])
+        return iter(range(self.rank, len(self.split_data), self.num_replicas))
+
+    def __len__(self) -> int:
+        return self.num_samples + self.num_padding
+
+    def set_epoch(self, epoch: int) -> None:
+        """
+        Set the epoch, which does not change the order of the indices.
+
+        Args:
+            epoch (int): epoch number
+        """
+        self.epoch = epoch
+
+
+class ResumableSampler:
+    """
+    Sampler which starts from a batch in the middle of epoch, so that training is resumed without loading finished batches.
+
+    Random samplers, ie. RandomSampler and WeightedRandomSampler, are seeded at each epoch by seed drawn from the global random number generator
+    in the same way as RandomSampler without generator, therefore the global random number generator is consumed as it is without this.
+    Seed of the epoch is saved, so that the order of indices in the epoch is reproduced when resumed in the middle of it.
+    """
+    def __init__(self, sampler: Sampler, batch_size: int) -> None:
+        """
+        Args:
+            sampler (Sampler): sampler of indices
+            batch_size (int): batch size
+        """
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.epoch = 0
+        self.start_batch = 0
+        # Seed of the current epoch, and seed of epoch resumed, which is used instead of drawing it.
+        self.seed = None
+        self.resumed_seed = None
+        self.resumed_epoch = None
+
+        if hasattr(self.sampler, 'generator') and (self.sampler.generator is None):
+            self.sampler.generator = torch.Generator()
+
+    def __iter__(self) -> Iterator[int]:
+        """
+        Return the iterator of the indices from the start batch.
+
+        Returns:
+            Iterator[int]: the indices
+        """
+        if getattr(self.sampler, 'generator', None) is not None:
+            if self.epoch == self.resumed_epoch:
+                self.seed = self.resumed_seed
+                self.resumed_epoch = None
+            else:
+                # Drawn in the same way as RandomSampler without generator.
+                self.seed = int(torch.empty((), dtype=torch.int64).random_().item())
+            self.sampler.generator.manual_seed(self.seed)
+        return itertools.islice(iter(self.sampler), self.start_batch * self.batch_size, None)
+
+    def __len__(self) -> int:
+        return max(len(self.sampler) - self.start_batch * self.batch_size, 0)
+
+    def set_epoch(self, epoch: int) -> None:
+        """
+        Set the epoch, which determines the order of the indices.
+
+        Args:
+            epoch (int): epoch number
+        """
+        self.epoch = epoch
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def set_start_batch(self, start_batch: int) -> None:
+        """
+        Set the batch which the epoch starts from.
+
+        Args:
+            start_batch (int): number of batches already done in the epoch
+        """
+        self.start_batch = start_batch
+
+    def state_dict(self) -> Dict[str, int]:
+        """
+        Return state to reproduce the order of the indices.
+
+        Returns:
+            Dict[str, int]: state
+
+        Note:
+            Seed is used only if resumed in the middle of the same epoch, ie. not at the end of it.
+        """
+        return {'seed': self.seed, 'epoch': self.epoch}
+
+    def load_state_dict(self, state: Dict[str, int]) -> None:
+        """
+        Load state returned by state_dict().
+
+        Args:
+            state (Dict[str, int]): state
+        """
+        self.resumed_seed = state['seed']
+        self.resumed_epoch = state['epoch']
+
+
+def _encode(values: np.ndarray) -> np.ndarray:
+    """
+    Encode values into codes of 0, 1, 2, ....
+
+    Args:
+        values (np.ndarray): values, eg. class labels or groups
+
+    Returns:
+        np.ndarray: codes of values
+    """
+    if (values.dtype.kind in 'iu') and (len(values) > 0) and (values.min() >= 0):
+        # Class labels are already codes.
+        return values.astype(np.int64, copy=False)
+    codes, _ = pd.factorize(values, sort=True)
+    return codes.astype(np.int64, copy=False)
+
+
+def calculate_weights(columns: List[np.ndarray]) -> torch.Tensor:
+    """
+    Calculate weights for each element, which are inversely proportional to
+    the number of elements with the same combination of values of columns.
+
+    Args:
+        columns (List[np.ndarray]): columns to be balanced, eg. labels or group
+
+    Returns:
+        torch.Tensor: weights for each element
+
+    Note:
+        Combinations are encoded as mixed radix numbers, and counted with bincount at once.
+    """
+    keys = np.zeros(len(columns[0]), dtype=np.int64)
+    for column in columns:
+        codes = _encode(np.asarray(column))
+        num_codes = int(codes.max()) + 1 if len(codes) > 0 else 1
+        keys = keys * num_codes + codes
+        # Renumber combinations which appear, so that keys do not overflow.
+        appeared = np.bincount(keys) > 0
+        keys = (np.cumsum(appeared) - 1)[keys]
+
+    keys = torch.from_numpy(keys)
+    class_sample_count = torch.bincount(keys)
+    weight = 1. / class_sample_count.double()
+    samples_weight = weight[keys]
+    return samples_weight
+
+
+def _balance_columns(split_data: Dataset, label_list: List[str], balance: str) -> List[np.ndarray]:
+    """
+    Return columns to be balanced.
+
+    Args:
+        split_data (Dataset): dataset
+        label_list (List[str]): label list
+        balance (str): label, group, or label_group
+
+    Returns:
+        List[np.ndarray]: columns
+    """
+    _columns = []
+    if balance in ['label', 'label_group']:
+        _columns = _columns + [split_data.row_store.column(label_name) for label_name in label_list]
+    if balance in ['group', 'label_group']:
+        _columns = _columns + [split_data.row_store.column('group')]
+    return _columns
+
+
+def set_sampler(
+                task: str = None,
+                label_list: List[str] = None,
+                sampler: str = None,
+                split_data: Dataset = None,
+                balance: str = 'label'
+                ) -> Union[DistributedSampler, WeightedRandomSampler, DistributedWeightedSampler]:
+    """
+    Set sampler for split of training.
+
+    Args:
+        task (str): task
+        label_list (List[str]): label list
+        sampler (str): sampler
+        split_data (Dataset): dataset
+        balance (str): what weighted samplers balance, ie. label, group, or label_group.
+                       With multi-label, each combination of classes is balanced.
+
+    Returns:
+        Union[DistributedSampler, WeightedRandomSampler, DistributedWeightedSampler]: sampler
+
+    Note:
+        Samplers are used only at training.
+    """
+    shuffle = True
+    drop_last = False
+    _sampler = None
+
+    if sampler == 'no':
+        return _sampler
+
+    elif sampler == 'distributed':
+        _sampler = DistributedSampler(
+                                    split_data,
+                                    shuffle=shuffle,
+                                    drop_last=drop_last
+                                    )
+        return _sampler
+
+    elif sampler in ['weighted', 'distweight']:
+        if balance in ['label', 'label_group']:
+            assert (task == 'classification') or (task == 'deepsurv'), 'Cannot make sampler based on weight of label in regression.'
+
+        # Calculate weights on the whole targets
+        weights = calculate_weights(_balance_columns(split_data, label_list, balance))
+
+        if sampler == 'weighted':
+            # WeightedRandomSampler does shuffle automatically.
+            _sampler = WeightedRandomSampler(
+                                            weights,
+                                            len(weights)
+                                            )
+            return _sampler
+
+        if sampler == 'distweight':
+            _sampler = DistributedWeightedSampler(
+                                            weights,
+                                            split_data,
+                                            shuffle=shuffle,
+                                            drop_last=drop_last
+                                            )
+            return _sampler
+
+    else:
+        raise ValueError(f"Invalid sampler: {sampler}.")
+
+
+def set_eval_sampler(sampler: str = None, split_data: Dataset = None) -> Optional[DistributedEvalSampler]:
+    """
+    Set sampler for validation at training, which is neither resampled nor padded.
+
+    Args:
+        sampler (str): sampler for training
+        split_data (Dataset): dataset
+
+    Returns:
+        Optional[DistributedEvalSampler]: sampler, or None if not distributed
+    """
+    if sampler in ['distributed', 'distweight']:
+        return DistributedEvalSampler(split_data)
+    return None
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pickle
+from pathlib import Path
+import numpy as np
+import torch
+import torch.nn as nn
+from .logger import BaseLogger
+from typing import Iterable, Tuple
+
+
+logger = BaseLogger.get_logger(__name__)
+
+
+class MinMaxScaler(nn.Module):
+    """
+    Min-max scaler held as tensors.
+
+    This scales each feature into [0, 1] with min and max of training data
+    in the same way as sklearn.preprocessing.MinMaxScaler, and missing values are ignored in fitting.
+    Since min and max are buffers, it is saved with torch.save and can be registered in a network.
+    """
+    def __init__(self, num_features: int) -> None:
+        """
+        Args:
+            num_features (int): number of features
+        """
+        super().__init__()
+        self.register_buffer('data_min', torch.full((num_features,), float('inf'), dtype=torch.float64))
+        self.register_buffer('data_max', torch.full((num_features,), float('-inf'), dtype=torch.float64))
+
+    def partial_fit(self, x: torch.Tensor) -> 'MinMaxScaler':
+        """
+        Update min and max with chunk of rows.
+
+        Args:
+            x (torch.Tensor): chunk of shape (M, N), where M is the number of rows and N is the number of features
+
+        Returns:
+            MinMaxScaler: self
+        """
+        x = x.to(torch.float64)
+        isnan = torch.isnan(x)
+        self.data_min = torch.minimum(self.data_min, x.masked_fill(isnan, float('inf')).amin(dim=0))
+        self.data_max = torch.maximum(self.data_max, x.masked_fill(isnan, float('-inf')).amax(dim=0))
+        return self
+
+    def fit(self, chunks: Iterable[torch.Tensor]) -> 'MinMaxScaler':
+        """
+        Fit to chunks of rows, which are read one by one.
+
+        Args:
+            chunks (Iterable[torch.Tensor]): chunks of shape (M, N)
+
+        Returns:
+            MinMaxScaler: self
+        """
+        for chunk in chunks:
+            self.partial_fit(chunk)
+        return self
+
+    def _scale_and_min(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Return scale and offset of features.
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: scale and offset
+
+        Note:
+            As with sklearn, features of constant values are not scaled.
+        """
+        data_range = self.data_max - self.data_min
+        data_range = torch.where(data_range < 10 * torch.finfo(torch.float64).eps, torch.ones_like(data_range), data_range)
+        scale = 1.0 / data_range
+        return scale, -self.data_min * scale
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Scale features.
+
+        Args:
+            x (torch.Tensor): features of shape (M, N)
+
+        Returns:
+            torch.Tensor: scaled features of torch.float64
+        """
+        scale, offset = self._scale_and_min()
+        return x.to(torch.float64) * scale + offset
+
+    def save(self, save_path: str) -> None:
+        """
+        Save min and max.
+
+        Args:
+            save_path (str): path to scaler
+        """
+        torch.save(self.state_dict(), save_path)
+
+    @classmethod
+    def load(cls, scaler_path: str) -> 'MinMaxScaler':
+        """
+        Load scaler saved by save, or by pickle of sklearn.preprocessing.MinMaxScaler at older training.
+
+        Args:
+            scaler_path (str): path to scaler
+
+        Returns:
+            MinMaxScaler: scaler
+        """
+        if Path(scaler_path).suffix == '.pkl':
+            with open(scaler_path, 'rb') as f:
+                _scaler = pickle.load(f)
+            state_dict = {
+                        'data_min': torch.from_numpy(np.asarray(_scaler.data_min_, dtype=np.float64)),
+                        'data_max': torch.from_numpy(np.asarray(_scaler.data_max_, dtype=np.float64))
+                        }
+        else:
+            state_dict = torch.load(scaler_path, map_location='cpu')
+
+        scaler = cls(len(state_dict['data_min']))
+        scaler.load_state_dict(state_dict)
+        return scaler
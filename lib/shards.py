@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import io
+import json
+import tarfile
+from pathlib import Path
+from .cache import hash_file
+from .options import read_manifest
+from .logger import BaseLogger
+from typing import List, Dict, Tuple, Iterator, Union
+
+
+logger = BaseLogger.get_logger(__name__)
+
+
+INDEX_NAME = 'index.json'
+
+
+class ShardWriter:
+    """
+    Class to write samples into shards of tar.
+
+    Each sample consists of two members with the same key, ie. <key>.id and <key><ext>,
+    where <key>.id is uniqID of the sample and <key><ext> is the image file as it is.
+    Since members are read sequentially, shards are read with large sequential reads instead of random reads.
+    """
+    def __init__(self, shard_dir: str, split: str, samples_per_shard: int = 1000) -> None:
+        """
+        Args:
+            shard_dir (str): directory of shards
+            split (str): split
+            samples_per_shard (int): number of samples in each shard
+        """
+        self.shard_dir = Path(shard_dir)
+        self.split = split
+        self.samples_per_shard = samples_per_shard
+
+        self.shards = []
+        self._tar = None
+        self._tmp_path = None
+        self._shard_path = None
+        self._num_samples = 0
+
+    def _open_shard(self) -> None:
+        """
+        Open a new shard, which is written into temporary file first.
+        """
+        self._shard_path = Path(self.shard_dir, f"{self.split}-{len(self.shards):06d}.tar")
+        self._tmp_path = self._shard_path.with_suffix('.tar.tmp')
+        self._tar = tarfile.open(self._tmp_path, 'w')
+        self._num_samples = 0
+
+    def _close_shard(self) -> None:
+        """
+        Close the current shard and move it to the final path.
+        """
+        self._tar.close()
+        os.replace(self._tmp_path, self._shard_path)
+        self.shards.append({'path': self._shard_path.name, 'num_samples': self._num_samples})
+        self._tar = None
+
+    def _add_member(self, name: str, data: bytes) -> None:
+        """
+        Add member to the current shard.
+
+        Args:
+            name (str): name of member
+            data (bytes): contents of member
+        """
+        info = tarfile.TarInfo(name=name)
+        info.size = len(data)
+        self._tar.addfile(info, io.BytesIO(data))
+
+    def write(self, uniqID: str, imgpath: str) -> None:
+        """
+        Write sample.
+
+        Args:
+            uniqID (str): uniqID of sample
+            imgpath (str): path to image
+        """
+        if self._tar is None:
+            self._open_shard()
+
+        key = f"{self._num_samples:09d}"
+        with open(imgpath, 'rb') as f:
+            image_bytes = f.read()
+        self._add_member(key + '.id', str(uniqID).encode('utf-8'))
+        self._add_member(key + Path(imgpath).suffix.lower(), image_bytes)
+        self._num_samples += 1
+
+        if self._num_samples >= self.samples_per_shard:
+            self._close_shard()
+
+    def close(self) -> List[Dict[str, Union[str, int]]]:
+        """
+        Close writer.
+
+        Returns:
+            List[Dict[str, Union[str, int]]]: file name and number of samples of each shard
+        """
+        if self._tar is not None:
+            self._close_shard()
+        return self.shards
+
+
+def make_shards(csvpath: str, shard_dir: str, samples_per_shard: int = 1000) -> Dict:
+    """
+    Pack images listed in csv into shards for each split.
+
+    Args:
+        csvpath (str): path to csv
+        shard_dir (str): directory of shards
+        samples_per_shard (int): number of samples in each shard
+
+    Returns:
+        Dict: index of shards
+
+    Note:
+        The index is written after all shards, therefore its existence means that shards are complete.
+        It has hash of csv, so that shards are checked if they are made from the csv used for training or test.
+    """
+    df_source = read_manifest(csvpath, columns=['uniqID', 'imgpath', 'split'])
+    df_source = df_source[df_source['split'] != 'exclude']
+
+    Path(shard_dir).mkdir(parents=True, exist_ok=True)
+    index = {'csv_hash': hash_file(csvpath), 'splits': {}}
+
+    for split in df_source['split'].unique():
+        df_split = df_source[df_source['split'] == split]
+        writer = ShardWriter(shard_dir, split, samples_per_shard=samples_per_shard)
+        for uniqID, imgpath in zip(df_split['uniqID'], df_split['imgpath']):
+            writer.write(uniqID, imgpath)
+        index['splits'][split] = writer.close()
+        logger.info(f"Packed {len(df_split)} samples of {split} into {len(index['splits'][split])} shards.")
+
+    index_path = Path(shard_dir, INDEX_NAME)
+    tmp_index_path = index_path.with_suffix('.json.tmp')
+    with open(tmp_index_path, 'w') as f:
+        json.dump(index, f, indent=4)
+    os.replace(tmp_index_path, index_path)
+    return index
+
+
+def load_shard_index(shard_dir: str, csvpath: str) -> Dict:
+    """
+    Load index of shards.
+
+    Args:
+        shard_dir (str): directory of shards
+        csvpath (str): path to csv used for training or test
+
+    Returns:
+        Dict: index of shards
+    """
+    index_path = Path(shard_dir, INDEX_NAME)
+    assert index_path.exists(), f"No index of shards: {index_path}. Make shards with make_shards.py."
+    with open(index_path) as f:
+        index = json.load(f)
+
+    if index['csv_hash'] != hash_file(csvpath):
+        raise ValueError(f"Shards in {shard_dir} are not made from {csvpath}. Make shards again with make_shards.py.")
+    return index
+
+
+def iter_shard(shard_path: str) -> Iterator[Tuple[str, bytes]]:
+    """
+    Read samples from shard sequentially.
+
+    Args:
+        shard_path (str): path to shard
+
+    Yields:
+        Tuple[str, bytes]: uniqID and image file
+    """
+    uniqID = None
+    # Stream mode reads shard from the beginning to the end without seeking.
+    with tarfile.open(shard_path, 'r|') as tar:
+        for member in tar:
+            data = tar.extractfile(member).read()
+            if member.name.endswith('.id'):
+                uniqID = data.decode('utf-8')
+            else:
+                yield uniqID, data
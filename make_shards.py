@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+from lib import make_shards, BaseLogger
+
+
+logger = BaseLogger.get_logger(__name__)
+
+
+class ShardOptions:
+    """
+    Class for options.
+    """
+    def __init__(self) -> None:
+        """
+        Options for making shards.
+        """
+        self.parser = argparse.ArgumentParser(description='Options for making shards')
+        self.parser.add_argument('--csvpath',           type=str, required=True, help='path to csv for training or test')
+        self.parser.add_argument('--shard_dir',         type=str, required=True, help='directory where shards are saved')
+        self.parser.add_argument('--samples_per_shard', type=int, default=1000,  help='number of samples in each shard (Default: 1000)')
+        self.args = self.parser.parse_args()
+
+    def get_args(self) -> argparse.Namespace:
+        """
+        Return arguments.
+
+        Returns:
+            argparse.Namespace: arguments
+        """
+        return self.args
+
+
+def main(args):
+    make_shards(args.csvpath, args.shard_dir, samples_per_shard=args.samples_per_shard)
+    logger.info(f"Saved shards in {args.shard_dir}.")
+
+
+if __name__ == '__main__':
+    try:
+        logger.info('\nMaking shards started.\n')
+
+        args = ShardOptions().get_args()
+        main(args)
+
+    except Exception as e:
+        logger.error(e, exc_info=True)
+
+    else:
+        logger.info('\nMaking shards finished.\n')
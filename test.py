@@ -10,6 +10,7 @@ from lib import (
         print_parameter,
         get_elapsed_time,
         create_dataloader,
+        create_tensor_caches,
         set_device,
         create_model,
         BaseLogger
@@ -34,39 +35,56 @@ def main(
     save_datetime_dir = args_conf.save_datetime_dir
     device = set_device(gpu_ids=gpu_ids)
 
-    dataloaders = {split: create_dataloader(args_dataloader, split=split) for split in test_splits}
-    model = create_model(args_model)
-    likelihood = set_likelihood(args_conf.task, args_conf.num_outputs_for_label)
-
-    for weight_path in args_conf.weight_paths:
-        logger.info(f"Inference ...")
-
-        model.network.to(device)
-        model.load_weight(weight_path, on_device=device)
-        if gpu_ids != []:
-            model.network = nn.DataParallel(model.network, device_ids=gpu_ids)
-
-        model.network.eval()
-        for i, split in enumerate(test_splits):
-            for j, data in enumerate(dataloaders[split]):
-                in_data, _ = model.set_data(data, device)
-
-                with torch.no_grad():
-                    outputs = model(in_data)
-
-                # Make a new likelihood every batch
-                df_likelihood = likelihood.make_format(data, outputs)
-
-                if i + j == 0:
-                    save_dir = Path(save_datetime_dir, 'likelihoods')
-                    save_dir.mkdir(parents=True, exist_ok=True)
-                    save_path = Path(save_dir, 'likelihood_' + Path(weight_path).stem + '.csv')
-                    df_likelihood.to_csv(save_path, index=False)
-                else:
-                    df_likelihood.to_csv(save_path, mode='a', index=False, header=False)
-
-        # Reset the current weight by initializing network.
-        model.init_network()
+    # Transformed images are reused for each weight.
+    args_dataloader.tensor_caches = create_tensor_caches(args_dataloader, test_splits)
+    try:
+        dataloaders = {split: create_dataloader(args_dataloader, split=split) for split in test_splits}
+        model = create_model(args_model)
+        likelihood = set_likelihood(args_conf.task, args_conf.num_outputs_for_label)
+
+        for weight_path in args_conf.weight_paths:
+            logger.info(f"Inference ...")
+
+            model.network.to(device)
+            model.load_weight(weight_path, on_device=device)
+            if gpu_ids != []:
+                model.network = nn.DataParallel(model.network, device_ids=gpu_ids)
+
+            model.network.eval()
+            for i, split in enumerate(test_splits):
+                profiler = dataloaders[split].dataset.profiler
+                if profiler is not None:
+                    profiler.reset()
+
+                for j, data in enumerate(dataloaders[split]):
+                    in_data, _ = model.set_data(data, device)
+
+                    with torch.no_grad():
+                        outputs = model(in_data)
+
+                    # Make a new likelihood every batch
+                    df_likelihood = likelihood.make_format(data, outputs)
+
+                    if i + j == 0:
+                        save_dir = Path(save_datetime_dir, 'likelihoods')
+                        save_dir.mkdir(parents=True, exist_ok=True)
+                        save_path = Path(save_dir, 'likelihood_' + Path(weight_path).stem + '.csv')
+                        df_likelihood.to_csv(save_path, index=False)
+                    else:
+                        df_likelihood.to_csv(save_path, mode='a', index=False, header=False)
+
+                tensor_cache = getattr(dataloaders[split].dataset, 'tensor_cache', None)
+                if tensor_cache is not None:
+                    logger.info(f"Tensor cache of {split}: {tensor_cache.stats()}")
+                if profiler is not None:
+                    logger.info(profiler.report(split, lambda idx: dataloaders[split].dataset.row_store.get('imgpath', idx)))
+
+            # Reset the current weight by initializing network.
+            model.init_network()
+
+    finally:
+        for tensor_cache in args_dataloader.tensor_caches.values():
+            tensor_cache.unlink()
 
 
 if __name__ == '__main__':
@@ -14,21 +14,92 @@ from lib import (
         setenv,
         get_elapsed_time,
         create_dataloader,
+        fit_scaler,
+        create_tensor_caches,
         create_model,
         set_device,
         setup,
+        SharedManifest,
+        CheckpointSchedule,
+        get_rng_states,
+        set_rng_states,
+        gather_rank_states,
+        load_checkpoint,
+        to_cpu,
+        AsyncValidator,
         BaseLogger
         )
 from lib.component import (
             set_criterion,
             set_optimizer,
-            set_loss_store
+            set_loss_store,
+            LossSum
             )
 
 
 logger = BaseLogger.get_logger(__name__)
 
 
+def save_checkpoint(
+                    model,
+                    optimizer,
+                    loss_store,
+                    train_position,
+                    epoch,
+                    step,
+                    device,
+                    save_datetime_dir,
+                    isMaster,
+                    async_validator = None
+                    ):
+    # States of random number generators and sampler of all ranks are gathered into checkpoint of the master.
+    rank_states = gather_rank_states({'rng': get_rng_states(device), 'sampler': train_position.state_dict()})
+    if isMaster:
+        checkpoint = {
+                    'epoch': epoch,
+                    'step': step,
+                    'optimizer': to_cpu(optimizer.state_dict()),
+                    'loss_store': loss_store.state_dict(),
+                    'rank_states': rank_states
+                    }
+        if async_validator is not None:
+            # Epochs waiting for validation are validated again when resumed.
+            checkpoint['async_val'] = async_validator.state_dict()
+        model.save_checkpoint(save_datetime_dir, checkpoint)
+
+
+def finish_epoch(
+                model,
+                loss_store,
+                epoch,
+                save_weight_policy,
+                save_datetime_dir,
+                weight = None
+                ):
+    loss_store.cal_epoch_loss(at_epoch=epoch)
+    loss_store.print_epoch_loss(at_epoch=epoch)
+    if loss_store.is_val_loss_updated():
+        model.store_weight(at_epoch=loss_store.get_best_epoch(), state_dict=weight)
+        if (epoch > 1) and (save_weight_policy == 'each'):
+            model.save_weight(save_datetime_dir, as_best=False)
+
+
+def finish_validated_epochs(
+                            model,
+                            loss_store,
+                            async_validator,
+                            max_pending,
+                            save_weight_policy,
+                            save_datetime_dir
+                            ):
+    # Epochs are finished in order with weight validated, when their results are received.
+    while async_validator.num_pending > max_pending:
+        result = async_validator.next_result()
+        loss_store.store_sums('train', result['train_loss_sums'], result['train_num_data'])
+        loss_store.store_sums('val', result['val_loss_sums'], result['val_num_data'])
+        finish_epoch(model, loss_store, result['epoch'], save_weight_policy, save_datetime_dir, weight=result['weight'])
+
+
 def train(
         rank,
         world_size,
@@ -47,11 +118,36 @@ def train(
         save_weight_policy = args_conf.save_weight_policy
         save_datetime_dir = args_conf.save_datetime_dir
 
-    dataloaders = {split: create_dataloader(args_dataloader, split=split) for split in ['train', 'val']}
+    # With async_val, validation is done by evaluator of the master process.
+    isAsyncVal = (args_conf.async_val == 'yes')
+    phases = ['train'] if isAsyncVal else ['train', 'val']
+    dataloaders = {split: create_dataloader(args_dataloader, split=split) for split in phases}
+    async_validator = None
+    if isMaster and isAsyncVal:
+        async_validator = AsyncValidator(
+                                        args_model,
+                                        args_dataloader,
+                                        args_conf.criterion,
+                                        args_conf.label_list,
+                                        gpu_ids=args_conf.async_val_gpu_id,
+                                        num_workers=args_conf.async_val_workers,
+                                        num_threads=args_conf.async_val_threads
+                                        )
 
     device = set_device(rank=rank, gpu_ids=args_conf.gpu_ids)
+    if device.type == 'cuda':
+        # Objects are gathered on the device of each rank.
+        torch.cuda.set_device(device)
     model = create_model(args_model)
     model.network.to(device)
+
+    # Training continues from the step after the checkpoint.
+    checkpoint = load_checkpoint(args_conf.resume) if args_conf.resume is not None else None
+    start_epoch, start_step = 1, 0
+    if checkpoint is not None:
+        model.load_checkpoint(checkpoint)
+        start_epoch, start_step = checkpoint['epoch'], checkpoint['step']
+
     if isDistributed:
         # When device_ids = None of DDP,
         # both the input data for the forward pass and the actual module
@@ -60,13 +156,37 @@ def train(
 
     criterion = set_criterion(args_conf.criterion, device)
     optimizer = set_optimizer(args_conf.optimizer, model.network, args_conf.lr)
+    loss_store = None
     if isMaster:
         loss_store = set_loss_store(label_list=args_conf.label_list,
                                     num_epochs=args_conf.epochs,
                                     world_size=world_size)
 
-    for epoch in range(1, args_conf.epochs + 1):
-        for phase in ['train', 'val']:
+    # Position in epoch is restored by sampler, or by dataset when streaming shards.
+    train_dataset = dataloaders['train'].dataset
+    train_position = train_dataset if hasattr(train_dataset, 'set_start_batch') else dataloaders['train'].batch_sampler.sampler
+    checkpoint_schedule = CheckpointSchedule(steps=args_conf.checkpoint_steps, minutes=args_conf.checkpoint_minutes)
+
+    resumed_rng_states = None
+    if checkpoint is not None:
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        if isMaster:
+            loss_store.load_state_dict(checkpoint['loss_store'])
+        assert (len(checkpoint['rank_states']) == world_size), 'Number of processes should be the same as when checkpoint was saved.'
+        rank_state = checkpoint['rank_states'][rank]
+        train_position.load_state_dict(rank_state['sampler'])
+        if (async_validator is not None) and ('async_val' in checkpoint):
+            async_validator.load_state_dict(checkpoint['async_val'])
+        if start_step == 0:
+            set_rng_states(rank_state['rng'], device)
+        else:
+            # In the middle of epoch, restored after DataLoader draws its seed as it did before checkpoint.
+            resumed_rng_states = rank_state['rng']
+        logger.info(f"Resume training from step {start_step} of epoch {start_epoch}.")
+        del checkpoint
+
+    for epoch in range(start_epoch, args_conf.epochs + 1):
+        for phase in phases:
             # Sync all processes before starting with a new epoch.
             dist.barrier()
 
@@ -78,10 +198,35 @@ def train(
                 raise ValueError(f"Invalid phase: {phase}.")
 
             split_dataloader = dataloaders[phase]
-            if isDistributed:
-                split_dataloader.sampler.set_epoch(epoch)  # shuffle
+            if hasattr(split_dataloader.dataset, 'set_epoch'):
+                split_dataloader.dataset.set_epoch(epoch)  # shuffle shards
+            elif hasattr(split_dataloader.batch_sampler.sampler, 'set_epoch'):
+                # Sampler is wrapped by batch sampler, which may read files ahead.
+                split_dataloader.batch_sampler.sampler.set_epoch(epoch)  # shuffle
 
-            for i, data in enumerate(split_dataloader):
+            start_batch = 0
+            if phase == 'train':
+                # Batches done before checkpoint are skipped.
+                start_batch = start_step if epoch == start_epoch else 0
+                train_position.set_start_batch(start_batch)
+
+            # Losses are accumulated on device, and reduced over all ranks at once at the end of phase or at checkpoint.
+            # Ranks may have different numbers of validation data.
+            # Apart from DDP itself, ranks are synchronized in steps only when checkpoint_minutes is checked every few steps.
+            loss_sum = LossSum(args_conf.label_list, device)
+            # Rank without validation data runs forward of a row as padding with the others, whose losses are not added.
+            isPadding = (getattr(getattr(split_dataloader.batch_sampler, 'sampler', None), 'num_padding', 0) > 0)
+
+            profiler = split_dataloader.dataset.profiler
+            if profiler is not None:
+                profiler.reset()
+
+            batches = iter(split_dataloader)
+            if (phase == 'train') and (resumed_rng_states is not None):
+                set_rng_states(resumed_rng_states, device)
+                resumed_rng_states = None
+
+            for i, data in enumerate(batches, start=start_batch):
                 optimizer.zero_grad()
                 in_data, labels = model.set_data(data, device)
 
@@ -94,32 +239,57 @@ def train(
                         loss.backward()
                         optimizer.step()
 
-                # label-wise all-reduce
-                for label_name in losses.keys():
-                    dist.all_reduce(losses[label_name], op=dist.ReduceOp.SUM)
-
-                if isMaster:
-                    batch_size=len(data['imgpath'])
-                    loss_store.store(phase, losses, batch_size=batch_size)
-
-        if isMaster:
-            loss_store.cal_epoch_loss(at_epoch=epoch)
-            loss_store.print_epoch_loss(at_epoch=epoch)
-            if loss_store.is_val_loss_updated():
-                model.store_weight(at_epoch=loss_store.get_best_epoch())
-                if (epoch > 1) and (save_weight_policy == 'each'):
-                    model.save_weight(save_datetime_dir, as_best=False)
+                if not isPadding:
+                    loss_sum.add(losses, batch_size=len(data['imgpath']))
+
+                if (phase == 'train') and checkpoint_schedule.is_due(device):
+                    # Losses so far are saved with checkpoint.
+                    loss_sums, num_data = loss_sum.all_reduce()
+                    if isMaster:
+                        loss_store.store_sums(phase, loss_sums, num_data)
+                    save_checkpoint(model, optimizer, loss_store, train_position, epoch, i + 1, device, args_conf.save_datetime_dir, isMaster, async_validator)
+                    checkpoint_schedule.reset()
+
+            loss_sums, num_data = loss_sum.all_reduce()
+            if isMaster:
+                loss_store.store_sums(phase, loss_sums, num_data)
+
+            tensor_cache = getattr(split_dataloader.dataset, 'tensor_cache', None)
+            if isMaster and (tensor_cache is not None):
+                logger.info(f"Tensor cache of {phase}: {tensor_cache.stats()}")
+            if isMaster and (profiler is not None):
+                # Measured in DataLoader workers of the master process.
+                logger.info(profiler.report(phase, lambda idx: split_dataloader.dataset.row_store.get('imgpath', idx)))
+
+        if isMaster and isAsyncVal:
+            # Training proceeds while weight of this epoch is validated, with lag of at most one epoch.
+            train_loss_sums, train_num_data = loss_store.pop_sums('train')
+            async_validator.submit(epoch, train_loss_sums, train_num_data, model.snapshot_weight())
+            # The last epoch is waited for, so that the last checkpoint has no epochs pending.
+            max_pending = 1 if (epoch < args_conf.epochs) else 0
+            finish_validated_epochs(model, loss_store, async_validator, max_pending, save_weight_policy, save_datetime_dir)
+        elif isMaster:
+            finish_epoch(model, loss_store, epoch, save_weight_policy, save_datetime_dir)
+
+        if checkpoint_schedule.enabled:
+            # Checkpoint at the end of epoch, from which the next epoch starts.
+            save_checkpoint(model, optimizer, loss_store, train_position, epoch + 1, 0, device, args_conf.save_datetime_dir, isMaster, async_validator)
+            checkpoint_schedule.reset()
 
     # Sync all processes after all epochs.
     dist.barrier()
 
     # Save learning curve and weight
     if isMaster:
+        if isAsyncVal:
+            async_validator.close()
         loss_store.save_learning_curve(save_datetime_dir)
         model.save_weight(save_datetime_dir, as_best=True)
         if isMLP:
             # Save scaler
-            dataloaders['train'].dataset.save_scaler(save_datetime_dir + '/' + 'scaler.pkl')
+            dataloaders['train'].dataset.save_scaler(save_datetime_dir + '/' + 'scaler.pt')
+        # Weights are written in background until here.
+        model.finish_saving()
 
     dist.destroy_process_group()
 
@@ -135,18 +305,30 @@ def main(args):
     isDistributed = (len(args_conf.gpu_ids) >= 1)
     world_size = set_world_size(args_conf.gpu_ids)
 
-    mp.spawn(
-            train,
-            args=(
-                world_size,
-                args_model,
-                args_dataloader,
-                args_conf,
-                isDistributed
-                ),
-            nprocs=world_size,
-            join=True
-            )
+    # Ranks attach to the parsed csv in shared memory instead of receiving its copy.
+    args_dataloader.df_source = SharedManifest.publish(args_dataloader.df_source)
+    if args_dataloader.mlp is not None:
+        # Fitted once here instead of in each split of each rank.
+        args_dataloader.scaler = fit_scaler(args_dataloader.df_source, args_dataloader.input_list)
+    # Transformed images of splits without augmentation are shared by ranks.
+    args_dataloader.tensor_caches = create_tensor_caches(args_dataloader, ['train', 'val'])
+    try:
+        mp.spawn(
+                train,
+                args=(
+                    world_size,
+                    args_model,
+                    args_dataloader,
+                    args_conf,
+                    isDistributed
+                    ),
+                nprocs=world_size,
+                join=True
+                )
+    finally:
+        args_dataloader.df_source.unlink()
+        for tensor_cache in args_dataloader.tensor_caches.values():
+            tensor_cache.unlink()
 
     save_datetime_dir = args_conf.save_datetime_dir
     save_parameter(args_save, save_datetime_dir + '/' + 'parameters.json')